@@ -0,0 +1,546 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import codecs
+import contextlib
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from sgrk.outputbuf import OutputBuffer
+
+# Everything sysgrok persists between runs lives under this directory
+data_dir = os.path.expanduser(os.environ.get("SYSGROK_HOME", "~/.sysgrok"))
+runs_dir = os.path.join(data_dir, "runs")
+_index_path = os.path.join(runs_dir, "index.json")
+# Held while the index is read and rewritten, as more than one sysgrok may be running at once
+_index_lock_path = os.path.join(runs_dir, "index.lock")
+
+# Everything under data_dir is derived from the output of commands run on hosts, which may well be sensitive, so
+# only its owner may read it. See open_private and makedirs_private.
+PRIVATE_DIR_MODE = 0o700
+PRIVATE_FILE_MODE = 0o600
+
+# Once a new run is started, the oldest runs are deleted so that at most this many are kept. 0 keeps all runs.
+_max_runs = 100
+
+# The most bytes of a file of command results that are read at a time. See _read_command_records.
+_READ_BYTES = 1024 * 1024
+# The longest escape sequence in a JSON string written by json.dumps: a surrogate pair, e.g. \ud83d\ude00
+_MAX_ESCAPE_CHARS = 12
+# The content of a JSON string, up to its closing quote or to the first escape sequence that is incomplete,
+# because the rest of it has not been read yet. A high surrogate is only matched as part of a pair, so that a
+# pair is never split.
+_json_string_content_re = re.compile(r'(?:[^"\\]+|\\u[dD][89abAB][0-9a-fA-F]{2}\\u[0-9a-fA-F]{4}|'
+                                     r'\\u(?![dD][89abAB])[0-9a-fA-F]{4}|\\[^u])*')
+
+_COMMANDS_FILE = "commands.jsonl.gz"
+# LLM queries are made from the worker processes of a multiprocessing Pool as well as from the main
+# process, so each process appends to its own file to avoid interleaving writes.
+_LLM_FILE_PATTERN = "llm-{pid}.jsonl.gz"
+_META_FILE = "meta.json"
+# Checkpoints are also written from the worker processes of a Pool, so there is one file per process
+_CHECKPOINT_FILE_PATTERN = "checkpoints-{pid}.jsonl.gz"
+
+# The kinds of checkpoint written during a run. Completed commands do not need a checkpoint of their own,
+# as their results are already recorded as soon as each command finishes.
+CHECKPOINT_PLAN = "plan"
+CHECKPOINT_CHUNK_SUMMARY = "chunk_summary"
+CHECKPOINT_COMMAND_SUMMARY = "command_summary"
+
+
+def set_max_runs(n):
+    global _max_runs
+    _max_runs = n
+
+
+def _private_opener(path, flags):
+    return os.open(path, flags, PRIVATE_FILE_MODE)
+
+
+def open_private(path, mode, **kwargs):
+    """Open a file, as open does, creating it so that only its owner can read it if it does not exist"""
+
+    return open(path, mode, opener=_private_opener, **kwargs)
+
+
+def makedirs_private(path):
+    """Create a directory, and any of its parents that do not exist, so that only their owner can use them"""
+
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    if parent and parent != path:
+        makedirs_private(parent)
+    try:
+        os.mkdir(path, PRIVATE_DIR_MODE)
+    except FileExistsError:
+        pass
+
+
+@contextlib.contextmanager
+def _open_record_file(path):
+    # Each record is written as its own gzip member. gzip.open reads a file made of many members
+    # as if it was one stream, and appending a member at a time means a run that is interrupted
+    # still leaves a readable archive behind.
+    with open_private(path, "ab") as raw, gzip.open(raw, "at", encoding="utf-8") as f:
+        yield f
+
+
+def _append_record(path, record):
+    with _open_record_file(path) as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _read_records(path):
+    records = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                records.append(json.loads(line))
+    except (EOFError, OSError, json.JSONDecodeError) as e:
+        # The last record may be truncated if the run was killed while writing it
+        logging.warning(f"Stopped reading {path} after {len(records)} records: {e}")
+    return records
+
+
+class _RecordReader:
+    """Reads the text of a gzipped file of records, opened in binary mode, up to _READ_BYTES at a time. Each read
+    decompresses at most one piece of the file, so that the records before a truncated gzip member are read
+    before the error it causes is raised.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.text = ""
+
+    def read_more(self):
+        piece = self.f.read1(_READ_BYTES)
+        self.text += self.decoder.decode(piece, final=not piece)
+        return bool(piece)
+
+    def read_until(self, token):
+        """Returns the text up to token, and consumes it and the token, or returns None, without consuming
+        anything, if the current line ends first.
+        """
+
+        start = 0
+        while True:
+            i = self.text.find(token, start)
+            newline = self.text.find("\n", start)
+            if newline != -1 and (i == -1 or newline < i):
+                return None
+            if i != -1:
+                text, self.text = self.text[:i], self.text[i + len(token):]
+                return text
+            start = max(len(self.text) - len(token), 0)
+            if not self.read_more():
+                raise EOFError("The record was cut short")
+
+    def read_string(self, buffer):
+        """Read the rest of a JSON string, the opening quote of which has been consumed, and write it to
+        buffer as UTF-8 a piece at a time.
+        """
+
+        while True:
+            end = _json_string_content_re.match(self.text).end()
+            closed = end < len(self.text) and self.text[end] == '"'
+            if end:
+                buffer.write(json.loads(f'"{self.text[:end]}"', strict=False).encode("utf-8", errors="replace"))
+            self.text = self.text[end + 1 if closed else end:]
+            if closed:
+                return
+            if len(self.text) >= _MAX_ESCAPE_CHARS:
+                raise ValueError(f"Invalid escape sequence in a record: {self.text[:_MAX_ESCAPE_CHARS]}")
+            if not self.read_more():
+                raise EOFError("The record was cut short")
+
+
+def _read_command_records(path):
+    """Yields the command results recorded in the file at path, as dicts with the fields of a
+    cmdexec.CommandResult, with their stdout and stderr in OutputBuffers. The output is read into the
+    buffers a piece at a time, so that it is held the same way as the output of a command that is
+    executed, and is never all decoded at once.
+    """
+
+    count = 0
+    try:
+        with gzip.open(path, "rb") as f:
+            reader = _RecordReader(f)
+            while reader.text or reader.read_more():
+                header = reader.read_until(', "stdout": "')
+                if header is None:
+                    # Not written by record_command_result, so it is read whole
+                    line, _, reader.text = reader.text.partition("\n")
+                    record = json.loads(line)
+                    record["stdout"] = OutputBuffer.of(record["stdout"])
+                    record["stderr"] = OutputBuffer.of(record["stderr"])
+                else:
+                    record = json.loads(header + "}")
+                    for name, separator in (("stdout", None), ("stderr", ', "stderr": "')):
+                        if separator and reader.read_until(separator) != "":
+                            raise ValueError(f"Unexpected field in the record of '{record['command']}'")
+                        record[name] = OutputBuffer()
+                        reader.read_string(record[name])
+                        record[name].finish()
+                    if reader.read_until("}\n") != "":
+                        raise ValueError(f"Unexpected field in the record of '{record['command']}'")
+                count += 1
+                yield record
+    except FileNotFoundError:
+        return
+    except (EOFError, OSError, ValueError) as e:
+        # The last record may be truncated if the run was killed while writing it
+        logging.warning(f"Stopped reading {path} after {count} records: {e}")
+
+
+@contextlib.contextmanager
+def _index_lock():
+    makedirs_private(runs_dir)
+    with open_private(_index_lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _rebuild_index():
+    """Returns the metadata of every run in runs_dir, read from the runs' own directories"""
+
+    index = []
+    for path in glob.glob(os.path.join(runs_dir, "*", _META_FILE)):
+        try:
+            with open(path) as f:
+                index.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring the archived run in {os.path.dirname(path)}: {e}")
+    return index
+
+
+def _read_index():
+    try:
+        with open(_index_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except ValueError as e:
+        logging.warning(f"The index of archived runs, {_index_path}, is corrupt ({e}). Rebuilding it.")
+        return _rebuild_index()
+
+
+def _write_index(index):
+    tmp_path = f"{_index_path}.{os.getpid()}.tmp"
+    with open_private(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, _index_path)
+
+
+def _update_index(meta):
+    with _index_lock():
+        index = [m for m in _read_index() if m["id"] != meta["id"]]
+        index.append(meta)
+        _write_index(index)
+
+
+def _prune_runs(keep_id):
+    """Delete the oldest runs so that at most _max_runs are kept. The run keep_id is never deleted."""
+
+    if not _max_runs:
+        return
+
+    with _index_lock():
+        index = sorted(_read_index(), key=lambda m: m["started"])
+        pruned = [m for m in index if m["id"] != keep_id][:max(len(index) - _max_runs, 0)]
+        if not pruned:
+            return
+        pruned_ids = {m["id"] for m in pruned}
+        _write_index([m for m in index if m["id"] not in pruned_ids])
+
+    for m in pruned:
+        shutil.rmtree(os.path.join(runs_dir, m["id"]), ignore_errors=True)
+    logging.info(f"Deleted the {len(pruned)} oldest archived runs, to keep at most {_max_runs}")
+
+
+class RunArchive:
+    """The recorded command results and LLM queries of a single run of sysgrok. Runs are stored in
+    their own directory under runs_dir, as gzipped JSON lines files, and listed in an index file
+    in runs_dir.
+
+    As the run progresses, checkpoints of the work it has completed (the commands the LLM suggested, and
+    the summaries of commands and chunks of their output) are written alongside them, so that a run that
+    is interrupted can be resumed without repeating that work.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _META_FILE)) as f:
+            self.meta = json.load(f)
+        # The command results, with their output in OutputBuffers, and checkpoints recorded before the run
+        # was resumed
+        self._resumed_results = {}
+        self._resumed_checkpoints = {}
+
+    @property
+    def id(self):
+        return self.meta["id"]
+
+    def record_command_result(self, result):
+        """Append a cmdexec.CommandResult to the archive. It is written as a record with its fields, like those
+        written by _append_record, but its output is decoded and written a piece at a time, so that large output
+        is never all decoded at once.
+        """
+
+        with _open_record_file(os.path.join(self.path, _COMMANDS_FILE)) as f:
+            f.write(json.dumps({"command": result.command, "exit_code": result.exit_code})[:-1])
+            for name, buffer in (("stdout", result.stdout_buffer), ("stderr", result.stderr_buffer)):
+                f.write(f', "{name}": "')
+                for text in buffer.iter_text():
+                    f.write(json.dumps(text)[1:-1])
+                f.write('"')
+            f.write("}\n")
+        self.meta["commands"] = self.meta.get("commands", 0) + 1
+
+    def record_llm_query(self, messages, response):
+        _append_record(os.path.join(self.path, _LLM_FILE_PATTERN.format(pid=os.getpid())),
+                       {"time": time.time(), "messages": messages, "response": response})
+
+    def record_checkpoint(self, kind, key, value):
+        _append_record(os.path.join(self.path, _CHECKPOINT_FILE_PATTERN.format(pid=os.getpid())),
+                       {"kind": kind, "key": key, "value": value})
+
+    def get_checkpoint(self, kind, key):
+        """Returns the value of a checkpoint recorded before the run was resumed, or None if there is none"""
+
+        return self._resumed_checkpoints.get((kind, key))
+
+    def get_resumed_command_result(self, command):
+        """Returns the result, as a dict with its output in OutputBuffers, of a command that completed before
+        the run was resumed, or None
+        """
+
+        return self._resumed_results.get(command)
+
+    def command_results(self):
+        """Yields the archived command results, in the order they were recorded. See _read_command_records."""
+
+        return _read_command_records(os.path.join(self.path, _COMMANDS_FILE))
+
+    def llm_queries(self):
+        """Returns a list of the archived LLM queries, from all processes, ordered by time"""
+
+        queries = []
+        for path in glob.glob(os.path.join(self.path, _LLM_FILE_PATTERN.format(pid="*"))):
+            queries.extend(_read_records(path))
+        return sorted(queries, key=lambda q: q["time"])
+
+    def checkpoints(self):
+        """Returns a list of the checkpoints, as dicts, from all processes"""
+
+        checkpoints = []
+        for path in glob.glob(os.path.join(self.path, _CHECKPOINT_FILE_PATTERN.format(pid="*"))):
+            checkpoints.extend(_read_records(path))
+        return checkpoints
+
+    def resume(self):
+        """Continue recording to this archive, and make the work that the run had completed available"""
+
+        self._resumed_results = {r["command"]: r for r in self.command_results()}
+        # The results recorded before the run stopped are not recorded again, but are counted in it
+        self.meta["commands"] = len(self._resumed_results)
+        self._resumed_checkpoints = {(c["kind"], c["key"]): c["value"] for c in self.checkpoints()}
+        logging.info(f"Resuming run {self.id}: {len(self._resumed_results)} commands and "
+                     f"{len(self._resumed_checkpoints)} checkpoints were completed before it stopped")
+
+        self.meta.setdefault("resumed", []).append(time.time())
+        self.meta.pop("finished", None)
+        self.meta.pop("exit_code", None)
+        self._write_meta()
+
+    def restore_args(self, args, names):
+        """Set each of the named command line arguments that is not set in args to its value in the run"""
+
+        for name in names:
+            if getattr(args, name, None) in (None, []) and self.meta["args"].get(name) is not None:
+                setattr(args, name, self.meta["args"][name])
+
+    def finish(self, exit_code):
+        self.meta["finished"] = time.time()
+        self.meta["exit_code"] = exit_code
+        self._write_meta()
+
+    def _write_meta(self):
+        with open_private(os.path.join(self.path, _META_FILE), "w") as f:
+            json.dump(self.meta, f, indent=1)
+        _update_index(self.meta)
+
+    @classmethod
+    def create(cls, sub_command, args):
+        """Create the archive for a new run.
+
+        Args:
+            sub_command (str): The sub-command being run
+            args (dict): The command line arguments of the run. Only those that can be stored as JSON are kept.
+        """
+
+        started = time.time()
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}-{sub_command}-{os.getpid()}"
+        path = os.path.join(runs_dir, run_id)
+        makedirs_private(runs_dir)
+        os.mkdir(path, PRIVATE_DIR_MODE)
+
+        meta = {
+            "id": run_id,
+            "sub_command": sub_command,
+            "started": started,
+            "commands": 0,
+            "args": {k: v for k, v in args.items() if isinstance(v, (str, int, float, bool, list, type(None)))},
+        }
+        with open_private(os.path.join(path, _META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        archive = cls(path)
+        archive._write_meta()
+        return archive
+
+
+def list_runs():
+    """Returns the metadata of all archived runs, oldest first"""
+
+    return sorted(_read_index(), key=lambda m: m["started"])
+
+
+def open_run(run):
+    """Open an archived run.
+
+    Args:
+        run (str): The ID of the run, a unique prefix of an ID, "last" for the most recent run, or the path to
+            the run's directory.
+
+    Raises:
+        ValueError: If no single run matches.
+    """
+
+    if os.path.isfile(os.path.join(run, _META_FILE)):
+        return RunArchive(run)
+
+    runs = list_runs()
+    if run == "last":
+        matches = runs[-1:]
+    else:
+        matches = [m for m in runs if m["id"] == run] or [m for m in runs if m["id"].startswith(run)]
+
+    if len(matches) != 1:
+        raise ValueError(f"{'No' if not matches else 'More than one'} archived run matches '{run}'")
+
+    return RunArchive(os.path.join(runs_dir, matches[0]["id"]))
+
+
+_run_archive = None
+
+
+def set_run_archive(a):
+    global _run_archive
+    logging.debug(f"Archiving run to {a.path if a else None}")
+    _run_archive = a
+
+
+def get_run_archive():
+    return _run_archive
+
+
+def for_worker():
+    """Returns the settings to record to the current run's archive from a worker process with, to pass to
+    start_worker, or None if the run is not being archived
+    """
+
+    if _run_archive is None:
+        return None
+    return {"path": _run_archive.path, "checkpoints": _run_archive._resumed_checkpoints}
+
+
+def start_worker(settings):
+    """Record to the run's archive from a worker process, with the settings returned by for_worker in the
+    parent process. Workers that are spawned, rather than forked, do not inherit the archive, so it is
+    always set.
+    """
+
+    run_archive = None
+    if settings is not None:
+        run_archive = RunArchive(settings["path"])
+        run_archive._resumed_checkpoints = settings["checkpoints"]
+    set_run_archive(run_archive)
+
+
+def get_checkpoint(kind, key):
+    """Returns the value of a checkpoint recorded before the current run was resumed, or None"""
+
+    run_archive = get_run_archive()
+    return run_archive.get_checkpoint(kind, key) if run_archive else None
+
+
+def record_checkpoint(kind, key, value):
+    run_archive = get_run_archive()
+    if run_archive:
+        run_archive.record_checkpoint(kind, key, value)
+
+
+def start_run(sub_command, args):
+    """Create the archive for a new run and make it the archive that command results and LLM queries
+    are recorded to, and delete the oldest runs beyond the number to keep (see set_max_runs). Failing to
+    create the archive does not stop the run.
+    """
+
+    try:
+        run_archive = RunArchive.create(sub_command, args)
+        set_run_archive(run_archive)
+        _prune_runs(run_archive.id)
+    except OSError as e:
+        logging.warning(f"Failed to create the archive for this run in {runs_dir}: {e}")
+
+
+def resume_run(run, sub_command):
+    """Resume an archived run that was interrupted, making it the archive that command results, LLM
+    queries and checkpoints are recorded to.
+
+    Args:
+        run (str): The run to resume. See open_run.
+        sub_command (str): The sub-command being run, which must be the one the run was started with.
+
+    Returns:
+        RunArchive: The archive of the resumed run.
+
+    Raises:
+        ValueError: If no single run matches, or it was started with a different sub-command.
+    """
+
+    run_archive = open_run(run)
+    if run_archive.meta["sub_command"] != sub_command:
+        raise ValueError(f"Run {run_archive.id} is a {run_archive.meta['sub_command']} run, not {sub_command}")
+    if run_archive.meta.get("exit_code") == 0:
+        logging.warning(f"Run {run_archive.id} already completed successfully. Resuming it anyway.")
+
+    run_archive.resume()
+    set_run_archive(run_archive)
+    return run_archive
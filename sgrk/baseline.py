@@ -0,0 +1,134 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from sgrk.archive import data_dir, makedirs_private, open_private
+from sgrk.cmdexec import CommandResult
+from sgrk.cmdfilter import diff_command_output
+
+# Each baseline is stored as a single gzipped JSON file in this directory
+baselines_dir = os.path.join(data_dir, "baselines")
+
+_name_re = re.compile(r"^[\w.@-]+$")
+
+
+def _baseline_path(name):
+    if not _name_re.match(name):
+        raise ValueError(f"Invalid baseline name '{name}'. Names may only contain letters, digits, '.', '@', "
+                         "'_' and '-'.")
+    return os.path.join(baselines_dir, f"{name}.json.gz")
+
+
+def save_baseline(name, host, command_output):
+    """Save the output of commands as a baseline, replacing any existing baseline with the same name.
+
+    Args:
+        name (str): The name of the baseline, e.g. a host name, or a role such as "es-data-node"
+        host (str): The host the commands were executed on
+        command_output (dict): A dictionary mapping commands to CommandResults
+    """
+
+    path = _baseline_path(name)
+    makedirs_private(baselines_dir)
+    baseline = {
+        "name": name,
+        "host": host,
+        "created": time.time(),
+        "results": [r.to_dict() for r in command_output.values()],
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open_private(tmp_path, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as f:
+        json.dump(baseline, f)
+    os.replace(tmp_path, path)
+    logging.info(f"Saved the output of {len(command_output)} commands on {host} as baseline {name}")
+
+
+def load_baseline(name):
+    """Load a baseline.
+
+    Returns:
+        (dict, dict): The baseline's metadata (name, host and created), and a dictionary mapping commands
+            to CommandResults, in the order they were executed.
+
+    Raises:
+        ValueError: If there is no baseline with the name
+    """
+
+    try:
+        with gzip.open(_baseline_path(name), "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"No baseline named '{name}'. Create one with the baseline command.")
+
+    results = {r["command"]: CommandResult(**r) for r in baseline.pop("results")}
+    return baseline, results
+
+
+def list_baselines():
+    """Returns the metadata of all baselines, oldest first"""
+
+    baselines = []
+    for path in glob.glob(os.path.join(baselines_dir, "*.json.gz")):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+        baselines.append({"name": baseline["name"], "host": baseline["host"], "created": baseline["created"],
+                          "commands": len(baseline["results"])})
+    return sorted(baselines, key=lambda b: b["created"])
+
+
+def diff_with_baseline(baseline_output, command_output):
+    """Replace the output of each command with the differences from its output in a baseline.
+
+    Args:
+        baseline_output (dict): A dictionary mapping commands to their CommandResults in the baseline
+        command_output (dict): A dictionary mapping commands to their current CommandResults
+
+    Returns:
+        (dict, list): A dictionary mapping the commands whose output has changed to CommandResults whose
+            stdout is the differences (see cmdfilter.diff_command_output), and a list of the commands whose
+            output has not changed.
+    """
+
+    changed = {}
+    unchanged = []
+    for command, result in command_output.items():
+        baseline = baseline_output.get(command)
+        if baseline is None:
+            changed[command] = result
+            continue
+
+        stdout = diff_command_output(baseline.stdout, result.stdout)
+        if result.exit_code != baseline.exit_code:
+            stdout = f"Exit code changed from {baseline.exit_code} to {result.exit_code}\n{stdout}"
+        stderr = result.stderr if result.stderr != baseline.stderr else ""
+        if not stdout and not stderr:
+            unchanged.append(command)
+            continue
+
+        logging.debug(f"Output of '{command}' reduced from {len(result.stdout)} to {len(stdout)} characters "
+                      "by diffing it with the baseline")
+        changed[command] = CommandResult(command, result.exit_code, stdout, stderr)
+
+    logging.info(f"{len(changed)} commands have changed from the baseline, {len(unchanged)} have not")
+    return changed, unchanged
@@ -0,0 +1,77 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import logging
+import os
+
+from sgrk.archive import data_dir, makedirs_private, open_private
+
+cache_dir = os.path.join(data_dir, "cache")
+
+
+def cache_key(*parts):
+    """Returns a key, for use with FileCache, that is a hash of all of the given strings"""
+
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class FileCache:
+    """A persistent string to string cache, stored as one file per entry under cache_dir/name. Entries
+    are written atomically, so the cache can be shared by concurrent processes, including the worker
+    processes of a multiprocessing Pool. Errors reading or writing the cache are logged and otherwise
+    ignored, as the cache is only an optimisation.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(cache_dir, name)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self._entry_path(key), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f"Failed to read {self._entry_path(key)} from the cache: {e}")
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Failed to delete {self._entry_path(key)} from the cache: {e}")
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            makedirs_private(os.path.dirname(path))
+            with open_private(tmp_path, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to write {path} to the cache: {e}")
@@ -16,50 +16,97 @@
 # under the License.
 
 import logging
+import math
 
 from multiprocessing import Pool
 
-from sgrk import llm
+from sgrk import archive, llm, models, profiling
+from sgrk.archive import CHECKPOINT_CHUNK_SUMMARY, CHECKPOINT_COMMAND_SUMMARY, get_checkpoint, record_checkpoint
+from sgrk.cache import FileCache, cache_key
+from sgrk.cmdexec import CommandResult, get_compress_output, set_compress_output
+from sgrk.cmdfilter import compact_output_blocks, score_chunks
+from sgrk.cmdparsers import summarise_command_locally
+from sgrk.outputbuf import OutputBuffer, get_spill_bytes, set_spill_bytes
 
 
-def multiproc_wrapper_summarise_command(llm_config, *args):
+def worker_settings():
+    """Returns the settings of this process that the worker processes which summarise commands must use,
+    to pass to multiproc_wrapper_summarise_command. Workers are only given this process's settings when
+    they are forked. On macOS and Windows they are spawned instead, so the settings are always passed.
+    """
+
+    return {
+        "profile": profiling.for_worker(),
+        "archive": archive.for_worker(),
+        "models": models.for_worker(),
+        "spill_bytes": get_spill_bytes(),
+        "compress_output": get_compress_output(),
+    }
+
+
+def multiproc_wrapper_summarise_command(llm_config, budget, latency_stats, settings, *args):
     """Wrapper around summarise_command for use in multiprocessing scenarios. This is necessary
     as the LLM module makes use of a bunch of environment variables in its configuration, and
-    these must be set anew in each multiprocessing process.
+    these must be set anew in each multiprocessing process, as must the other settings returned
+    by worker_settings.
+
+    The budget is this process's share of the run's budget. It is returned, along with the result
+    of summarise_command, the prompt and latency statistics, and the process's profile (see
+    profiling.for_worker), so that the parent process can account for what was used.
     """
 
     llm.set_config(llm_config)
-    return summarise_command(*args)
+    llm.set_endpoint_quota_share(llm.get_max_concurrent_queries())
+    llm.set_budget(budget)
+    llm.set_prompt_stats(llm.PromptStats())
+    llm.set_latency_stats(latency_stats)
+    profiling.start_worker(settings["profile"])
+    archive.start_worker(settings["archive"])
+    models.start_worker(settings["models"])
+    set_spill_bytes(settings["spill_bytes"])
+    set_compress_output(settings["compress_output"])
+    try:
+        result = summarise_command(*args)
+    except llm.BudgetExhaustedError as e:
+        logging.warning(f"Could not summarise '{args[0]}': {e}")
+        result = args[0], f"Not summarised, as the run's budget was exhausted ({e})."
+    return result, llm.get_budget(), llm.get_prompt_stats(), llm.get_latency_stats(), profiling.finish_worker()
+
+
+# All of the prompts used to summarise a command begin with the same context, followed by the
+# instructions for the particular task, followed by the data for that particular command or chunk.
+# This means that all calls made during a run share a stable prompt prefix. It is too short to be cached
+# by the provider on its own, but it keeps the start of the prompts the same for any that are long enough.
+_command_context_with_problem = """I am a sysadmin. I am logged onto a Linux machine that is experiencing a problem,
+which I describe below. I am executing commands to debug that problem and I need you to summarise their output. Your
+summaries must focus on information that is useful in understanding and debugging the problem. They should also
+include any information that points to performance, security, reliability, or stability issues with the machine or
+any services running on it. If there is no information in the output of a command that is useful in understanding
+or debugging the problem say "No useful information".
 
+Problem: {problem_description}
 
-_summarise_summaries_prompt_with_problem = """I am a systems adminstrator. I have logged onto a Linux machine that
-is experiencing the following problem: {problem_description}. I have executed the command
-"{command}" to debug that problem.
+"""
 
-The full command output (stdout) is too long to give to you, so I have split the output into
-chunks and summarised those chunks. I will give you an ordered list of these summaries.
+_command_context_without_problem = """I am a sysadmin. I am logged onto a Linux machine and I am executing commands to
+check on its health. I need you to summarise their output. Your summaries should give an overview of any notable
+information found in the output of each command. In particular, your summaries must include any information that
+points to performance, security, reliability or stability issues with the machine or any services running on it.
 
-Your task is to create a summary of the entire command output from the chunk summaries. Your
-summary should focus on information that is useful in understanding and debugging the problem
-'{problem_description}'.
+"""
 
-Problem: {problem_description}
-Command: {command}
-Exit code: {exit_code}
-Stderr: {stderr}
-Stdout chunk summaries: {chunk_summaries}
-Final summary, created from the chunk summaries (must be {summary_max_chars} or fewer characters):"""
 
-_summarise_summaries_prompt_without_problem = """I am a systems adminstrator. I have logged onto a Linux machine
-and I have executed the command "{command}".
+def _get_command_context(problem_description):
+    """Returns the prompt prefix shared by all command summarisation prompts"""
+
+    if problem_description:
+        return _command_context_with_problem.format(problem_description=problem_description)
+    return _command_context_without_problem
 
-The full command output (stdout) is too long to give to you, so I have split the output into
-chunks and summarised those chunks. I will give you an ordered list of these summaries.
 
-Your task is to create a summary of the entire command output from the chunk summaries. Your
-summary should give the user an overview of all notable information found in the output of the
-command. Your summary must include any information that points to performance, security, reliability, or
-stability issues with the machine or any services running on it.
+_summarise_summaries_prompt = """The full output (stdout) of the command below is too long to give to you, so I have
+split the output into chunks and summarised those chunks. I will give you an ordered list of these summaries.
+Your task is to create a summary of the entire command output from the chunk summaries.
 
 Command: {command}
 Exit code: {exit_code}
@@ -74,186 +121,232 @@ def _summarise_chunk_summaries(command, command_output, chunk_summaries, summary
     produce the final output summary for that command from these individual output chunk summaries.
     """
 
-    if problem_description:
-        logging.debug(
-            f"Creating command summary from {len(chunk_summaries)} chunk summaries (max chars: {summary_max_chars}):"
-            f" {command}. Problem:'{problem_description}")
-        prompt = _summarise_summaries_prompt_with_problem.format(
-            problem_description=problem_description,
-            command=command,
-            summary_max_chars=summary_max_chars,
-            exit_code=command_output.exit_code,
-            stderr=command_output.stderr,
-            chunk_summaries=chunk_summaries)
-    else:
-        logging.debug(f"Creating command summary from {len(chunk_summaries)} chunk summaries "
-                      f" (max chars: {summary_max_chars}): {command}")
-        prompt = _summarise_summaries_prompt_without_problem.format(
-            command=command,
-            summary_max_chars=summary_max_chars,
-            exit_code=command_output.exit_code,
-            stderr=command_output.stderr,
-            chunk_summaries=chunk_summaries)
+    logging.debug(f"Creating command summary from {len(chunk_summaries)} chunk summaries "
+                  f" (max chars: {summary_max_chars}): {command}")
+    prompt = _summarise_summaries_prompt.format(
+        command=command,
+        summary_max_chars=summary_max_chars,
+        exit_code=command_output.exit_code,
+        stderr=command_output.stderr,
+        chunk_summaries=chunk_summaries)
 
-    summary = llm.get_llm_response(prompt)
+    summary = llm.get_llm_response(prompt, prefix=_get_command_context(problem_description))
     return command, summary
 
 
-def _split_command_output_into_chunks(command_output, chunk_num_chars):
-    lines = command_output.splitlines()
-    logging.debug(f"Split command output of len {len(command_output)} into {len(lines)} lines")
-
-    chunks = []
-    curr_chunk = []
-    curr_chunk_numchars = 0
-    for line in lines:
-        if curr_chunk_numchars + len(line) <= chunk_num_chars:
-            curr_chunk.append(line)
-            curr_chunk_numchars += len(line)
-            continue
-
-        chunks.append("\n".join(curr_chunk))
-        curr_chunk = [line]
-        curr_chunk_numchars = len(line)
-
-    chunks.append("\n".join(curr_chunk))
-    logging.debug(f"Split command output of len {len(command_output)} into {len(chunks)} chunks"
-                  f" with {chunk_num_chars} characters each")
-    return chunks
+_chunk_summary_cache = FileCache("chunk-summaries")
 
-
-_summarise_chunk_prompt_with_problem = """I am a systems adminstrator. I have logged onto a Linux machine that
-is experiencing the following problem: {problem_description}. I have executed the command
-"{command}" to debug that problem. Your task is to summarise the output of that command. Your
-summary should focus on information that is useful in understanding and debugging the problem
-'{problem_description}'. Your summary should also include any information that points to performance,
-security, reliability, or stability issues with the machine or any services running on it.
-
-The stdout output of the command is too long for you to process all at once so I will split it
-into chunks and provide you with those chunks to summarise one at a time. Your summary of each
-chunk must use a maximum of {chunk_summary_max_chars} text characters. Once you have summarised
+_summarise_chunk_prompt = """The stdout output of the command below is too long for you to process all at once so I
+will split it into chunks and provide you with those chunks to summarise one at a time. Once you have summarised
 each chunk I will then ask you to produce a final summary from each of the chunk summaries.
 Therefore you should also include in each chunk summary any information that you think would be
 useful to you when producing a final summary from the individual chunk summaries. If the output
-format of the command "{command}" means that information found in a particular chunk is
+format of the command means that information found in a particular chunk is
 necessary to understand a later chunk then you should include that information in your summary.
 
-Problem: {problem_description}
 Command: {command}
 Stdout (chunk {chunk_number} of {number_of_chunks}): {chunk_data}
 Chunk Summary (in {chunk_summary_max_chars} or fewer characters):"""
 
-_summarise_chunk_prompt_without_problem = """I am a sysems adminstrator. I have logged onto a Linux machine and
-executed the command "{command}". Your task is to summarise the output of that command. Your summary
-should give an overview of any notable information found in the output of the command. In particular,
-your summary must include any information that points to performance, security, reliability or stability
-issues with the machine or any services running on it.
 
-The stdout output of the command is too long for you to process all at once so I will split it
-into chunks and provide you with those chunks to summarise one at a time. Your summary of each
-chunk must use a maximum of {chunk_summary_max_chars} text characters. Once you have summarised
-each chunk I will then ask you to produce a final summary from each of the chunk summaries.
-Therefore you should also include in each chunk summary any information that you think would be
-useful to you when producing a final summary from the individual chunk summaries. If the output
-format of the command "{command}" means that information found in a particular chunk is
-necessary to understand a later chunk then you should include that information in your summary.
+def _get_affordable_calls(tokens_per_call):
+    """Returns how many LLM calls, each using up to tokens_per_call tokens, the current budget allows"""
 
-Command: {command}
-Stdout (chunk {chunk_number} of {number_of_chunks}): {chunk_data}
-Chunk Summary (in {chunk_summary_max_chars} or fewer characters):"""
+    budget = llm.get_budget()
+    affordable = [n for n in (budget.remaining_calls(), budget.remaining_tokens()) if n is not None]
+    if budget.remaining_tokens() is not None:
+        affordable[-1] = affordable[-1] // tokens_per_call
+    return min(affordable) if affordable else float("inf")
 
 
-def _summarise_command_chunked(command, command_output, summary_max_chars, problem_description=None):
+def _summarise_command_chunked(command, command_output, summary_max_chars, problem_description=None, cache=True):
     """Use the LLM to summarise the output of a command in summary_max_chars or fewer characters.
     This function should be used when the command_output results in a summarisation prompt that
     is too large for the model's context window limit.
 
+    The output is split into chunks greedily, line by line, so when the output of a command only grows
+    at the end (e.g. logs) all but the last few chunks are the same as in an earlier run. If cache is
+    true then the summaries of those chunks are reused, and only the new chunks are summarised.
+
     Experimentation is still needed to validate whether or not the approach in this function
     loses information in comparison to the normal summarise_command approach which can fit the
     entire command output in a single call to the LLM.
     """
 
     # Step 1: Split the input data into chunks
-    if problem_description:
-        # To split the command output we need to know how long each chunk can be. This depends on the
-        # prompt that it will be embedded in, so we need to create that prompt, minus the chunk summary.
-        summarise_chunk_dummy_prompt = _summarise_chunk_prompt_with_problem.format(
-                problem_description=problem_description,
-                command=command,
-                chunk_summary_max_chars=100000,
-                chunk_data="",
-                chunk_number=1000,
-                number_of_chunks=1000)
-        # We also need to know how long each chunk summary can be. This depends on the prompt that will
-        # eventually be used to compute the final summary from the chunk summaries.
-        summarise_summaries_dummy_prompt = _summarise_summaries_prompt_with_problem.format(
-            problem_description=problem_description,
-            command=command,
-            summary_max_chars=summary_max_chars,
-            exit_code=command_output.exit_code,
-            stderr=command_output.stderr,
-            chunk_summaries="")
-    else:
-        summarise_chunk_dummy_prompt = _summarise_chunk_prompt_without_problem.format(
-                command=command,
-                chunk_summary_max_chars=100000,
-                chunk_data="",
-                chunk_number=1000,
-                number_of_chunks=1000)
-        summarise_summaries_dummy_prompt = _summarise_summaries_prompt_without_problem.format(
-            command=command,
-            summary_max_chars=summary_max_chars,
-            exit_code=command_output.exit_code,
-            stderr=command_output.stderr,
-            chunk_summaries="")
-
-    # Calculate the number of characters that should be in each chunk and then split
-    summarise_chunk_dummy_prompt_tokens = llm.get_token_count(summarise_chunk_dummy_prompt)
-    chunk_tokens = llm.get_model_max_tokens() - summarise_chunk_dummy_prompt_tokens
-    chunk_num_chars = int(chunk_tokens * llm.get_command_char_token_ratio() + 0.5)
-    chunks = _split_command_output_into_chunks(command_output.stdout, chunk_num_chars)
-
-    # Calculate the maximum number of characters each chunk summary can use
-    summarise_summaries_dummy_prompt_tokens = llm.get_token_count(summarise_summaries_dummy_prompt)
+    # To split the command output we need to know how long each chunk can be. This depends on the
+    # prompt that it will be embedded in, so we need to create that prompt, minus the chunk summary.
+    context = _get_command_context(problem_description)
+    summarise_chunk_dummy_prompt = _summarise_chunk_prompt.format(
+        command=command,
+        chunk_summary_max_chars=100000,
+        chunk_data="",
+        chunk_number=1000,
+        number_of_chunks=1000)
+    # We also need to know how long each chunk summary can be. This depends on the prompt that will
+    # eventually be used to compute the final summary from the chunk summaries.
+    summarise_summaries_dummy_prompt = _summarise_summaries_prompt.format(
+        command=command,
+        summary_max_chars=summary_max_chars,
+        exit_code=command_output.exit_code,
+        stderr=command_output.stderr,
+        chunk_summaries="")
+
+    # Calculate the number of characters that should be in each chunk and then split. The chunks are
+    # summarised by the model for the chunk summary phase, so their size depends on that model.
+    with llm.phase(llm.PHASE_CHUNK_SUMMARY):
+        summarise_chunk_dummy_prompt_tokens = llm.get_token_count(context + summarise_chunk_dummy_prompt)
+        chunk_tokens = int((llm.get_model_max_tokens() - summarise_chunk_dummy_prompt_tokens) *
+                           llm.get_chunk_fraction())
+        chunk_num_chars = int(chunk_tokens * llm.measure_char_token_ratio(command_output.stdout_buffer) + 0.5)
+    # Chunks are sized in bytes, which for output that is not ASCII is more than its characters, so they
+    # may be a little smaller than they could be but never too large
+    with profiling.span(profiling.SPAN_CHUNKING):
+        chunks = command_output.stdout_buffer.chunks(chunk_num_chars)
+
+    # Calculate the maximum number of characters each chunk summary can use. This is rounded down to a
+    # power of two so that it usually stays the same when the output grows by a few chunks, which means
+    # the cached summaries of the earlier chunks can still be used.
+    summarise_summaries_dummy_prompt_tokens = llm.get_token_count(context + summarise_summaries_dummy_prompt)
     summary_tokens_available = llm.get_model_max_tokens() - summarise_summaries_dummy_prompt_tokens
     chunk_summary_max_tokens = int(summary_tokens_available / len(chunks) + 0.5)
     chunk_summary_max_chars = int(chunk_summary_max_tokens * llm.get_prose_char_token_ratio())
+    chunk_summary_max_chars = 2 ** int(math.log2(max(chunk_summary_max_chars, 1)))
 
     # Step 2: Summarise each chunk
-    chunk_idx = 0
-    chunk_summaries = []
-    num_chunks = len(chunks)
-    while chunk_idx < num_chunks:
-        if problem_description:
-            logging.debug(
-                f"Summarising command chunk {chunk_idx+1}/{num_chunks} (max chars: {chunk_summary_max_chars}): "
-                f"{command}. Problem: '{problem_description}'")
-            prompt = _summarise_chunk_prompt_with_problem.format(
-                problem_description=problem_description,
-                command=command,
-                chunk_summary_max_chars=chunk_summary_max_chars,
-                chunk_data=chunks[chunk_idx],
-                chunk_number=chunk_idx,
-                number_of_chunks=num_chunks)
-        else:
-            logging.debug(f"Summarising command chunk {chunk_idx+1}/{num_chunks} (max chars: "
-                          f"{chunk_summary_max_chars}): {command}")
-            prompt = _summarise_chunk_prompt_without_problem.format(
-                command=command,
-                chunk_summary_max_chars=chunk_summary_max_chars,
-                chunk_data=chunks[chunk_idx],
-                chunk_number=chunk_idx,
-                number_of_chunks=num_chunks)
-
-        chunk_summaries.append(llm.get_llm_response(prompt))
-        chunk_idx += 1
+    chunk_summaries = _summarise_chunks(command, chunks, chunk_summary_max_chars, problem_description, cache)
 
     # Step 3: Create a final summary from the summaries of each chunk
     return _summarise_chunk_summaries(command, command_output, chunk_summaries, summary_max_chars, problem_description)
 
 
-def summarise_command(command, command_output, summary_max_chars=None, problem_description=None):
-    """Use the LLM to summarise the output of a command.
+@llm.phase(llm.PHASE_CHUNK_SUMMARY)
+def _summarise_chunks(command, chunks, chunk_summary_max_chars, problem_description, cache):
+    """Summarise each chunk of a command's output. Chunks that were summarised in an earlier run, for the
+    same problem and model, are taken from the cache, as are those summarised before the run was resumed.
+
+    If there are more chunks left to summarise than the max_chunks_per_command setting, or the run's
+    budget, allows then only those that cmdfilter.score_chunks ranks as the most informative are
+    summarised, and a note of which chunks were skipped is added in place of the others.
+    """
+
+    num_chunks = len(chunks)
+    model = llm.get_model()
+    cache_keys = [cache_key(model, problem_description or "", command, chunk_summary_max_chars, chunk)
+                  for chunk in chunks]
+    cached_summaries = [get_checkpoint(CHECKPOINT_CHUNK_SUMMARY, k) or (_chunk_summary_cache.get(k) if cache else None)
+                        for k in cache_keys]
+    uncached_chunks = [i for i, summary in enumerate(cached_summaries) if summary is None]
+    logging.debug(f"{num_chunks - len(uncached_chunks)} of {num_chunks} chunk summaries for '{command}' are cached")
+
+    # If the budget does not allow us to summarise every chunk, plus the final summary, then only
+    # summarise as many of the chunks as we can afford
+    max_chunks = _get_affordable_calls(llm.get_model_max_tokens()) - 1
+    if max_chunks < len(uncached_chunks):
+        logging.warning(f"Only summarising {max(max_chunks, 1)} of {len(uncached_chunks)} output chunks "
+                        f"for '{command}' to stay within the run's budget")
+    max_chunks = max(max_chunks, 1)
+    if llm.get_max_chunks_per_command():
+        max_chunks = min(max_chunks, llm.get_max_chunks_per_command())
+
+    selected_chunks = set(uncached_chunks)
+    if max_chunks < len(uncached_chunks):
+        scores = score_chunks(chunks)
+        selected_chunks = set(sorted(uncached_chunks, key=lambda i: scores[i], reverse=True)[:max_chunks])
+        logging.info(f"Summarising the {max_chunks} most informative of {len(uncached_chunks)} output chunks "
+                     f"for '{command}'")
+
+    chunk_summaries = []
+    skipped_chunks = []
+    for chunk_idx, chunk in enumerate(chunks):
+        if cached_summaries[chunk_idx] is not None:
+            chunk_summaries.append(cached_summaries[chunk_idx])
+            continue
+
+        if chunk_idx not in selected_chunks:
+            skipped_chunks.append(chunk_idx + 1)
+            continue
+
+        logging.debug(f"Summarising command chunk {chunk_idx+1}/{num_chunks} (max chars: "
+                      f"{chunk_summary_max_chars}): {command}")
+        prompt = _summarise_chunk_prompt.format(
+            command=command,
+            chunk_summary_max_chars=chunk_summary_max_chars,
+            chunk_data=chunk,
+            chunk_number=chunk_idx + 1,
+            number_of_chunks=num_chunks)
+
+        chunk_summary = llm.get_llm_response(prompt, prefix=_get_command_context(problem_description))
+        # The placeholder summaries of a dry run must not be reused by later runs
+        if cache and not llm.get_dry_run():
+            _chunk_summary_cache.put(cache_keys[chunk_idx], chunk_summary)
+        record_checkpoint(CHECKPOINT_CHUNK_SUMMARY, cache_keys[chunk_idx], chunk_summary)
+        chunk_summaries.append(chunk_summary)
+
+    if skipped_chunks:
+        chunk_summaries.append(f"{len(skipped_chunks)} of the {num_chunks} chunks of the output were not summarised "
+                               "to stay within the limits for this run. They were ranked as the least informative, "
+                               "as they contain mostly repetitive lines without errors, warnings or unusual values. "
+                               f"Skipped chunks: {_format_chunk_numbers(skipped_chunks)}.")
+
+    return chunk_summaries
+
+
+def _format_chunk_numbers(numbers):
+    """Format a sorted list of numbers as ranges, e.g. [1, 2, 3, 5] as 1-3, 5"""
+
+    ranges = []
+    for n in numbers:
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ", ".join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in ranges)
+
+
+_summarise_command_prompt = """I have executed the command below. I will provide you with the stdout, stderr and exit
+code of the command. I need you to summarise the output of the command, using no more than the number of
+characters given below.
+
+Command: {command}
+Exit code: {exit_code}
+Stderr: {stderr}
+Stdout: {stdout}
+Summary (in {summary_max_chars} or fewer characters):
+"""
+
+
+@profiling.span(profiling.SPAN_COMPACTION)
+def compact_command_result(command_output):
+    """Compact the stdout of a command (see cmdfilter.compact_command_output) and log how many tokens
+    this saved.
+
+    Returns:
+        cmdexec.CommandResult: A copy of command_output with its stdout compacted
+    """
+
+    # The output is read, and compacted, a piece at a time, so that it is never all decoded at once
+    original = command_output.stdout_buffer
+    tokens = sum(llm.get_token_count(text) for text in original.iter_text())
+    stdout = OutputBuffer()
+    compacted_tokens = 0
+    for i, block in enumerate(compact_output_blocks(original.lines())):
+        text = f"\n{block}" if i else block
+        stdout.write(text.encode("utf-8"))
+        compacted_tokens += llm.get_token_count(text)
+    stdout.finish()
+
+    saved = 100 * (tokens - compacted_tokens) / tokens if tokens else 0
+    logging.info(f"Compacted the output of '{command_output.command}' from {tokens} to {compacted_tokens} tokens "
+                 f"({saved:.0f}% saved)")
+    return CommandResult(command_output.command, command_output.exit_code, stdout, command_output.stderr_buffer)
+
+
+@llm.phase(llm.PHASE_COMMAND_SUMMARY)
+def summarise_command(command, command_output, summary_max_chars=None, problem_description=None, compact=True,
+                      local_parsers=True, cache=True):
+    """Use the LLM to summarise the output of a command. If the command is one that we have a local
+    parser for (see cmdparsers) then the summary is computed locally instead, without an LLM call.
 
     Args:
         command (str): The command and its arguments
@@ -262,89 +355,105 @@ def summarise_command(command, command_output, summary_max_chars=None, problem_d
         problem_description (str): Description of the problem the user is investigating using
             the command. If provided then the LLM will be asked to summarise the command output
             with respect to this problem description.
+        compact (bool): If true, collapse repeated and uninformative lines in the command's stdout
+            before it is given to the LLM. See cmdfilter.compact_command_output.
+        local_parsers (bool): If true, summarise the command locally if there is a parser for it.
+        cache (bool): If true, reuse the cached summaries of chunks of the output that were summarised
+            in earlier runs. Only applies to output that is too large to summarise in one call.
 
     Returns:
         (str, str): A tuple of the command and the summary
     """
 
-    prompt_with_problem = """I am a sysadmin. I am logged onto a Linux machine that is experiencing the
-following problem: {problem_description}.
-I have executed the command '{command}' to debug that problem. I will provide you with the stdout,
-stderr and exit code of the command. I need you to summarise the output
-of the command, using a maximum of {summary_max_chars} characters. Your summary must include
-information that is useful in understanding and debugging the problem '{problem_description}'. Your summary
-should also include any information that points to performance, security, reliability, or
-stability issues with the machine or any services running on it.
-If there is no information in the exit code, stderr and stdout of the command that is useful in
-understanding or debugging the problem say "No useful information".
-
-Problem: {problem_description}
-Command: {command}
-Exit code: {exit_code}
-Stderr: {stderr}
-Stdout: {stdout}
-Summary (in {summary_max_chars} or fewer characters):
-"""
+    if local_parsers:
+        summary = summarise_command_locally(command, command_output)
+        if summary:
+            return command, summary
+
+    checkpoint_key = cache_key(problem_description or "", command, command_output.exit_code, command_output.stderr,
+                               command_output.stdout)
+    summary = get_checkpoint(CHECKPOINT_COMMAND_SUMMARY, checkpoint_key)
+    if summary is not None:
+        logging.debug(f"Using the summary of '{command}' from before the run was resumed")
+        return command, summary
+
+    _, summary = _summarise_command_with_llm(command, command_output, summary_max_chars, problem_description, compact,
+                                             cache)
+    record_checkpoint(CHECKPOINT_COMMAND_SUMMARY, checkpoint_key, summary)
+    return command, summary
 
-    prompt_without_problem = """I am a sysadmin. I am logged onto a Linux machine and I have executed the
-command '{command}'. I will provide you with the stdout, stderr and exit code of the command. I need you to
-summarise the output of the command, using a maximum of {summary_max_chars} characters. Your summary should
-give the user an overview of any notable information found in the output of the command. In particular,
-your summary must include any information that points to performance, security, reliability orstability
-issues with the machine or any services running on it.
 
-Command: {command}
-Exit code: {exit_code}
-Stderr: {stderr}
-Stdout: {stdout}
-Summary (in {summary_max_chars} or fewer characters):
-"""
+def _summarise_command_with_llm(command, command_output, summary_max_chars, problem_description, compact, cache):
+    if compact:
+        command_output = compact_command_result(command_output)
 
     summary_tokens = None
     if not summary_max_chars:
-        # If no number is given for the summary size then lets say 10% of the available context length
-        summary_tokens = int(llm.get_model_max_tokens() * .10)
+        # If no number is given for the summary size then use a fraction of the available context length,
+        # 10% unless it has been tuned for the model
+        summary_tokens = int(llm.get_model_max_tokens() * llm.get_summary_fraction())
         summary_max_chars = int(summary_tokens * llm.get_prose_char_token_ratio())
         logging.debug(f"summary_max_characters not specified. Calculated it to be "
                       f"{summary_tokens} tokens, {summary_max_chars} characters.")
 
-    if problem_description:
-        logging.debug(
-            f"Summarising command (max chars: {summary_max_chars}): {command}. Problem:'{problem_description}")
-        prompt = prompt_with_problem.format(
-            problem_description=problem_description,
-            command=command,
-            summary_max_chars=summary_max_chars,
-            exit_code=command_output.exit_code,
-            stderr=command_output.stderr,
-            stdout=command_output.stdout)
-    else:
-        logging.debug(f"Summarising command (max chars: {summary_max_chars}): {command}")
-        prompt = prompt_without_problem.format(
+    context = _get_command_context(problem_description)
+
+    def format_prompt(stdout):
+        return _summarise_command_prompt.format(
             command=command,
             summary_max_chars=summary_max_chars,
             exit_code=command_output.exit_code,
             stderr=command_output.stderr,
-            stdout=command_output.stdout)
+            stdout=stdout)
 
-    # Check if there is room left for a response
-    prompt_tokens = llm.get_token_count(prompt)
-    model_max_tokens = llm.get_model_max_tokens()
     # If summary_max_chars was not provided as an argument then we already know how many tokens
     # we want in the summary, as we calculated it above. If summary_max_chars was provided though,
     # then we need to calculate the token limit from it.
     if not summary_tokens:
         summary_tokens = int(summary_max_chars/llm.get_command_char_token_ratio() + 0.5)
+
+    # If the budget for this run is nearly exhausted then, rather than failing, produce a smaller
+    # summary of as much of the output as we can afford.
+    model_max_tokens = llm.get_model_max_tokens()
+    remaining_tokens = llm.get_budget().remaining_tokens()
+    stdout = command_output.stdout
+    if remaining_tokens is not None and remaining_tokens < model_max_tokens:
+        if summary_tokens > remaining_tokens * .10:
+            summary_tokens = int(remaining_tokens * .10)
+            summary_max_chars = int(summary_tokens * llm.get_prose_char_token_ratio())
+        stdout_tokens = remaining_tokens - summary_tokens - llm.get_token_count(context + format_prompt(""))
+        if stdout_tokens <= 0:
+            raise llm.BudgetExhaustedError(f"{remaining_tokens} tokens left, which is not enough to summarise "
+                                           f"'{command}'")
+        stdout_max_chars = int(stdout_tokens * llm.measure_char_token_ratio(stdout))
+        if len(stdout) > stdout_max_chars:
+            logging.warning(f"Only summarising the first {stdout_max_chars} characters of the output of '{command}' "
+                            "to stay within the run's budget")
+            stdout = stdout[:stdout_max_chars] + "\n[Output truncated]"
+
+    logging.debug(f"Summarising command (max chars: {summary_max_chars}): {command}")
+    prompt = format_prompt(stdout)
+
+    # Check if there is room left for a response
+    prompt_tokens = llm.get_token_count(context + prompt)
     logging.debug(f"Prompt tokens: {prompt_tokens}, model max tokens: {model_max_tokens}"
                   f" summary tokens: {summary_tokens}")
     if prompt_tokens > model_max_tokens - summary_tokens:
         logging.debug("Insufficient room left in context window for summary.")
-        return _summarise_command_chunked(command, command_output, summary_max_chars, problem_description)
-
-    summary = llm.get_llm_response(prompt)
+        # One query to a model with a large enough context window is much faster than summarising the
+        # output in chunks, and then summarising the chunk summaries, so use one if we can
+        large_model = llm.get_large_context_model(prompt_tokens + summary_tokens)
+        if large_model and (remaining_tokens is None or prompt_tokens + summary_tokens <= remaining_tokens):
+            logging.debug(f"Summarising '{command}' with {large_model}, instead of in chunks")
+            with llm.use_model(large_model):
+                return command, llm.get_llm_response(prompt, prefix=context)
+        return _summarise_command_chunked(command, command_output, summary_max_chars, problem_description, cache)
+
+    summary = llm.get_llm_response(prompt, prefix=context)
     return command, summary
 
 
+@llm.phase(llm.PHASE_ANALYSIS)
 def calculate_max_chars_per_command_summary(prompt, example_response, num_commands):
     """Calculate the maximum number of characters (not tokens) that each command summary can use.
 
@@ -356,8 +465,9 @@ def calculate_max_chars_per_command_summary(prompt, example_response, num_comman
 
     prompt_tokens = llm.get_token_count(prompt)
     response_tokens = llm.get_token_count(example_response)
-    # Allow for a bigger response than the example response
-    response_tokens = int(response_tokens * 4)
+    # Allow for a bigger response than the example response, 4 times bigger unless it has been tuned for the
+    # model
+    response_tokens = int(response_tokens * llm.get_response_factor())
 
     # Calculate the number of tokens each command can use by dividing the remaining tokens
     # after we account for the length of the prompt by the number of commands
@@ -432,48 +542,167 @@ Command summaries:
 Response:"""
 
 
-def _get_command_summaries(commands_output, problem_description=None):
-    """Use the LLM to summarise the provided commands. The summarisation queries
-    to the LLM are done in parallel.
+@llm.phase(llm.PHASE_COMMAND_SUMMARY)
+def estimate_summary_cost(command_output):
+    """Estimate the number of tokens, and LLM calls, that summarising command_output with the LLM will use"""
+
+    output_tokens = ((len(command_output.stdout_buffer) + len(command_output.stderr_buffer)) /
+                     llm.get_command_char_token_ratio())
+    model_max_tokens = llm.get_model_max_tokens()
+    # Each call includes the prompt's instructions and the summary. Output that does not fit in a
+    # single call is split into chunks, and the chunk summaries are then summarised.
+    num_calls = 1 if output_tokens < model_max_tokens * .75 else int(output_tokens / (model_max_tokens * .75)) + 2
+    return int(output_tokens + num_calls * model_max_tokens * .25), num_calls
+
+
+@llm.phase(llm.PHASE_COMMAND_SUMMARY)
+def _select_affordable_commands(commands_output, budget, reserve_tokens):
+    """Select the commands that we can afford to summarise within the budget, after setting aside
+    reserve_tokens tokens and one LLM call for the final analysis. Commands are considered in order,
+    so the earlier a command appears in commands_output the higher its priority.
+
+    Returns a tuple of the dict of selected commands and a dict mapping every command to its
+    estimated cost in tokens.
+    """
+
+    costs = {c: estimate_summary_cost(o)[0] for c, o in commands_output.items()}
+    remaining_tokens = budget.remaining_tokens()
+    remaining_calls = budget.remaining_calls()
+    if remaining_tokens is None and remaining_calls is None:
+        return commands_output, costs
+
+    if remaining_tokens is not None:
+        remaining_tokens -= reserve_tokens
+    if remaining_calls is not None:
+        remaining_calls -= 1
+
+    selected = {}
+    for c, o in commands_output.items():
+        # Commands whose output is too large for the remaining budget are summarised in part, so
+        # we only need enough budget for a single full-sized call to select a command.
+        cost = min(costs[c], llm.get_model_max_tokens())
+        if remaining_calls is not None:
+            if remaining_calls < 1:
+                break
+            remaining_calls -= 1
+        if remaining_tokens is not None:
+            if cost > remaining_tokens:
+                continue
+            remaining_tokens -= cost
+        selected[c] = o
+
+    if len(selected) < len(commands_output):
+        logging.warning(f"Skipping {len(commands_output) - len(selected)} commands to stay within the run's budget")
+    return selected, costs
+
+
+def get_max_chars_per_command_summary(problem_description, num_commands):
+    """Calculate the maximum number of characters each summary can use so that the summaries of
+    num_commands commands fit in the prompt of analyse_command_summaries.
     """
 
     if problem_description:
-        max_chars = calculate_max_chars_per_command_summary(
-            analyse_summaries_prompt_with_problem.format(response=example_response,
-                                                         problem=problem_description,
-                                                         command_summaries=""),
-            example_response,
-            len(commands_output))
+        prompt = analyse_summaries_prompt_with_problem.format(response=example_response,
+                                                              problem=problem_description,
+                                                              command_summaries="")
     else:
-        max_chars = calculate_max_chars_per_command_summary(
-            analyse_summaries_prompt_without_problem.format(response=example_response,
-                                                            command_summaries=""),
-            example_response,
-            len(commands_output))
+        prompt = analyse_summaries_prompt_without_problem.format(response=example_response,
+                                                                 command_summaries="")
+    return calculate_max_chars_per_command_summary(prompt, example_response, num_commands)
 
-    logging.debug(f"Asking for a maximum of {max_chars} characters per command summary")
-    logging.info(f"Summarising {len(commands_output)} commands")
 
-    multiproc_args = [(llm.get_config(), c, o, max_chars, problem_description) for c, o in commands_output.items()]
-    with Pool(min(llm.get_max_concurrent_queries(), len(commands_output))) as p:
-        command_summaries = p.starmap(multiproc_wrapper_summarise_command, multiproc_args)
+def get_command_summaries(commands_output, problem_description=None, compact=True, local_parsers=True,
+                          total_commands=None, cache=True):
+    """Use the LLM to summarise the provided commands. The summarisation queries
+    to the LLM are done in parallel. Commands that we have a local parser for are summarised
+    without the LLM.
 
-    return command_summaries
+    Args:
+        commands_output (dict): A dict mapping from commands to CommandResult objects for that command.
+        problem_description (str): The problem description to summarise the commands with respect to.
+        compact (bool): If true, collapse repeated and uninformative lines in each command's output.
+        local_parsers (bool): If true, summarise commands that we have a local parser for without the LLM.
+        total_commands (int): The total number of command summaries that will eventually be given
+            to analyse_command_summaries. Used to size each summary when commands are summarised in
+            several batches. Defaults to the number of commands in commands_output.
+        cache (bool): If true, reuse cached summaries of chunks of large outputs. See summarise_command.
 
+    Returns:
+        list: A list of (command, summary) tuples
+    """
 
-def analyse_command_output(commands_output: dict, problem_description: str = None, print_each_summary: bool = False):
-    """Use the LLM to analyse and summarise the output of one or more commands. The result is
-    streamed to stdout.
+    if not total_commands:
+        total_commands = len(commands_output)
+    order = {c: i for i, c in enumerate(commands_output)}
+
+    command_summaries = []
+    if local_parsers:
+        remaining = {}
+        for c, o in commands_output.items():
+            summary = summarise_command_locally(c, o)
+            if summary:
+                command_summaries.append((c, summary))
+            else:
+                remaining[c] = o
+        logging.info(f"Summarised {len(command_summaries)} commands locally")
+        commands_output = remaining
+
+    if not commands_output:
+        return sorted(command_summaries, key=lambda cs: order[cs[0]])
+
+    # Compact the output here, rather than in the worker processes, so that we can estimate the
+    # cost of summarising each command and send less data to the workers.
+    if compact:
+        commands_output = {c: compact_command_result(o) for c, o in commands_output.items()}
+
+    # If the run has a budget then skip the commands we cannot afford to summarise, keeping enough
+    # back for the final analysis, and give each of the others a share of the budget in proportion
+    # to its expected cost.
+    budget = llm.get_budget()
+    with llm.phase(llm.PHASE_ANALYSIS):
+        reserve_tokens = llm.get_model_max_tokens()
+    commands_output, costs = _select_affordable_commands(commands_output, budget, reserve_tokens)
+    for c in costs.keys() - commands_output.keys():
+        command_summaries.append((c, "Not summarised, to stay within the budget for this run."))
+    if not commands_output:
+        return sorted(command_summaries, key=lambda cs: order[cs[0]])
+    budgets = budget.split([costs[c] for c in commands_output], reserve_tokens=reserve_tokens, reserve_calls=1)
+
+    max_chars = get_max_chars_per_command_summary(problem_description, total_commands)
+    logging.debug(f"Asking for a maximum of {max_chars} characters per command summary")
+    logging.info(f"Summarising {len(commands_output)} commands")
+
+    latency_stats = llm.get_latency_stats()
+    settings = worker_settings()
+    multiproc_args = [(llm.get_config(), b, latency_stats.for_worker(), settings, c, o, max_chars,
+                       problem_description, False, False, cache)
+                      for (c, o), b in zip(commands_output.items(), budgets)]
+    with profiling.span(profiling.SPAN_POOL_STARTUP):
+        pool = Pool(min(llm.get_max_concurrent_queries(), len(commands_output)))
+    with pool as p:
+        for summary, used, prompt_stats, worker_latency_stats, profile in p.starmap(
+                multiproc_wrapper_summarise_command, multiproc_args):
+            command_summaries.append(summary)
+            budget.merge(used)
+            llm.get_prompt_stats().merge(prompt_stats)
+            latency_stats.merge(worker_latency_stats)
+            profiling.merge(profile)
+
+    return sorted(command_summaries, key=lambda cs: order[cs[0]])
+
+
+@llm.phase(llm.PHASE_ANALYSIS)
+def analyse_command_summaries(command_summaries: list, problem_description: str = None,
+                              print_each_summary: bool = False):
+    """Use the LLM to analyse a set of command summaries, as produced by get_command_summaries.
+    The result is streamed to stdout.
 
     Args:
-        commands_output: A dict mapping from commands to CommandResult objects for that command.
+        command_summaries: A list of (command, summary) tuples.
         problem_description: The problem description to analyse the commands with respect to.
         print_each_summary: If true, then print each command summary.
     """
 
-    # Summarise the output of each of the commands
-    command_summaries = _get_command_summaries(commands_output, problem_description)
-
     # Build a string of the command summaries for inclusion in the prompt
     cs_str_builder = []
     for cs in command_summaries:
@@ -482,16 +711,45 @@ def analyse_command_output(commands_output: dict, problem_description: str = Non
         cs_str_builder.append(f"Summary for '{command}': {summary}")
     cs_str = "\n".join(cs_str_builder)
 
-    if print_each_summary:
+    def print_summaries():
         print("# Command Summaries")
         for c, s in command_summaries:
             print(f"## Summary for '{c}'")
             print(s)
 
+    if print_each_summary:
+        print_summaries()
+
     # Ask the LLM to analyse the combination of the summaries and produce recommendations
-    if problem_description:
-        llm.print_streamed_llm_response(analyse_summaries_prompt_with_problem.format(
-            response=example_response, problem=problem_description, command_summaries=cs_str))
-    else:
-        llm.print_streamed_llm_response(analyse_summaries_prompt_without_problem.format(
-            response=example_response, command_summaries=cs_str))
+    try:
+        if problem_description:
+            llm.print_streamed_llm_response(analyse_summaries_prompt_with_problem.format(
+                response=example_response, problem=problem_description, command_summaries=cs_str))
+        else:
+            llm.print_streamed_llm_response(analyse_summaries_prompt_without_problem.format(
+                response=example_response, command_summaries=cs_str))
+    except llm.BudgetExhaustedError as e:
+        # The summaries are still useful by themselves, so give the user those instead
+        logging.error(f"Unable to produce the final analysis, as the run's budget was exhausted: {e}")
+        if not print_each_summary:
+            print_summaries()
+
+
+def analyse_command_output(commands_output: dict, problem_description: str = None, print_each_summary: bool = False,
+                           compact: bool = True, local_parsers: bool = True, cache: bool = True):
+    """Use the LLM to analyse and summarise the output of one or more commands. The result is
+    streamed to stdout.
+
+    Args:
+        commands_output: A dict mapping from commands to CommandResult objects for that command.
+        problem_description: The problem description to analyse the commands with respect to.
+        print_each_summary: If true, then print each command summary.
+        compact: If true, collapse repeated and uninformative lines in each command's output before
+            it is summarised.
+        local_parsers: If true, summarise commands that we have a local parser for without the LLM.
+        cache: If true, reuse cached summaries of chunks of large outputs. See summarise_command.
+    """
+
+    command_summaries = get_command_summaries(commands_output, problem_description, compact, local_parsers,
+                                              cache=cache)
+    analyse_command_summaries(command_summaries, problem_description, print_each_summary)
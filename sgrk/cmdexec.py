@@ -15,36 +15,341 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import logging
+import os
+import re
+import select
+import shlex
+import time
+import zlib
 
 import fabric
+import fabric.runners
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from sgrk import profiling
+from sgrk.archive import get_run_archive, open_run
+from sgrk.outputbuf import OutputBuffer
 
 
-@dataclass
 class CommandResult:
-    """Contains the result of executing a command, including its exit code, stdout and stderr"""
+    """Contains the result of executing a command, including its exit code, stdout and stderr.
+
+    stdout and stderr are kept in OutputBuffers, which hold large output compressed, or in a temporary
+    file, and are decoded each time they are accessed. Code that uses them more than once should keep
+    the decoded string for as long as it needs it, rather than accessing them repeatedly.
+    """
+
+    def __init__(self, command, exit_code, stdout, stderr):
+        self.command = command
+        self.exit_code = exit_code
+        self.stdout_buffer = OutputBuffer.of(stdout)
+        self.stderr_buffer = OutputBuffer.of(stderr)
+
+    @property
+    def stdout(self):
+        return self.stdout_buffer.text()
+
+    @property
+    def stderr(self):
+        return self.stderr_buffer.text()
+
+    def to_dict(self):
+        """Returns the result as a dict, e.g. to store it as JSON. CommandResult(**d) recreates it."""
+
+        return {"command": self.command, "exit_code": self.exit_code, "stdout": self.stdout, "stderr": self.stderr}
+
+    def __repr__(self):
+        return (f"CommandResult(command={self.command!r}, exit_code={self.exit_code}, stdout={self.stdout_buffer!r}, "
+                f"stderr={self.stderr_buffer!r})")
+
+
+# Programs whose output is a log, which can be filtered by pattern and line count. Files read by
+# _file_readers are treated as logs if they are under /var/log or their name contains "log".
+_log_programs = ("journalctl", "dmesg", "docker logs", "podman logs", "kubectl logs")
+# The options that programs which output a log take a time window with, each with its short forms. docker,
+# podman and kubectl logs are not given the time window, as they do not take times in the same format.
+_time_window_options = {
+    "journalctl": (("--since", "-S"), ("--until", "-U")),
+    "dmesg": (("--since",), ("--until",)),
+}
+# Only some versions of these programs take a time window (dmesg only from util-linux 2.37), so whether the
+# one on the host does is checked, by looking for the option in its help, when the command is run
+_probe_time_window_programs = ("dmesg",)
+_file_readers = ("cat", "zcat", "tail", "head", "less", "grep", "zgrep")
+# Files under /var/log, the volatile journal in /run/log, and files named like a log or a rotated log, e.g.
+# app.log.1 or app.log.2.gz. Other files with "log" in their path, e.g. /etc/logrotate.conf, are not logs.
+_log_file_re = re.compile(r"^/var/log/|^/run/log/|\.log(\.\d+)?(\.gz)?$")
+# The options that limit the number of lines programs which output a log output. journalctl's -e implies -n.
+_line_limit_options = {
+    "journalctl": re.compile(r"^(-n\d*|--lines(=.*)?|-e)$"),
+    "docker logs": re.compile(r"^(-n\d*|--tail(=.*)?)$"),
+    "podman logs": re.compile(r"^(-n\d*|--tail(=.*)?)$"),
+    "kubectl logs": re.compile(r"^--tail(=.*)?$"),
+}
+# Commands with any of these are not rewritten, as we could not be sure of where to add the filters
+_unsafe_to_rewrite_re = re.compile(r";|&&|\|\||\$\(|`|>|<")
+
+
+def _split_first_segment(command):
+    """Split a command into its first pipeline segment and the rest of the pipeline (including the |)"""
+
+    quote = None
+    for i, c in enumerate(command):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "|":
+            return command[:i].rstrip(), " " + command[i:]
+    return command, ""
+
+
+def _split_last_segment(command):
+    first, rest = _split_first_segment(command)
+    while rest:
+        first, rest = _split_first_segment(rest.lstrip(" |"))
+    return first
+
+
+def _program(argv):
+    """Returns the program run by argv, ignoring sudo and environment variable assignments, along with its
+    sub-command for programs like docker, and the program's arguments
+    """
+
+    while argv and (argv[0] == "sudo" or "=" in argv[0]):
+        argv = argv[1:]
+    if not argv:
+        return None, []
+    program = os.path.basename(argv[0])
+    if program in ("docker", "podman", "kubectl") and len(argv) > 1:
+        return f"{program} {argv[1]}", argv[2:]
+    return program, argv[1:]
+
+
+@dataclass
+class CommandFilters:
+    """Filters that are pushed down into the commands executed on the remote host, so that only the part
+    of their output that is of interest is sent back to us, and on to the LLM.
+
+    since and until are a time window, in any format journalctl accepts, e.g. "2024-05-01 13:00" or "-2h".
+    They are added as options to the commands that support them (journalctl, and dmesg if the version on the
+    host takes them, which is checked when the command is run). grep is a list of
+    extended regular expressions, and only the lines of a log that match at least one of them are kept. The
+    log is filtered with grep before it is passed to the rest of the command's pipeline, if it has one. If
+    tail is set then only the last tail lines of the output are kept, unless the command already limits them.
+    """
+
+    since: str = None
+    until: str = None
+    grep: list = field(default_factory=list)
+    tail: int = None
+
+    def __bool__(self):
+        return bool(self.since or self.until or self.grep or self.tail)
+
+    def rewrite(self, command):
+        """Returns the command with the filters added to it. Commands that do not output a log, and those
+        that are too complex to rewrite safely, are returned unchanged.
+        """
+
+        if _unsafe_to_rewrite_re.search(command):
+            return command
+
+        first, rest = _split_first_segment(command)
+        try:
+            program, args = _program(shlex.split(first))
+        except ValueError:
+            return command
+
+        is_log = program in _log_programs or \
+            (program in _file_readers and any(_log_file_re.search(a) for a in args if not a.startswith("-")))
+        if not is_log:
+            return command
+
+        if program in _time_window_options:
+            unfiltered = first
+            for value, options in zip((self.since, self.until), _time_window_options[program]):
+                if value and not any(a.startswith(option) for a in args for option in options):
+                    first += f" {options[0]} {shlex.quote(value)}"
+            if first != unfiltered and program in _probe_time_window_programs:
+                first = f"if {program} --help 2>&1 | grep -q -e --since; then {first}; else {unfiltered}; fi"
+
+        if self.grep:
+            patterns = " ".join(f"-e {shlex.quote(p)}" for p in self.grep)
+            # grep exits with 1 if nothing matched, which is not an error here
+            rest = f" | {{ grep -E {patterns} || test $? -eq 1; }}{rest}"
+
+        last_program, _ = _program(shlex.split(_split_last_segment(command))) if rest else (program, args)
+        has_line_limit = last_program in ("tail", "head") or \
+            (program in _line_limit_options and any(_line_limit_options[program].match(a) for a in args))
+        if self.tail and not has_line_limit:
+            rest += f" | tail -n {self.tail}"
+
+        rewritten = f"{first}{rest}"
+        if rewritten != command:
+            logging.debug(f"Rewrote '{command}' as '{rewritten}'")
+        return rewritten
+
 
-    command: str
-    exit_code: int
-    stdout: str
-    stderr: str
+def add_filter_arguments(parser):
+    """Add the command line arguments for CommandFilters to parser"""
 
+    parser.add_argument("--since",
+                        help="""Only fetch log entries from after this time, e.g. '2024-05-01 13:00' or '-2h'. Added to
+                        the journalctl and dmesg commands that are executed.""")
+    parser.add_argument("--until", help="Only fetch log entries from before this time. See --since.")
+    parser.add_argument("--grep", action="append", default=[], metavar="PATTERN",
+                        help="""Only fetch the lines of logs that match this extended regular expression. May be given
+                        more than once, to fetch the lines that match any of them.""")
+    parser.add_argument("--tail", type=int, metavar="LINES", help="Only fetch the last LINES lines of logs")
 
-def execute_commands_remote(host: str, commands: list) -> dict:
+
+def filters_from_args(args):
+    return CommandFilters(args.since, args.until, args.grep, args.tail)
+
+
+# If set, the output of commands is compressed on the remote host before it is sent to us. See _run_compressed.
+_compress_output = False
+
+
+def set_compress_output(c):
+    global _compress_output
+    logging.debug(f"Setting compress output to {c}")
+    _compress_output = c
+
+
+def get_compress_output():
+    return _compress_output
+
+
+# The remote side of a compressed command. The first byte of stdout says how the rest of it is compressed:
+# z for zstd, g for gzip, or n if neither is installed and it is not compressed at all. As the exit code of
+# the pipeline is that of the compressor, the exit code of the command is written to the end of stderr.
+# The command itself is run with bash, as conn.run would usually run it (the commands the LLM suggests may
+# use bash syntax), and only with sh if bash is not installed.
+_compress_script = """if {try_zstd} command -v zstd >/dev/null 2>&1; then printf z; c="zstd -q -1 -c";
+elif command -v gzip >/dev/null 2>&1; then printf g; c="gzip -1 -c"; else printf n; c=cat; fi
+if command -v bash >/dev/null 2>&1; then s=bash; else s=sh; fi
+( $s -c {command}; echo "{exit_marker}$?" >&2) | $c"""
+_exit_marker = "sgrk-exit-code:"
+_READ_SIZE = 65536
+
+
+def _decompressor(method):
+    """Returns a function that decompresses the next piece of a stream compressed with method"""
+
+    if method == b"z":
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    if method == b"g":
+        # wbits of 16 + MAX_WBITS means a gzip header and trailer are expected
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if method == b"n":
+        return lambda data: data
+    raise ValueError(f"Unexpected compression method {method}")
+
+
+def _run_compressed(conn, command, timeout):
+    """Run command on the host conn is connected to, with its stdout compressed on the host and decompressed
+    here as it arrives. This is much faster than conn.run for large outputs over slow links. zstd is used if
+    it is installed on the host and the zstandard module is installed here, then gzip, and the output is
+    sent uncompressed if neither is available on the host.
+
+    Returns:
+        fabric.runners.Result: The result, as conn.run would return it, except that its stdout is an
+            OutputBuffer, so that it is never held in memory in full.
+
+    Raises:
+        TimeoutError: If the command does not complete within timeout seconds
+    """
+
+    script = _compress_script.format(command=shlex.quote(command), exit_marker=_exit_marker,
+                                     try_zstd="" if zstandard else "false &&")
+    conn.open()
+    channel = conn.client.get_transport().open_session()
+    channel.exec_command(f"sh -c {shlex.quote(script)}")
+
+    deadline = time.time() + timeout
+    decompress = None
+    stdout = OutputBuffer()
+    stderr = []
+    compressed_bytes = 0
+    try:
+        while True:
+            if time.time() > deadline:
+                raise TimeoutError(f"'{command}' did not complete within {timeout}s")
+            select.select([channel], [], [], min(1, timeout))
+
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(_READ_SIZE))
+            data = channel.recv(_READ_SIZE) if channel.recv_ready() else b""
+            if data:
+                compressed_bytes += len(data)
+                if decompress is None:
+                    decompress = _decompressor(data[:1])
+                    data = data[1:]
+                stdout.write(decompress(data))
+            elif channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+        exit_status = channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    stdout.finish()
+    stderr, _, exit_code = b"".join(stderr).decode("utf-8", errors="replace").rpartition(_exit_marker)
+    if not exit_code.strip().isdigit():
+        # The command did not complete, e.g. it was killed, so its exit code was not written
+        return fabric.runners.Result(connection=conn, command=command, stdout=stdout, stderr=stderr + exit_code,
+                                     exited=exit_status or -1)
+    logging.debug(f"Received {compressed_bytes} bytes for {len(stdout)} bytes of output from '{command}'")
+    return fabric.runners.Result(connection=conn, command=command, stdout=stdout, stderr=stderr,
+                                 exited=int(exit_code))
+
+
+def execute_commands_remote(host: str, commands: list, deadline: float = None, on_result=None,
+                            filters: CommandFilters = None) -> dict:
     """Executes the provided commands on the specified host.
 
     Args:
         host: The host to connect to. Must be defined in the ssh .config file for the system.
         commands: A list of commands and their arguments.
+        deadline: Optional time, as returned by time.time(), after which no more commands are started.
+        on_result: Optional function that is called with each CommandResult as soon as it is available.
+        filters: Optional filters to push down into the commands. The commands are rewritten to include
+            them, and the results are for the rewritten commands. See CommandFilters.
 
     Returns:
         command output: A dictionary mapping commands to CommandResults.
     """
 
     res = {}
+    run_archive = get_run_archive()
+    compress = get_compress_output()
     with fabric.Connection(host) as conn:
         for command in commands:
+            if filters:
+                command = filters.rewrite(command)
+
+            # If the run is being resumed then commands that completed before it stopped are not run again
+            resumed = run_archive.get_resumed_command_result(command) if run_archive else None
+            if resumed:
+                logging.info(f"Using the output of '{command}' from before the run was resumed")
+                res[command] = CommandResult(**resumed)
+                if on_result:
+                    on_result(res[command])
+                continue
+
+            if deadline is not None and time.time() >= deadline:
+                logging.warning(f"Time limit reached. Not executing '{command}' or any later commands.")
+                break
+
+            started = time.time()
             tries = 0
             success = False
             while not success and tries < 3:
@@ -52,20 +357,60 @@ def execute_commands_remote(host: str, commands: list) -> dict:
                 logging.debug(f"Executing '{command}' on {host}")
 
                 try:
-                    e = conn.run(command, hide=True, timeout=20, warn=True)
-                    if e.ok:
-                        logging.debug(f"stdout from {command}: {e.stdout}")
+                    if compress:
+                        try:
+                            e = _run_compressed(conn, command, timeout=20)
+                        except TimeoutError:
+                            raise
+                        except (OSError, ValueError, zlib.error) as error:
+                            # Use plain conn.run for the rest of the commands, as it is likely to fail again
+                            logging.warning(f"Failed to fetch the compressed output of '{command}' from {host}. "
+                                            f"Not compressing output from now on. Error: {error}")
+                            compress = False
+                            e = conn.run(command, hide=True, timeout=20, warn=True)
                     else:
-                        logging.error(f"Failed to execute '{command}' on {host}. Non-zero exit code: {e.return_code}.")
-                        logging.debug(f"stdout: {e.stdout}")
-                        logging.debug(f"stderr: {e.stderr}")
-
+                        e = conn.run(command, hide=True, timeout=20, warn=True)
                     res[command] = CommandResult(command, e.return_code, e.stdout, e.stderr)
+                    # Drop the result, so that its copy of the output can be freed
+                    e = None
+                    if res[command].exit_code != 0:
+                        logging.error(f"Failed to execute '{command}' on {host}. Non-zero exit code: "
+                                      f"{res[command].exit_code}.")
+                    # Only decode the output to log it if it will be logged, as it may be very large. This is the
+                    # only place where all of the output is decoded at once when it is not sent to the LLM whole.
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        logging.debug(f"stdout from {command}: {res[command].stdout}")
+                        logging.debug(f"stderr from {command}: {res[command].stderr}")
+
                     success = True
+                    if run_archive:
+                        run_archive.record_command_result(res[command])
                 except Exception as e:
                     logging.error(f"Failed to execute '{command}' on {host}. Exception: {e}")
+            # The first command's time includes connecting to the host
+            profiling.record_span(profiling.SPAN_COLLECTION, time.time() - started, command)
 
             if not success:
                 logging.error(f"Failed to execute '{command}' on {host}")
+            elif on_result:
+                on_result(res[command])
 
-    return res
\ No newline at end of file
+    return res
+
+
+def load_commands_archived(run: str) -> dict:
+    """Loads the command results recorded in an archived run, instead of executing the commands again.
+
+    Args:
+        run: The archived run. See archive.open_run.
+
+    Returns:
+        command output: A dictionary mapping commands to CommandResults, in the order they were executed.
+    """
+
+    run_archive = open_run(run)
+    logging.info(f"Replaying the command output recorded in run {run_archive.id}")
+    res = {}
+    for r in run_archive.command_results():
+        res[r["command"]] = CommandResult(**r)
+    return res
@@ -0,0 +1,498 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import math
+import re
+import statistics
+
+# Tokens which look like hex identifiers (addresses, hashes, container IDs) or runs of digits
+# (timestamps, PIDs, counters) are the parts of a line that usually vary between otherwise
+# identical log lines. Masking them gives us the line's template.
+_hex_re = re.compile(r"\b(?:0x)?[0-9a-fA-F]{8,}\b")
+_digits_re = re.compile(r"\d+")
+_number_re = re.compile(r"^[-+]?\d+(?:\.\d+)?$")
+_numeric_token_re = re.compile(r"^[-+]?\d+(?:[.:]\d+)*%?,?$")
+_zero_token_re = re.compile(r"^[-+]?0+(?:[.:]0+)*%?,?$")
+_separator_line_re = re.compile(r"^[\s\-=+*_|~]*$")
+
+# A row is considered mostly zero if at least this fraction of its numeric fields are zero
+_ZERO_ROW_FRACTION = 2 / 3
+# Rows need at least this many numeric fields before we consider dropping them
+_ZERO_ROW_MIN_NUMBERS = 4
+# We only drop mostly zero rows if there are at least this many of them with the same shape. A single
+# zero row (e.g. "MiB Swap: 0.0 total, 0.0 free") is usually informative, hundreds of them are not.
+_ZERO_ROW_MIN_GROUP = 3
+# Timestamps, e.g. 12:03:45, 2024-05-01T12:03:45.123Z, or the uptime in dmesg output (12345.678901]), which
+# are the only fields that may differ between lines that are collapsed together
+_timestamp_re = re.compile(r"^\[?(?:\d+[-/:T]\d+(?:[-/:T.,]\d+)*(?:Z|[+-]\d\d:?\d\d)?|\d+\.\d+\])\]?,?$")
+# Words that mark a line as reporting a problem, and the weight each such line adds to the score of the chunk
+# it is in when ranking chunks of output (see score_chunks)
+_error_re = re.compile(r"\b(?:error|errors|fail|failed|failure|fatal|panic|oom|out of memory|killed|segfault|"
+                       r"critical|crit|emerg|alert|corrupt|exception|traceback|denied|unreachable|timed? ?out|"
+                       r"hung|blocked for more than)\b", re.IGNORECASE)
+_warning_re = re.compile(r"\b(?:warn|warning|retry|retrying|degraded|throttl\w*|dropped|reset|slow|refused)\b",
+                         re.IGNORECASE)
+_ERROR_WEIGHT = 8
+_WARNING_WEIGHT = 3
+# A numeric field is an outlier if it is more than this many median absolute deviations from the median of
+# the values in the same field of lines with the same template. There must be at least _MIN_OUTLIER_SAMPLES
+# values for the comparison to be meaningful.
+_OUTLIER_MADS = 5
+_MIN_OUTLIER_SAMPLES = 10
+_OUTLIER_WEIGHT = 4
+# Tables are runs of at least _MIN_TABLE_ROWS rows, after the header, of at least _MIN_TABLE_COLUMNS
+# whitespace separated fields, most of which are padded to align their columns. A column is aligned if
+# at least _ALIGNED_FRACTION of its cells start, or end, at the same position.
+_MIN_TABLE_ROWS = 3
+_MIN_TABLE_COLUMNS = 3
+_ALIGNED_FRACTION = .8
+_padding_re = re.compile(r"\S {2,}\S|^ {2,}\S")
+_field_re = re.compile(r"\S+")
+# Rows that were collapsed by compaction are not aligned with the rest of the table, and are not considered
+# when checking that it is aligned
+_collapsed_re = re.compile(r"\[\d+ similar lines\]$")
+# Lines added by compaction, e.g. "[12 rows with all or mostly zero values omitted ...]", which are kept in
+# place rather than ending the table they are in
+_note_re = re.compile(r"^\[.*\]$")
+# Table cells are separated by the first of these that does not appear anywhere in the table
+_TABLE_DELIMITERS = ("|", ";", "\t")
+# Decimal values in tables are rounded to this many places, and trailing zeros are dropped
+_float_re = re.compile(r"^[-+]?\d+\.\d+$")
+_MAX_DECIMALS = 2
+# Output is compacted in blocks of this many lines, each independently of the others. Appending lines to
+# the output, as happens when a log is read again later, then only changes the compacted form of the last
+# block, so the chunks that the compacted output is split into for summarisation mostly stay the same.
+_BLOCK_LINES = 1000
+
+
+def _line_template(tokens):
+    return tuple(_digits_re.sub("0", _hex_re.sub("<hex>", t)) for t in tokens)
+
+
+def _is_mostly_zero(tokens):
+    numbers = [t for t in tokens if _numeric_token_re.match(t)]
+    if len(numbers) < _ZERO_ROW_MIN_NUMBERS:
+        return False
+
+    zeros = sum(1 for t in numbers if _zero_token_re.match(t))
+    return zeros / len(numbers) >= _ZERO_ROW_FRACTION
+
+
+def _run_key(tokens):
+    """Returns what consecutive lines must have in common to be collapsed into one: every field apart
+    from timestamps. Other numbers, such as PIDs and CPU usage, must be the same, as which line they are
+    on matters.
+    """
+
+    return tuple("<timestamp>" if _timestamp_re.match(t) else t for t in tokens)
+
+
+class _LineRun:
+    """A run of consecutive lines that differ only in their timestamps. The first and last values of
+    each timestamp are kept.
+    """
+
+    def __init__(self, line, tokens):
+        self.first_line = line
+        self.first = tokens
+        self.last = tokens
+        self.count = 1
+
+    def add(self, tokens):
+        self.count += 1
+        self.last = tokens
+
+    def render(self):
+        if self.count == 1:
+            return self.first_line
+
+        rendered = [first if first == last else f"{{{first}..{last}}}" for first, last in zip(self.first, self.last)]
+        return f"{' '.join(rendered)} [{self.count} similar lines]"
+
+
+def _compact_lines(lines):
+    """Compact a block of lines. See compact_command_output."""
+
+    zero_rows = {}
+    for line in lines:
+        tokens = line.split()
+        if _is_mostly_zero(tokens):
+            zero_rows.setdefault(len(tokens), []).append(line)
+    dropped_shapes = {k for k, v in zero_rows.items() if len(v) >= _ZERO_ROW_MIN_GROUP}
+
+    compacted = []
+    run = None
+    run_key = None
+    dropped_emitted = set()
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) in dropped_shapes and _is_mostly_zero(tokens):
+            if len(tokens) not in dropped_emitted:
+                dropped_emitted.add(len(tokens))
+                rows = zero_rows[len(tokens)]
+                if run is not None:
+                    compacted.append(run.render())
+                    run = None
+                compacted.append(f"[{len(rows)} rows with all or mostly zero values omitted, e.g.: {rows[0].strip()}]")
+            continue
+
+        key = _run_key(tokens)
+        if run is not None and key == run_key:
+            run.add(tokens)
+            continue
+        if run is not None:
+            compacted.append(run.render())
+        run, run_key = _LineRun(line, tokens), key
+
+    if run is not None:
+        compacted.append(run.render())
+    return "\n".join(compacted)
+
+
+def _round_decimal(cell):
+    if not _float_re.match(cell):
+        return cell
+    return f"{round(float(cell), _MAX_DECIMALS):.{_MAX_DECIMALS}f}".rstrip("0").rstrip(".")
+
+
+def _encode_table(lines, num_columns):
+    """Encode the lines of a table. See encode_tables."""
+
+    delimiter = next((d for d in _TABLE_DELIMITERS if not any(d in line for line in lines)), None)
+    if delimiter is None:
+        return lines
+
+    rows = [None if _note_re.match(line.strip()) else line.split(None, num_columns - 1) for line in lines]
+    header = None
+    if not any(_number_re.match(c) for c in rows[0]) and any(_number_re.match(c) for c in rows[1] or []):
+        header, rows = rows[0], rows[1:]
+
+    data_rows = [r for r in rows if r is not None]
+    constant = [i for i in range(num_columns - 1) if len({r[i] for r in data_rows}) == 1]
+    encoded = []
+    if constant:
+        names = [header[i] if header else f"column {i + 1}" for i in constant]
+        values = ", ".join(f"{name}={data_rows[0][i]}" for name, i in zip(names, constant))
+        encoded.append(f"[Same in every row: {values}]")
+    keep = [i for i in range(num_columns) if i not in constant]
+
+    if header:
+        encoded.append(delimiter.join(header[i] for i in keep))
+    for line, row in zip(lines[len(lines) - len(rows):], rows):
+        if row is None:
+            encoded.append(line.strip())
+        else:
+            encoded.append(delimiter.join(_round_decimal(row[i].strip()) for i in keep))
+    return encoded
+
+
+def _table_columns(lines, start):
+    """Returns the number of columns of the table that starts at lines[start], and the index of the line
+    after its end, or None for the number of columns if there is no table there.
+    """
+
+    if _note_re.match(lines[start].strip()):
+        return None, start + 1
+    # The header, or first row, of a table is padded to align it with the rest. Checking this first saves
+    # scanning ahead from every line of output that is not in a table, e.g. logs, and stops an unpadded line
+    # before a table, such as a title, from being taken as its header.
+    if not _padding_re.search(lines[start]):
+        return None, start + 1
+
+    num_columns = len(lines[start].split())
+    end = start + 1
+    rows = 0
+    while end < len(lines):
+        if _note_re.match(lines[end].strip()):
+            end += 1
+            continue
+        if len(lines[end].split()) < num_columns:
+            break
+        rows += 1
+        end += 1
+
+    table = [line for line in lines[start:end] if not _note_re.match(line.strip()) and not _collapsed_re.search(line)]
+    if num_columns < _MIN_TABLE_COLUMNS or rows < _MIN_TABLE_ROWS or len(table) < 2 or \
+            sum(1 for line in table if _padding_re.search(line)) * 2 < len(table) or \
+            not _columns_aligned(table, num_columns):
+        return None, start + 1
+    return num_columns, end
+
+
+def _columns_aligned(table, num_columns):
+    fields = [list(_field_re.finditer(line))[:num_columns - 1] for line in table]
+    for column in range(num_columns - 1):
+        for position in (lambda m: m.start(), lambda m: m.end()):
+            counts = {}
+            for row in fields:
+                p = position(row[column])
+                counts[p] = counts.get(p, 0) + 1
+            if max(counts.values()) >= _ALIGNED_FRACTION * len(table):
+                break
+        else:
+            return False
+    return True
+
+
+def encode_tables(output):
+    """Re-encode whitespace aligned tables, such as the output of top, ps, iostat and df, in a form
+    that uses fewer tokens. Within each table:
+
+    1. The padding that aligns the columns is removed, and the cells are separated by a delimiter.
+    2. Columns that have the same value in every row are replaced with a single line before the
+       table that gives their value.
+    3. Decimal values are rounded to _MAX_DECIMALS places, and trailing zeros are dropped.
+
+    A table is a header, or a first row, followed by at least _MIN_TABLE_ROWS rows with at least as many
+    fields. Extra fields, e.g. the arguments of a command in `ps aux`, are kept in the last column. Other
+    lines are unchanged.
+
+    Args:
+        output (str): The stdout of a command, or part of it
+
+    Returns:
+        str: The output, with its tables re-encoded
+    """
+
+    lines = output.splitlines()
+    encoded = []
+    i = 0
+    while i < len(lines):
+        num_columns, end = _table_columns(lines, i)
+        if num_columns is None:
+            encoded.append(lines[i])
+        else:
+            encoded.extend(_encode_table(lines[i:end], num_columns))
+        i = end
+
+    return "\n".join(encoded)
+
+
+def compact_command_output(output):
+    """Shrink the output of a command before it is given to the LLM. This is done by:
+
+    1. Dropping blank lines and lines that are purely separators (e.g. "-----").
+    2. Dropping rows in which most numeric fields are zero, if there are many of them with the same
+       shape (e.g. idle kernel threads in `top` or `ps`, idle devices in `iostat`). A single line
+       noting how many rows were dropped, with an example, is kept in their place.
+    3. Collapsing runs of consecutive lines which differ only in their timestamps (e.g. a repeated log
+       message) into a single line that records the number of lines it represents and the first and
+       last timestamps. Lines that differ in any other field, e.g. the rows of a table, are kept.
+    4. Re-encoding tables in a more compact form. See encode_tables.
+
+    Lines are kept in their original order. Each block of _BLOCK_LINES lines is compacted separately.
+
+    Args:
+        output (str): The stdout of a command
+
+    Returns:
+        str: The compacted output
+    """
+
+    compacted = "\n".join(compact_output_blocks(output.splitlines()))
+    logging.debug(f"Compacted command output from {len(output)} characters to {len(compacted)} characters "
+                  f"({len(compacted.splitlines())} lines)")
+    return compacted
+
+
+def compact_output_blocks(lines):
+    """Compact output given as an iterable of lines, e.g. outputbuf.OutputBuffer.lines, and yield each block
+    of compacted lines, joined by line breaks, as soon as it is compacted. This allows output that is too
+    large to hold in memory to be compacted. See compact_command_output.
+    """
+
+    block = []
+    for line in lines:
+        if _separator_line_re.match(line):
+            continue
+        block.append(line)
+        if len(block) == _BLOCK_LINES:
+            yield encode_tables(_compact_lines(block))
+            block = []
+    if block:
+        yield encode_tables(_compact_lines(block))
+
+
+def _numeric_fields(tokens):
+    return [(i, float(t)) for i, t in enumerate(tokens) if _number_re.match(t)]
+
+
+def score_chunks(chunks):
+    """Score each chunk of a command's output by how likely it is to contain the information that is
+    useful when debugging a problem, so that when there are too many chunks to summarise all of them the
+    least useful can be skipped. A chunk scores highly if it contains:
+
+    1. Rare lines. Each line template (see _line_template) contributes its information content,
+       log2(total lines / lines with the template), shared between the chunks it appears in. Chunks made
+       up of the same few templates as the rest of the output score little.
+    2. Lines that mention errors or warnings. Each distinct template of such lines adds a fixed weight.
+    3. Numeric outliers, e.g. a latency or queue length far larger than in the other lines of the
+       same template. Each line with an outlier adds a fixed weight.
+
+    Args:
+        chunks (list): The chunks of the output, as strings
+
+    Returns:
+        list: The score of each chunk, as floats
+    """
+
+    chunk_lines = [[line.split() for line in chunk.splitlines() if line.strip()] for chunk in chunks]
+    chunk_templates = [[_line_template(tokens) for tokens in lines] for lines in chunk_lines]
+
+    template_counts = {}
+    template_chunks = {}
+    field_values = {}
+    for chunk_idx, (lines, templates) in enumerate(zip(chunk_lines, chunk_templates)):
+        for tokens, template in zip(lines, templates):
+            template_counts[template] = template_counts.get(template, 0) + 1
+            template_chunks.setdefault(template, set()).add(chunk_idx)
+            for i, v in _numeric_fields(tokens):
+                field_values.setdefault((template, i), []).append(v)
+
+    # The median and median absolute deviation of each numeric field of each template
+    field_stats = {}
+    for key, values in field_values.items():
+        if len(values) < _MIN_OUTLIER_SAMPLES:
+            continue
+        median = statistics.median(values)
+        mad = statistics.median(abs(v - median) for v in values)
+        if mad > 0:
+            field_stats[key] = (median, mad)
+
+    total_lines = max(sum(template_counts.values()), 1)
+    scores = []
+    for lines, templates in zip(chunk_lines, chunk_templates):
+        score = 0
+        for template in set(templates):
+            information = math.log2(total_lines / template_counts[template])
+            score += information / len(template_chunks[template])
+            line = " ".join(template)
+            if _error_re.search(line):
+                score += _ERROR_WEIGHT
+            elif _warning_re.search(line):
+                score += _WARNING_WEIGHT
+
+        for tokens, template in zip(lines, templates):
+            for i, v in _numeric_fields(tokens):
+                stats = field_stats.get((template, i))
+                if stats and abs(v - stats[0]) > _OUTLIER_MADS * stats[1]:
+                    score += _OUTLIER_WEIGHT
+                    break
+
+        scores.append(score)
+
+    logging.debug(f"Chunk scores: {', '.join(f'{s:.1f}' for s in scores)}")
+    return scores
+
+
+# A numeric field has changed meaningfully from the baseline if the difference is more than this fraction
+# of the larger of the two values, and at least _METRIC_MIN_DELTA
+_METRIC_CHANGE_FRACTION = .25
+_METRIC_MIN_DELTA = 1
+# The number of added or removed lines with the same template that are listed in a diff. The rest are counted.
+_MAX_DIFF_LINES_PER_TEMPLATE = 3
+
+
+# Sizes with a unit suffix, as printed by e.g. free -h and df -h (14.5Gi, 97G, 12M, 512K, 100B), which are
+# parsed into bytes, so that changes to them are found like changes to any other number
+_size_re = re.compile(r"^([-+]?\d+(?:\.\d+)?)(?:([kKMGTPE])i?)?B?$")
+_SIZE_UNITS = "KMGTPE"
+
+
+def _parse_number(token):
+    m = _size_re.match(token.rstrip(",%"))
+    if not m:
+        return None
+    unit = m.group(2)
+    return float(m.group(1)) * (1024 ** (_SIZE_UNITS.index(unit.upper()) + 1) if unit else 1)
+
+
+def _changed_metrics(baseline_tokens, tokens):
+    changes = []
+    for old_token, new_token in zip(baseline_tokens, tokens):
+        old, new = _parse_number(old_token), _parse_number(new_token)
+        if old is None or new is None:
+            continue
+        delta = abs(new - old)
+        if delta >= _METRIC_MIN_DELTA and delta > _METRIC_CHANGE_FRACTION * max(abs(old), abs(new)):
+            changes.append(f"{old_token} -> {new_token}")
+    return changes
+
+
+def diff_command_output(baseline, output):
+    """Compare the output of a command with its output from a baseline, e.g. a healthy host or the same
+    host before an incident, and describe only what has changed. Lines are matched by their template
+    (see _line_template), so lines that differ only in numbers and identifiers are compared field by field:
+
+    - Lines in which a numeric field has changed meaningfully are listed with a "~" prefix, followed by
+      the old and new values of the fields that changed.
+    - Lines whose template does not appear in the baseline, or appears fewer times, are listed with a "+"
+      prefix, and those that no longer appear with a "-" prefix. After the first few lines of a template
+      the rest are counted instead of listed.
+
+    Lines that are unchanged, or whose numbers changed only a little, are omitted, except for the first
+    line of the output, which is kept, without a prefix, as it is often the header of a table.
+
+    Args:
+        baseline (str): The stdout of the command in the baseline
+        output (str): The current stdout of the command
+
+    Returns:
+        str: The differences, or an empty string if there are none
+    """
+
+    baseline_lines = {}
+    for line in baseline.splitlines():
+        tokens = line.split()
+        if tokens:
+            baseline_lines.setdefault(_line_template(tokens), []).append(tokens)
+
+    diff = []
+    added = {}
+    for line in output.splitlines():
+        tokens = line.split()
+        if not tokens:
+            continue
+        template = _line_template(tokens)
+        matches = baseline_lines.get(template)
+        if matches:
+            changes = _changed_metrics(matches.pop(0), tokens)
+            if changes:
+                diff.append(f"~ {line.strip()} [changed from baseline: {', '.join(changes)}]")
+            continue
+
+        added.setdefault(template, []).append(line.strip())
+        if len(added[template]) <= _MAX_DIFF_LINES_PER_TEMPLATE:
+            diff.append(f"+ {line.strip()}")
+
+    removed = {t: [" ".join(tokens) for tokens in lines] for t, lines in baseline_lines.items() if lines}
+    for lines in removed.values():
+        diff.extend(f"- {line}" for line in lines[:_MAX_DIFF_LINES_PER_TEMPLATE])
+
+    for sign, groups, description in (("+", added, "new"), ("-", removed, "removed")):
+        for lines in groups.values():
+            if len(lines) > _MAX_DIFF_LINES_PER_TEMPLATE:
+                diff.append(f"{sign} [{len(lines) - _MAX_DIFF_LINES_PER_TEMPLATE} more {description} lines like: "
+                            f"{lines[0]}]")
+
+    logging.debug(f"Diffed command output of {len(output)} characters against a baseline of {len(baseline)} "
+                  f"characters: {len(diff)} lines changed")
+    first_line = output.strip().splitlines()[0].strip() if output.strip() else None
+    if diff and first_line and not any(d[2:].startswith(first_line) for d in diff):
+        diff.insert(0, first_line)
+    return "\n".join(diff)
@@ -0,0 +1,397 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Local parsers for the output of common diagnostic commands. For these commands the output is
+# mostly tables of numbers, so rather than paying the LLM to summarise them we compute a compact
+# summary (top consumers, saturation flags, anomalies) ourselves.
+
+import logging
+import re
+
+# Thresholds used to flag problems in the parsed output
+_HIGH_IOWAIT_PCT = 20
+_HIGH_STEAL_PCT = 10
+_LOW_IDLE_PCT = 10
+_LOW_AVAILABLE_MEM_PCT = 10
+_HIGH_SWAP_USED_PCT = 50
+_HIGH_DISK_USE_PCT = 90
+_HIGH_DEVICE_UTIL_PCT = 90
+_HIGH_DEVICE_AWAIT_MS = 50
+_HIGH_TIMEWAIT = 5000
+# The number of entries to report in "top consumers" style lists
+_TOP_N = 5
+
+_size_suffixes = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4, "p": 1024 ** 5}
+
+
+def _to_float(value):
+    return float(value.rstrip("%,").replace(",", "."))
+
+
+def _to_bytes(value):
+    """Convert a size such as '3.8Gi', '512M' or '1024' to a number. Plain numbers are returned as-is."""
+
+    m = re.match(r"^([\d.,]+)([bkmgtp]?)i?b?$", value.lower())
+    if not m:
+        raise ValueError(f"Invalid size: {value}")
+    return float(m.group(1).replace(",", ".")) * _size_suffixes[m.group(2)]
+
+
+def _table(lines, header_index, ncols=None):
+    """Parse the rows following lines[header_index] into dicts keyed by the header's column names.
+    Parsing stops at the first blank line. If ncols is given, rows are split into at most ncols
+    fields so that the final column may contain spaces.
+    """
+
+    header = lines[header_index].split()
+    rows = []
+    for line in lines[header_index + 1:]:
+        if not line.strip():
+            break
+        fields = line.split(None, ncols - 1) if ncols else line.split()
+        if len(fields) != len(header):
+            continue
+        rows.append(dict(zip(header, fields)))
+    return header, rows
+
+
+def _find_line(lines, pattern, start=0):
+    for i in range(start, len(lines)):
+        if re.search(pattern, lines[i]):
+            return i
+    raise ValueError(f"No line matching {pattern}")
+
+
+def _parse_uptime(stdout):
+    m = re.search(r"up\s+(.*?),\s+(\d+)\s+users?,\s+load average:\s*([\d.]+),?\s+([\d.]+),?\s+([\d.]+)", stdout)
+    if not m:
+        raise ValueError("Unrecognised uptime output")
+
+    load1, load5, load15 = (float(m.group(i)) for i in (3, 4, 5))
+    summary = [f"Up {m.group(1).strip()}, {m.group(2)} user(s) logged in. "
+               f"Load average (1/5/15 min): {load1}, {load5}, {load15}."]
+    if load1 >= 1 and load1 > load15 * 1.5:
+        summary.append("Load is rising: the 1 minute average is well above the 15 minute average.")
+    elif load15 >= 1 and load15 > load1 * 1.5:
+        summary.append("Load is falling: the 1 minute average is well below the 15 minute average.")
+    return summary
+
+
+def _parse_free(stdout):
+    lines = stdout.splitlines()
+    header = lines[_find_line(lines, r"\btotal\b")].split()
+
+    summary = []
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0] not in ("Mem:", "Swap:"):
+            continue
+        values = dict(zip(header, fields[1:]))
+        total = _to_bytes(values["total"])
+        used = _to_bytes(values["used"])
+        if fields[0] == "Mem:":
+            summary.append(f"Memory: {values['total']} total, {values['used']} used, {values['free']} free"
+                           + (f", {values['available']} available." if "available" in values else "."))
+            if "available" in values and total:
+                available_pct = _to_bytes(values["available"]) * 100 / total
+                if available_pct < _LOW_AVAILABLE_MEM_PCT:
+                    summary.append(f"WARNING: only {available_pct:.1f}% of memory is available.")
+        else:
+            if not total:
+                summary.append("No swap is configured.")
+                continue
+            used_pct = used * 100 / total
+            summary.append(f"Swap: {values['total']} total, {values['used']} used ({used_pct:.1f}%).")
+            if used_pct > _HIGH_SWAP_USED_PCT:
+                summary.append(f"WARNING: {used_pct:.1f}% of swap is in use.")
+
+    if not summary:
+        raise ValueError("Unrecognised free output")
+    return summary
+
+
+def _parse_df(stdout):
+    lines = stdout.splitlines()
+    header_index = _find_line(lines, r"^Filesystem\s")
+    use_col = "IUse%" if "IUse%" in lines[header_index] else "Use%"
+    kind = "inodes" if use_col == "IUse%" else "space"
+    # "Mounted on" is two words in the header, but one column in the rows
+    ncols = len(lines[header_index].split()) - 1
+    header = lines[header_index].split()[:ncols - 1] + ["Mounted on"]
+
+    filesystems = []
+    pending = []
+    for line in lines[header_index + 1:]:
+        # Long device names can cause df to wrap a row over two lines
+        fields = pending + line.split()
+        if len(fields) < ncols:
+            pending = fields
+            continue
+        pending = []
+        row = dict(zip(header, fields[:ncols - 1] + [" ".join(fields[ncols - 1:])]))
+        if row[use_col] == "-":
+            continue
+        filesystems.append((_to_float(row[use_col]), row["Mounted on"], row["Filesystem"]))
+
+    if not filesystems:
+        raise ValueError("Unrecognised df output")
+
+    filesystems.sort(reverse=True)
+    summary = [f"{len(filesystems)} filesystems. Highest {kind} usage: "
+               + ", ".join(f"{mount} ({fs}) {use:.0f}%" for use, mount, fs in filesystems[:_TOP_N]) + "."]
+    full = [f"{mount} {use:.0f}%" for use, mount, _ in filesystems if use >= _HIGH_DISK_USE_PCT]
+    if full:
+        summary.append(f"WARNING: filesystems at or above {_HIGH_DISK_USE_PCT}% {kind} usage: {', '.join(full)}.")
+    return summary
+
+
+def _parse_vmstat(stdout):
+    lines = stdout.splitlines()
+    header_index = _find_line(lines, r"^\s*r\s+b\s+")
+    header = lines[header_index].split()
+    rows = []
+    for line in lines[header_index + 1:]:
+        fields = line.split()
+        if len(fields) < len(header) or not fields[0].isdigit():
+            continue
+        rows.append(dict(zip(header, (float(f) for f in fields))))
+
+    if not rows:
+        raise ValueError("Unrecognised vmstat output")
+    # The first row reports averages since boot, so prefer the samples that follow it
+    if len(rows) > 1:
+        rows = rows[1:]
+
+    def avg(col):
+        return sum(r.get(col, 0) for r in rows) / len(rows)
+
+    def peak(col):
+        return max(r.get(col, 0) for r in rows)
+
+    summary = [f"{len(rows)} sample(s). Run queue avg {avg('r'):.1f} (max {peak('r'):.0f}), blocked avg "
+               f"{avg('b'):.1f} (max {peak('b'):.0f}). CPU avg: {avg('us'):.0f}% user, {avg('sy'):.0f}% system, "
+               f"{avg('id'):.0f}% idle, {avg('wa'):.0f}% iowait, {avg('st'):.0f}% steal. Context switches avg "
+               f"{avg('cs'):.0f}/s, interrupts avg {avg('in'):.0f}/s."]
+    if peak("si") or peak("so"):
+        summary.append(f"WARNING: the system is swapping (si max {peak('si'):.0f}, so max {peak('so'):.0f}).")
+    if avg("b") >= 1:
+        summary.append("WARNING: processes are regularly blocked waiting on I/O.")
+    summary.extend(_cpu_flags(avg("id"), avg("wa"), avg("st")))
+    return summary
+
+
+def _cpu_flags(idle, iowait, steal):
+    flags = []
+    if idle < _LOW_IDLE_PCT:
+        flags.append(f"WARNING: CPU is saturated ({idle:.0f}% idle).")
+    if iowait > _HIGH_IOWAIT_PCT:
+        flags.append(f"WARNING: high I/O wait ({iowait:.0f}%).")
+    if steal > _HIGH_STEAL_PCT:
+        flags.append(f"WARNING: high CPU steal time ({steal:.0f}%), the hypervisor is overcommitted.")
+    return flags
+
+
+def _parse_iostat(stdout):
+    lines = stdout.splitlines()
+    # iostat with an interval prints several reports. The first covers the time since boot, so we
+    # use the last one.
+    device_headers = [i for i, line in enumerate(lines) if re.match(r"^Device:?\s", line)]
+    if not device_headers:
+        raise ValueError("Unrecognised iostat output")
+    header, rows = _table(lines, device_headers[-1])
+
+    summary = []
+    cpu_headers = [i for i, line in enumerate(lines) if line.startswith("avg-cpu:")]
+    if cpu_headers:
+        cpu_cols = lines[cpu_headers[-1]].split()[1:]
+        cpu = dict(zip(cpu_cols, (_to_float(v) for v in lines[cpu_headers[-1] + 1].split())))
+        summary.append(f"CPU: {cpu.get('%user', 0):.0f}% user, {cpu.get('%system', 0):.0f}% system, "
+                       f"{cpu.get('%iowait', 0):.0f}% iowait, {cpu.get('%idle', 0):.0f}% idle.")
+        summary.extend(_cpu_flags(cpu.get("%idle", 100), cpu.get("%iowait", 0), cpu.get("%steal", 0)))
+
+    device_col = header[0]
+    devices = []
+    for row in rows:
+        util = _to_float(row.get("%util", "0"))
+        awaits = [_to_float(row[c]) for c in ("await", "r_await", "w_await") if c in row]
+        devices.append((util, max(awaits) if awaits else 0, row))
+
+    busy = sorted((d for d in devices if d[0] > 0 or d[1] > 0), key=lambda d: d[0], reverse=True)
+    summary.append(f"{len(devices)} devices, {len(devices) - len(busy)} idle.")
+    if busy:
+        summary.append("Busiest devices: " + ", ".join(
+            f"{row[device_col]} ({util:.0f}% util, {row.get('r/s', '?')} r/s, {row.get('w/s', '?')} w/s, "
+            f"await {wait:.1f} ms)" for util, wait, row in busy[:_TOP_N]) + ".")
+
+    for util, wait, row in busy:
+        if util >= _HIGH_DEVICE_UTIL_PCT:
+            summary.append(f"WARNING: {row[device_col]} is saturated ({util:.0f}% util).")
+        if wait >= _HIGH_DEVICE_AWAIT_MS:
+            summary.append(f"WARNING: {row[device_col]} has high I/O latency (await {wait:.1f} ms).")
+    return summary
+
+
+def _parse_mpstat(stdout):
+    lines = stdout.splitlines()
+    # Prefer the "Average:" rows if there are any, otherwise use the final report
+    header_indices = [i for i, line in enumerate(lines) if re.search(r"\sCPU\s+%", line)]
+    if not header_indices:
+        raise ValueError("Unrecognised mpstat output")
+    averages = [i for i in header_indices if lines[i].startswith("Average:")]
+    header_index = averages[-1] if averages else header_indices[-1]
+
+    # Strip any leading timestamp/AM/PM/"Average:" fields so the header starts at CPU
+    header = lines[header_index].split()
+    offset = header.index("CPU")
+    cpus = {}
+    for line in lines[header_index + 1:]:
+        fields = line.split()
+        if not fields:
+            break
+        fields = fields[len(fields) - (len(header) - offset):]
+        row = dict(zip(header[offset:], fields))
+        cpus[row["CPU"]] = {k: _to_float(v) for k, v in row.items() if k != "CPU"}
+
+    if not cpus:
+        raise ValueError("Unrecognised mpstat output")
+
+    summary = []
+    overall = cpus.pop("all", None)
+    if overall:
+        summary.append(f"All CPUs: {overall.get('%usr', 0):.0f}% user, {overall.get('%sys', 0):.0f}% system, "
+                       f"{overall.get('%iowait', 0):.0f}% iowait, {overall.get('%steal', 0):.0f}% steal, "
+                       f"{overall.get('%idle', 0):.0f}% idle.")
+        summary.extend(_cpu_flags(overall.get("%idle", 100), overall.get("%iowait", 0), overall.get("%steal", 0)))
+
+    if cpus:
+        busiest = sorted(cpus.items(), key=lambda kv: kv[1].get("%idle", 100))
+        summary.append(f"{len(cpus)} CPUs. Busiest: " + ", ".join(
+            f"CPU {cpu} ({100 - stats.get('%idle', 100):.0f}% busy)" for cpu, stats in busiest[:_TOP_N]) + ".")
+        hot = [cpu for cpu, stats in cpus.items() if stats.get("%idle", 100) < _LOW_IDLE_PCT]
+        if hot and len(hot) < len(cpus) / 2:
+            summary.append(f"WARNING: load is unevenly spread, CPU(s) {', '.join(hot)} are saturated while "
+                           "others are not.")
+    return summary
+
+
+def _parse_top(stdout):
+    lines = stdout.splitlines()
+    summary = _parse_uptime(lines[0]) if "load average" in lines[0] else []
+
+    for line in lines:
+        if line.startswith("Tasks:"):
+            tasks = dict((v, int(k)) for k, v in re.findall(r"(\d+)\s+(\w+)", line))
+            summary.append(f"Tasks: {tasks.get('total', '?')} total, {tasks.get('running', '?')} running.")
+            if tasks.get("zombie"):
+                summary.append(f"WARNING: {tasks['zombie']} zombie process(es).")
+        elif line.startswith("%Cpu"):
+            cpu = dict((k, float(v)) for v, k in re.findall(r"([\d.]+)\s*(\w\w)\b", line))
+            summary.append(f"CPU: {cpu.get('us', 0):.0f}% user, {cpu.get('sy', 0):.0f}% system, "
+                           f"{cpu.get('id', 0):.0f}% idle, {cpu.get('wa', 0):.0f}% iowait.")
+            summary.extend(_cpu_flags(cpu.get("id", 100), cpu.get("wa", 0), cpu.get("st", 0)))
+        elif re.match(r"^\w+ Mem\s*:", line):
+            mem = dict((k, float(v)) for v, k in re.findall(r"([\d.]+)\+?\s+(total|free|used|buff/cache)", line))
+            summary.append(" ".join(line.split()) + ".")
+            if mem.get("total") and mem.get("free", 0) * 100 / mem["total"] < _LOW_AVAILABLE_MEM_PCT:
+                avail = re.search(r"([\d.]+)\s+avail", stdout)
+                if not avail or float(avail.group(1)) * 100 / mem["total"] < _LOW_AVAILABLE_MEM_PCT:
+                    summary.append("WARNING: memory is nearly exhausted.")
+
+    header_index = _find_line(lines, r"^\s*PID\s+USER\s")
+    header, rows = _table(lines, header_index, ncols=len(lines[header_index].split()))
+    if not rows:
+        raise ValueError("Unrecognised top output")
+
+    for col, resource in (("%CPU", "CPU"), ("%MEM", "memory")):
+        consumers = sorted((r for r in rows if _to_float(r[col]) > 0), key=lambda r: _to_float(r[col]), reverse=True)
+        if consumers:
+            summary.append(f"Top processes by {resource}: " + ", ".join(
+                f"{r['COMMAND']} (pid {r['PID']}, {r[col]}%)" for r in consumers[:_TOP_N]) + ".")
+        else:
+            summary.append(f"No process is using a measurable amount of {resource}.")
+    stuck = [f"{r['COMMAND']} (pid {r['PID']})" for r in rows if r.get("S") == "D"]
+    if stuck:
+        summary.append(f"WARNING: processes in uninterruptible sleep (D state): {', '.join(stuck[:_TOP_N])}.")
+    return summary
+
+
+def _parse_ss_summary(stdout):
+    total = re.search(r"^Total:\s*(\d+)", stdout, re.MULTILINE)
+    tcp = re.search(r"^TCP:\s*(\d+)\s*\((.*)\)", stdout, re.MULTILINE)
+    if not (total and tcp):
+        raise ValueError("Unrecognised ss -s output")
+
+    states = dict((k, int(v)) for k, v in re.findall(r"(\w+)\s+(\d+)", tcp.group(2)))
+    summary = [f"{total.group(1)} sockets in total. TCP: {tcp.group(1)} ("
+               + ", ".join(f"{k} {v}" for k, v in states.items()) + ")."]
+    if states.get("timewait", 0) > _HIGH_TIMEWAIT:
+        summary.append(f"WARNING: {states['timewait']} TCP connections in TIME-WAIT, which suggests a high rate "
+                       "of short-lived connections.")
+    if states.get("orphaned", 0) > 0:
+        summary.append(f"{states['orphaned']} orphaned TCP connections.")
+    return summary
+
+
+# Registry of local parsers. Each entry maps a regex, which must match the entire command
+# (minus any leading sudo), to a function that takes the command's stdout and returns a list of
+# summary sentences. Parsers raise an exception if they do not recognise the output format, in
+# which case we fall back to summarising the output with the LLM.
+_parsers = [
+    (re.compile(r"^uptime$"), _parse_uptime),
+    (re.compile(r"^free(\s+-[bkmgthw]+)*$"), _parse_free),
+    (re.compile(r"^df(\s+-[hHiTkPl]+)*(\s+[\w/.-]+)*$"), _parse_df),
+    (re.compile(r"^vmstat(\s+-[wSt]+(\s+[kKmM])?)*(\s+\d+){0,2}$"), _parse_vmstat),
+    (re.compile(r"^iostat(\s+-\w+)*\s+-\w*x\w*(\s+-\w+)*(\s+\d+){0,2}$"), _parse_iostat),
+    (re.compile(r"^mpstat(\s+-P\s+\w+|\s+-u)*(\s+\d+){0,2}$"), _parse_mpstat),
+    (re.compile(r"^top(?=.*\s-\w*b)(\s+-\w+(\s+\d+)?)*$"), _parse_top),
+    (re.compile(r"^ss\s+-s$"), _parse_ss_summary),
+]
+
+
+def get_parser(command):
+    """Returns the local parser for the given command, or None if there is no parser for it."""
+
+    command = re.sub(r"^sudo\s+", "", command.strip())
+    for regex, parser in _parsers:
+        if regex.match(command):
+            return parser
+    return None
+
+
+def summarise_command_locally(command, command_output):
+    """Summarise the output of a command without using the LLM.
+
+    Args:
+        command (str): The command and its arguments
+        command_output (cmdexec.CommandResult): The output of running the command
+
+    Returns:
+        str: The summary, or None if the command is not one that we can summarise locally
+    """
+
+    parser = get_parser(command)
+    if not parser or command_output.exit_code != 0:
+        return None
+
+    try:
+        summary = " ".join(parser(command_output.stdout))
+    except (ValueError, KeyError, IndexError, ZeroDivisionError) as e:
+        logging.debug(f"Failed to parse the output of '{command}' locally: {e}")
+        return None
+
+    logging.debug(f"Summarised '{command}' locally: {summary}")
+    return summary
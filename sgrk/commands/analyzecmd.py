@@ -19,8 +19,10 @@ import argparse
 import logging
 import sys
 
+from sgrk.archive import resume_run, start_run
 from sgrk.cmdanalysis import summarise_command
-from sgrk.cmdexec import execute_commands_remote
+from sgrk.cmdexec import add_filter_arguments, execute_commands_remote, filters_from_args, load_commands_archived
+from sgrk.llm import get_budget
 
 
 command = "analyzecmd"
@@ -30,8 +32,22 @@ help = "Summarise the output of a command, optionally with respect to a problem
 def add_to_command_parser(subparsers):
     parser = subparsers.add_parser(command, help=help)
     parser.add_argument("-p", "--problem-description", help="Optional description of the problem you are investigating")
-    parser.add_argument("-t", "--target-host", required=True,
-                        help="The host to connect to via ssh. Otherwise command is run locally.")
+    parser.add_argument("-t", "--target-host",
+                        help="The host to connect to via ssh. Required unless --replay or --resume is used.")
+    parser.add_argument("--replay", metavar="RUN",
+                        help="""Analyse the output of the command recorded in an earlier run, instead of executing it.
+                        RUN is a run ID, or a unique prefix of one, or 'last' for the most recent run.""")
+    parser.add_argument("--resume", metavar="RUN",
+                        help="""Continue a run that was interrupted from where it stopped, without executing the command
+                        again if it completed, or summarising again the chunks of its output that were summarised. The
+                        command, problem description and target host of the run are used unless others are given.""")
+    parser.add_argument("--no-compact", action="store_true", default=False,
+                        help="Send the raw command output to the LLM, without collapsing repeated lines")
+    parser.add_argument("--no-local-parsers", action="store_true", default=False,
+                        help="Always use the LLM to summarise commands, even those sysgrok can summarise itself")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Summarise every chunk of large outputs, instead of reusing summaries from earlier runs")
+    add_filter_arguments(parser)
     parser.add_argument("command", nargs=argparse.REMAINDER, help="The command to execute and analyze")
 
 
@@ -40,23 +56,65 @@ def run(args_parser, args):
         logging.error(f"Chat not implemented for {command}")
         sys.exit(1)
 
+    if args.command and args.command[0] == '--':
+        args.command = args.command[1:]
+
+    if args.replay and args.resume:
+        logging.error("Only one of --replay and --resume can be used")
+        sys.exit(1)
+
+    if args.resume:
+        try:
+            run_archive = resume_run(args.resume, command)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+
+        run_archive.restore_args(args, ["problem_description", "target_host", "since", "until", "grep", "tail"])
+        if not args.command:
+            args.command = [run_archive.meta["args"]["command"]]
+
+    if args.replay:
+        try:
+            command_output = load_commands_archived(args.replay)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+
+        if not args.command and len(command_output) == 1:
+            args.command = list(command_output.keys())
+        elif not args.command:
+            logging.error(f"The run recorded {len(command_output)} commands. Specify which one to analyse: "
+                          f"{', '.join(command_output.keys())}")
+            sys.exit(1)
+
     if not args.command:
         logging.error("Command not provided")
         sys.exit(1)
 
-    if args.command[0] == '--':
-        args.command = args.command[1:]
-
     args.command = " ".join(args.command)
     logging.debug(f"Analyzing command: {args.command}")
 
-    command_output = execute_commands_remote(args.target_host, [args.command])
+    if not args.replay:
+        if not args.target_host:
+            logging.error("A target host must be provided, unless --replay or --resume is used")
+            sys.exit(1)
+
+        if not args.no_archive and not args.resume:
+            start_run(command, vars(args))
+        # The filters are applied here, rather than by execute_commands_remote, so that we know the command
+        # that the output will be for
+        args.command = filters_from_args(args).rewrite(args.command)
+        command_output = execute_commands_remote(args.target_host, [args.command], get_budget().deadline)
 
     if args.command not in command_output:
         logging.error(f"Failed to execute {args.command}")
         sys.exit(1)
 
     _, summary = summarise_command(args.command, command_output[args.command],
-                                   problem_description=args.problem_description)
+                                   problem_description=args.problem_description,
+                                   compact=not args.no_compact,
+                                   local_parsers=not args.no_local_parsers,
+                                   cache=not args.no_cache)
     print(summary)
     return 0
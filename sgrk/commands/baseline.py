@@ -0,0 +1,95 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import sys
+import time
+
+from sgrk.archive import open_run, start_run
+from sgrk.baseline import list_baselines, save_baseline
+from sgrk.cmdexec import execute_commands_remote, load_commands_archived
+from sgrk.commands.debughost import triage_commands
+from sgrk.llm import get_budget
+
+command = "baseline"
+help = "Capture the output of commands on a healthy host, for debughost --baseline to compare against"
+
+
+def add_to_command_parser(subparsers):
+    parser = subparsers.add_parser(command, help=help)
+    parser.add_argument("-t", "--target-host",
+                        help="The host to connect to via ssh. Required unless --from-run or --list is used.")
+    parser.add_argument("-n", "--name",
+                        help="""The name of the baseline, e.g. a role such as es-data-node if it is to be compared
+                        against other hosts with the same role. Defaults to the target host.""")
+    parser.add_argument("-c", "--command", action="append", default=[], dest="commands", metavar="COMMAND",
+                        help="""A command to include in the baseline. May be given more than once. Defaults to the
+                        triage commands that debughost --iterative starts with.""")
+    parser.add_argument("--from-run", metavar="RUN",
+                        help="""Create the baseline from the command output recorded in an earlier run, e.g. from
+                        before an incident, instead of executing the commands. RUN is a run ID, or a unique prefix
+                        of one, or 'last' for the most recent run.""")
+    parser.add_argument("--list", action="store_true", default=False, help="List the existing baselines")
+
+
+def run(args_parser, args):
+    if args.chat:
+        logging.error(f"Chat not implemented for {command}")
+        sys.exit(1)
+
+    if args.list:
+        for b in list_baselines():
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(b["created"]))
+            print(f"{b['name']}\t{b['host']}\t{created}\t{b['commands']} commands")
+        return 0
+
+    if args.from_run:
+        try:
+            host = open_run(args.from_run).meta["args"].get("target_host")
+            command_output = load_commands_archived(args.from_run)
+        except ValueError as e:
+            logging.error(e)
+            return -1
+        if args.commands:
+            command_output = {c: o for c, o in command_output.items() if c in args.commands}
+    else:
+        if not args.target_host:
+            logging.error("A target host must be provided, unless --from-run is used")
+            return -1
+
+        if not args.no_archive:
+            start_run(command, vars(args))
+        host = args.target_host
+        commands = args.commands or list(triage_commands)
+        logging.info(f"Capturing the output of {len(commands)} commands on {host}")
+        command_output = execute_commands_remote(host, commands, get_budget().deadline)
+
+    if not command_output:
+        sys.stderr.write("No command output to save")
+        return -1
+
+    name = args.name or host
+    if not name:
+        logging.error("A name for the baseline must be provided, as the run does not record a target host")
+        return -1
+
+    try:
+        save_baseline(name, host, command_output)
+    except ValueError as e:
+        logging.error(e)
+        return -1
+    return 0
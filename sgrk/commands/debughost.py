@@ -17,12 +17,18 @@
 
 import json
 import logging
+import re
 import sys
+import time
 
+from sgrk import profiling
+from sgrk.archive import CHECKPOINT_PLAN, get_checkpoint, record_checkpoint, resume_run, start_run
 from sgrk.ui import query_yes_no
-from sgrk.llm import get_llm_response
-from sgrk.cmdanalysis import analyse_command_output
-from sgrk.cmdexec import execute_commands_remote
+from sgrk.llm import PHASE_PLAN, get_budget, get_dry_run, get_llm_response, phase, stream_llm_response
+from sgrk.cmdanalysis import analyse_command_output, analyse_command_summaries, get_command_summaries
+from sgrk.cmdexec import add_filter_arguments, execute_commands_remote, filters_from_args, load_commands_archived
+from sgrk.pipeline import collect_and_summarise
+from sgrk.baseline import diff_with_baseline, load_baseline
 
 command = "debughost"
 help = "Debug an issue by executing CLI tools and interpreting the output"
@@ -30,35 +36,47 @@ help = "Debug an issue by executing CLI tools and interpreting the output"
 
 def add_to_command_parser(subparsers):
     parser = subparsers.add_parser(command, help=help)
-    parser.add_argument("-p", "--problem-description", required=True,
-                        help="A description of the problem you are investigating. Be as detailed as possible.")
-    parser.add_argument("-t", "--target-host", required=True,
-                        help="The host to connect to via ssh. Otherwise commands are run locally.")
+    parser.add_argument("-p", "--problem-description",
+                        help="""A description of the problem you are investigating. Be as detailed as possible.
+                        Required unless --resume is used.""")
+    parser.add_argument("-t", "--target-host",
+                        help="The host to connect to via ssh. Required unless --replay or --resume is used.")
+    parser.add_argument("--replay", metavar="RUN",
+                        help="""Analyse the output of the commands recorded in an earlier run, instead of asking the LLM
+                        for commands and executing them. RUN is a run ID, or a unique prefix of one, or 'last' for the
+                        most recent run.""")
+    parser.add_argument("--resume", metavar="RUN",
+                        help="""Continue a run that was interrupted from where it stopped. The commands the LLM
+                        suggested, the commands that completed, and the summaries that were made are not repeated. The
+                        problem description and target host of the run are used unless others are given.""")
+    parser.add_argument("--baseline", metavar="NAME",
+                        help="""Run the commands in a baseline created with the baseline command, e.g. on a healthy
+                        host with the same role or on this host before the problem started, and analyse only how their
+                        output differs from the baseline""")
     parser.add_argument("-e", "--explain-commands", action="store_true",
                         help="Print the explanations the LLM gives for each command it suggests")
     parser.add_argument("--print-summaries", action="store_true",
                         help="Include the command summaries in the final report")
     parser.add_argument("--yolo", action="store_true", default=False,
                         help="Run LLM suggested commands without confirmation")
+    parser.add_argument("--no-compact", action="store_true", default=False,
+                        help="Send the raw command output to the LLM, without collapsing repeated lines")
+    parser.add_argument("--no-local-parsers", action="store_true", default=False,
+                        help="Always use the LLM to summarise commands, even those sysgrok can summarise itself")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Summarise every chunk of large outputs, instead of reusing summaries from earlier runs")
+    parser.add_argument("--iterative", action="store_true", default=False,
+                        help="""Start with a small set of triage commands and then ask the LLM for a few more commands
+                        at a time, based on what has been found so far, instead of running one large set of commands""")
+    parser.add_argument("--max-rounds", type=int, default=4,
+                        help="The maximum number of rounds of commands to run in --iterative mode")
+    parser.add_argument("--commands-per-round", type=int, default=5,
+                        help="The maximum number of commands to ask the LLM for per round in --iterative mode")
+    add_filter_arguments(parser)
 
 
-def ask_llm_for_commands(problem_description):
-    """Get a list of commands to run to solve the problem described by args.problem_description.
-
-    Returns a list of strings, where each entry is a command to run and its arguments.
-    """
-
-    prompt = """I am a sysadmin. I am logged onto a machine that is experiencing a
-problem. I need you to tell me what Linux commands to run to debug the problem.
-
-Your task is to suggest a list of up to fifty Linux command line tools that I should run
-that will provide information I can use to debug this problem. For each command line tool you must explain
-how it will help debug the problem. You should format your output as JSON. Return a JSON dictionary
-where the keys are the commands and their arguments and the values are the explanation of how
-that command will help debug the problem.
-
-Be aware that there may be more than one process with the same name running on the system, so commands like
-pidof may return multiple process IDs.
+_command_rules = """Be aware that there may be more than one process with the same name running on the system, so
+commands like pidof may return multiple process IDs.
 
 All commands that you suggest must exit after a maximum of 10 seconds. You must provide the arguments
 to the command that will cause it to exit before this time limit.
@@ -72,7 +90,87 @@ running on the host.
 I will run the commands you suggest verbatim, so you must never suggest an argument to a command that is a
 placeholder that needs to be replaced. If a command line tool requires a port or a process ID then the
 command you generate must calculate this value via command substitution or some other mechanism.
+"""
+
+
+_json_decoder = json.JSONDecoder()
+_whitespace_re = re.compile(r"[\s,]*")
+
+
+def _iter_json_object_items(chunks):
+    """Incrementally parse a JSON object of strings, which is received as a sequence of chunks of text,
+    and yield each key and value as soon as both have been received. Any text before the opening brace is
+    ignored.
+
+    Raises:
+        json.JSONDecodeError: If the text is not a complete JSON object.
+    """
+
+    buf = ""
+    pos = None
+    done = False
+    for chunk in chunks:
+        buf += chunk
+        # Keep consuming the chunks after the object is closed, so that the stream is completed
+        if done:
+            continue
+
+        if pos is None:
+            start = buf.find("{")
+            if start == -1:
+                continue
+            pos = start + 1
+
+        while True:
+            pos = _whitespace_re.match(buf, pos).end()
+            if buf.startswith("}", pos):
+                done = True
+                break
+
+            try:
+                key, end = _json_decoder.raw_decode(buf, pos)
+                end = _whitespace_re.match(buf, end).end()
+                if not buf.startswith(":", end):
+                    break
+                end = _whitespace_re.match(buf, end + 1).end()
+                value, end = _json_decoder.raw_decode(buf, end)
+            except json.JSONDecodeError:
+                # The item is not complete yet
+                break
+
+            # A value at the very end of the buffer may be a number or literal that is still being received
+            if end == len(buf) and not isinstance(value, str):
+                break
+
+            pos = end
+            yield key, value
+
+    if not done:
+        raise json.JSONDecodeError("Incomplete JSON object", buf, pos or 0)
+
+
+def ask_llm_for_commands(problem_description, already_planned=()):
+    """Get the commands to run to solve the problem described by args.problem_description. If already_planned
+    is given, the LLM is asked not to suggest those commands again.
+
+    The LLM's response is streamed, and each command is yielded as soon as it has been received, so
+    that commands can be executed while the LLM is still generating the rest of them. If the response
+    is cut short, or is not valid JSON, then the error is logged and no more commands are yielded.
+
+    Yields:
+        tuple: A command to run and its arguments, and the LLM's explanation of how it will help.
+    """
+
+    prompt = """I am a sysadmin. I am logged onto a machine that is experiencing a
+problem. I need you to tell me what Linux commands to run to debug the problem.
 
+Your task is to suggest a list of up to fifty Linux command line tools that I should run
+that will provide information I can use to debug this problem. For each command line tool you must explain
+how it will help debug the problem. You should format your output as JSON. Return a JSON dictionary
+where the keys are the commands and their arguments and the values are the explanation of how
+that command will help debug the problem.
+
+{rules}
 Here is an example. I will specify the problem. You will tell me the command line tools to run to debug it. This
 example has four command line tools, but you should respond with fifty if you can. It is OK to respond with fewer
 if there are fewer than fifty commands that are likely to be useful.
@@ -90,21 +188,121 @@ Command line tools: {{
 Problem: {problem}
 Commands:"""
 
-    return json.loads(get_llm_response(prompt.format(problem=problem_description)))
+    rules = _command_rules
+    if already_planned:
+        rules += ("\nYou have already suggested the following commands, so do not suggest them again: " +
+                  ", ".join(already_planned) + "\n")
 
+    # The phase has to be set around the iteration of the stream, rather than by decorating this function,
+    # as the LLM is queried as the commands are consumed
+    with phase(PHASE_PLAN):
+        try:
+            yield from _iter_json_object_items(stream_llm_response(prompt.format(problem=problem_description,
+                                                                                 rules=rules)))
+        except json.JSONDecodeError as e:
+            # By now the commands received before the error have been executed, and their output is analysed
+            logging.error(f"The LLM's list of commands was cut short or malformed ({e}). Only the commands received "
+                          "before that are run.")
 
-def run(args_parser, args):
-    if args.chat:
-        logging.error(f"Chat not implemented for {command}")
-        sys.exit(1)
 
-    logging.info("Querying the LLM for commands to run ...")
-    commands = ask_llm_for_commands(args.problem_description)
-    if not commands:
-        sys.stderr.write("LLM did not return any commands to run")
-        return -1
+# Cheap commands that give a broad overview of the health of a host. These are run in the first round
+# of --iterative mode, before the LLM is asked for any commands. Most of them can be summarised by
+# cmdparsers without using the LLM.
+triage_commands = {
+    "uptime": "Shows how long the system has been up and the load averages.",
+    "top -b -n1": "Shows overall CPU and memory usage and the processes using the most resources.",
+    "vmstat 1 5": "Shows run queue length, memory, swap, I/O and CPU activity over five seconds.",
+    "free -m": "Shows memory and swap usage.",
+    "df -h": "Shows disk space usage of each filesystem.",
+    "iostat -x 1 2": "Shows utilisation and latency of each block device.",
+    "ss -s": "Shows a summary of socket usage.",
+    "sudo dmesg -T | tail -n 50": "Shows the most recent kernel messages, such as OOM kills and hardware errors.",
+}
+
+
+@phase(PHASE_PLAN)
+@profiling.span(profiling.SPAN_PLANNING)
+def ask_llm_for_next_commands(problem_description, command_summaries, max_commands):
+    """Ask the LLM what commands to run next, given the summaries of the commands that have been
+    run so far.
+
+    Returns a tuple of a bool, which is True if the LLM considers that it has enough information to
+    diagnose the problem, and a dict mapping commands to run to an explanation of why to run them.
+    """
+
+    prompt = """I am a sysadmin. I am logged onto a machine that is experiencing a
+problem. I am running Linux commands to debug the problem, a few at a time. I have already run some commands
+and I will give you a summary of the output of each of them.
+
+Your task is to decide whether the information I have gathered so far is enough to diagnose the problem. If it
+is not, then suggest up to {max_commands} further Linux command line tools that I should run next. Choose the
+commands that will best confirm or rule out the most likely causes of the problem given what has been found
+so far. Do not suggest commands that I have already run. For each command line tool you must explain how it
+will help debug the problem.
+
+{rules}
+You must format your output as JSON. Return a JSON dictionary with the following keys:
+"done": true if the information so far is enough to diagnose the problem, otherwise false.
+"reason": a brief explanation of why you have, or have not, got enough information.
+"commands": a JSON dictionary where the keys are the commands and their arguments and the values are the
+explanation of how that command will help debug the problem. This must be empty if "done" is true.
+
+The commands you generate will be put in a JSON string, so ensure they are escaped correctly.
+
+Problem: {problem}
+Summaries of the commands run so far:
+{command_summaries}
+Response:"""
+
+    cs_str = "\n".join(f"Summary for '{c}': {s}" for c, s in command_summaries)
+    response = get_llm_response(prompt.format(problem=problem_description, rules=_command_rules,
+                                              max_commands=max_commands, command_summaries=cs_str))
+    with profiling.span(profiling.SPAN_JSON_PARSING):
+        response = json.loads(response)
+    done = bool(response.get("done"))
+    logging.debug(f"LLM {'has' if done else 'does not have'} enough information: {response.get('reason')}")
+    return done, response.get("commands") or {}
 
-    logging.info("LLM suggested running the following commands: ")
+
+def _checkpointed_plan(key, plan):
+    """Yield the (command, explanation) pairs from plan, which queries the LLM for them, recording each in a
+    checkpoint as it is received, and the whole plan in another once it is complete. If the run is being
+    resumed, the commands the LLM suggested before it stopped are taken from the checkpoints. If the plan was
+    not complete then plan is then called for the rest of the commands.
+
+    Args:
+        key (str): The key of the plan's checkpoints
+        plan (function): Called with the list of commands already planned, and returns an iterable of
+            (command, explanation) pairs
+    """
+
+    planned = get_checkpoint(CHECKPOINT_PLAN, key)
+    if planned is not None:
+        logging.info("Using the commands the LLM suggested before the run was resumed")
+        yield from planned
+        return
+
+    planned = []
+    item = get_checkpoint(CHECKPOINT_PLAN, f"{key}/0")
+    while item is not None:
+        planned.append(tuple(item))
+        item = get_checkpoint(CHECKPOINT_PLAN, f"{key}/{len(planned)}")
+    if planned:
+        logging.info(f"Using the {len(planned)} commands the LLM suggested before the run was resumed, and asking "
+                     "it for the rest")
+        yield from planned
+
+    already_planned = {cmd for cmd, _ in planned}
+    for cmd, reason in plan([cmd for cmd, _ in planned]):
+        if cmd in already_planned:
+            continue
+        record_checkpoint(CHECKPOINT_PLAN, f"{key}/{len(planned)}", (cmd, reason))
+        planned.append((cmd, reason))
+        yield cmd, reason
+    record_checkpoint(CHECKPOINT_PLAN, key, planned)
+
+
+def _log_commands(args, commands):
     for cmd, reason in commands.items():
         if args.explain_commands:
             logging.info(f"    {cmd} - {reason}")
@@ -112,12 +310,205 @@ def run(args_parser, args):
             logging.info(f"    {cmd}")
             logging.debug(f"        {reason}")
 
-    if not args.yolo:
-        if not query_yes_no("Allow execution of the above commands with sudo?"):
-            logging.error("Permission denied. Exiting.")
+
+def run_iterative(args):
+    """Debug the host in rounds. The first round runs a fixed set of triage commands. Each following
+    round asks the LLM for a few more commands based on the summaries of the commands run so far.
+    We stop when the LLM says it has enough information, when it suggests no new commands, or after
+    args.max_rounds rounds.
+    """
+
+    total_commands = len(triage_commands) + (args.max_rounds - 1) * args.commands_per_round
+    command_summaries = []
+    commands_run = set()
+    commands = triage_commands
+    for round_num in range(1, args.max_rounds + 1):
+        logging.info(f"Round {round_num}: running the following commands: ")
+        _log_commands(args, commands)
+        if not args.yolo:
+            if not query_yes_no("Allow execution of the above commands with sudo?"):
+                logging.error("Permission denied. Stopping.")
+                break
+
+        commands_run.update(commands)
+        command_output = execute_commands_remote(args.target_host, commands.keys(), get_budget().deadline,
+                                                 filters=filters_from_args(args))
+        command_summaries.extend(get_command_summaries(command_output, args.problem_description,
+                                                       compact=not args.no_compact,
+                                                       local_parsers=not args.no_local_parsers,
+                                                       total_commands=total_commands,
+                                                       cache=not args.no_cache))
+        if round_num == args.max_rounds:
+            break
+        # Planning the next round uses an LLM call, and we need to keep at least one for the final analysis
+        remaining_calls = get_budget().remaining_calls()
+        if get_budget().exhausted() or (remaining_calls is not None and remaining_calls < 3):
+            logging.warning("Not planning any more rounds, to stay within the run's budget")
+            break
+
+        checkpoint_key = f"round-{round_num + 1}"
+        checkpoint = get_checkpoint(CHECKPOINT_PLAN, checkpoint_key)
+        if checkpoint is not None:
+            logging.info("Using the commands the LLM suggested before the run was resumed")
+            done, commands = checkpoint
+        else:
+            logging.info("Querying the LLM for the next commands to run ...")
+            done, commands = ask_llm_for_next_commands(args.problem_description, command_summaries,
+                                                       args.commands_per_round)
+            record_checkpoint(CHECKPOINT_PLAN, checkpoint_key, (done, commands))
+        if get_dry_run():
+            logging.info("Stopping after the first round, as a dry run cannot know what commands the LLM would "
+                         "suggest next")
+            break
+        commands = {c: r for c, r in list(commands.items())[:args.commands_per_round] if c not in commands_run}
+        if done:
+            logging.info("The LLM has enough information to diagnose the problem")
+            break
+        if not commands:
+            logging.info("The LLM does not have enough information to diagnose the problem, but did not suggest any "
+                         "commands that have not already been run. Analysing the information gathered so far.")
+            break
+
+    if not command_summaries:
+        sys.stderr.write("No commands were run")
+        return -1
+
+    analyse_command_summaries(command_summaries, args.problem_description, args.print_summaries)
+    return 0
+
+
+_differential_problem = """{problem}
+
+The output of each command has been compared with its output in a baseline captured on {host} at {created},
+and only the differences are given. Lines starting with + are new, lines starting with - are no longer
+present, and lines starting with ~ have numeric fields that changed, whose old and new values are listed.
+A line without a prefix is the first line of the output, e.g. the header of a table, and is unchanged."""
+
+
+def run_differential(args):
+    """Run the commands in a baseline on the host and analyse the differences between their output and
+    the baseline. Only the differences are summarised, so far less is sent to the LLM and the analysis
+    focuses on what has changed.
+    """
+
+    try:
+        meta, baseline_output = load_baseline(args.baseline)
+    except ValueError as e:
+        logging.error(e)
+        return -1
+
+    created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["created"]))
+    logging.info(f"Running the commands in baseline {meta['name']}, captured on {meta['host']} at {created}: ")
+    _log_commands(args, {c: "From the baseline" for c in baseline_output})
+    if not args.yolo and not query_yes_no("Allow execution of the above commands with sudo?"):
+        logging.error("Permission denied. Stopping.")
+        return -1
+
+    command_output = execute_commands_remote(args.target_host, baseline_output.keys(), get_budget().deadline)
+    if not command_output:
+        sys.stderr.write("No commands were executed")
+        return -1
+
+    changed, unchanged = diff_with_baseline(baseline_output, command_output)
+    problem_description = _differential_problem.format(problem=args.problem_description, host=meta["host"],
+                                                       created=created)
+    command_summaries = []
+    if changed:
+        # Local parsers expect the full output of a command, not the differences, and the differences are
+        # already compact
+        command_summaries = get_command_summaries(changed, problem_description, compact=False, local_parsers=False,
+                                                  cache=not args.no_cache)
+    command_summaries.extend((c, "No meaningful change from the baseline.") for c in unchanged)
+
+    analyse_command_summaries(command_summaries, problem_description, args.print_summaries)
+    return 0
+
+
+def run(args_parser, args):
+    if args.chat:
+        logging.error(f"Chat not implemented for {command}")
+        sys.exit(1)
+
+    if args.replay and args.resume:
+        logging.error("Only one of --replay and --resume can be used")
+        return -1
+
+    if not args.problem_description and not args.resume:
+        logging.error("A problem description must be provided, unless --resume is used")
+        return -1
+
+    if args.replay:
+        try:
+            command_output = load_commands_archived(args.replay)
+        except ValueError as e:
+            logging.error(e)
             return -1
 
-    logging.info(f"{len(commands)} commands in total to execute ...")
+        if not command_output:
+            sys.stderr.write("The run did not record any command output")
+            return -1
+
+        analyse_command_output(command_output, args.problem_description, args.print_summaries,
+                               compact=not args.no_compact,
+                               local_parsers=not args.no_local_parsers,
+                               cache=not args.no_cache)
+        return 0
+
+    if args.resume:
+        try:
+            resume_run(args.resume, command).restore_args(args, ["problem_description", "target_host", "since",
+                                                                 "until", "grep", "tail"])
+        except ValueError as e:
+            logging.error(e)
+            return -1
+    elif not args.no_archive:
+        start_run(command, vars(args))
+
+    if not args.target_host:
+        logging.error("A target host must be provided, unless --replay or --resume is used")
+        return -1
+
+    if args.baseline:
+        return run_differential(args)
+
+    if args.iterative:
+        return run_iterative(args)
+
+    logging.info("Querying the LLM for commands to run ...")
+
+    plan = _checkpointed_plan("initial", lambda planned: ask_llm_for_commands(args.problem_description, planned))
+    if get_dry_run():
+        # A dry run cannot know what commands the LLM would suggest, so the query for them is only counted,
+        # and the triage commands stand in for them
+        for _ in plan:
+            pass
+        plan = triage_commands.items()
+    if not args.yolo:
+        # The whole plan is received before asking for approval, so that the LLM's response is not held open
+        # while waiting for an answer, and the questions are not mixed up with the output of running commands
+        plan = list(plan)
+
+    def approved_commands():
+        for cmd, reason in plan:
+            logging.info("LLM suggested running the following command: ")
+            _log_commands(args, {cmd: reason})
+            if args.yolo or query_yes_no(f"Allow execution of '{cmd}' with sudo?"):
+                yield cmd
+            else:
+                logging.info(f"Not executing '{cmd}'")
+
+    # With --yolo, commands are executed as soon as they are received from the LLM, while it is still generating
+    # the rest. Each command's output is summarised as soon as the command completes, while later commands run.
+    commands = approved_commands() if args.yolo else list(approved_commands())
+    command_summaries = collect_and_summarise(args.target_host, commands, args.problem_description,
+                                              compact=not args.no_compact,
+                                              local_parsers=not args.no_local_parsers,
+                                              cache=not args.no_cache,
+                                              filters=filters_from_args(args))
+    if not command_summaries:
+        sys.stderr.write("No commands were executed")
+        return -1
 
-    command_output = execute_commands_remote(args.target_host, commands.keys())
-    analyse_command_output(command_output, args.problem_description, args.print_summaries)
+    logging.info(f"{len(command_summaries)} commands executed")
+    analyse_command_summaries(command_summaries, args.problem_description, args.print_summaries)
+    return 0
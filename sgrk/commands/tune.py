@@ -0,0 +1,291 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import math
+import sys
+import time
+
+from sgrk import llm
+from sgrk.archive import open_run
+from sgrk.cmdanalysis import (analyse_summaries_prompt_with_problem, analyse_summaries_prompt_without_problem,
+                              estimate_summary_cost, example_response, get_command_summaries, summarise_command)
+from sgrk.cmdexec import load_commands_archived
+from sgrk.cmdparsers import summarise_command_locally
+from sgrk.endpoints import RETRYABLE_ERRORS
+from sgrk.models import get_model_info, save_model_fields, set_model_fields
+
+command = "tune"
+help = "Tune summary sizes, chunk size and concurrency for the configured models, using the output of earlier runs"
+
+# A value is only chosen over one that makes fewer concurrent queries if it is at least this much faster
+_MIN_SPEEDUP = .1
+# A summary size is too small if more than 10% of summaries use more than _FULL_SUMMARY of it
+_SUMMARY_PERCENTILE = .9
+_FULL_SUMMARY = .9
+# The final analysis is allowed this much more than the longest analysis seen while tuning
+_RESPONSE_MARGIN = 1.25
+
+
+def _ints(s):
+    return [int(v) for v in s.split(",")]
+
+
+def _floats(s):
+    return [float(v) for v in s.split(",")]
+
+
+def add_to_command_parser(subparsers):
+    parser = subparsers.add_parser(command, help=help)
+    parser.add_argument("-r", "--run", action="append", default=[], dest="runs", metavar="RUN",
+                        help="""An archived run whose command output to tune with. May be given more than once. RUN is
+                        a run ID, or a unique prefix of one, or 'last' for the most recent run, which is the default.
+                        The final analyses recorded in the runs are used to tune the size allowed for the analysis.""")
+    parser.add_argument("--max-commands", type=int, default=10,
+                        help="""Tune with the output of at most this many commands from each run, those with the
+                        largest output, to limit the number of LLM queries made""")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 2, 4, 8], metavar="N,...",
+                        help="The numbers of concurrent queries to try. Default: 1,2,4,8")
+    parser.add_argument("--chunk-fractions", type=_floats, default=[.5, .75, 1], metavar="F,...",
+                        help="The fractions of the prompt to fill with each chunk of large outputs to try. "
+                             "Default: .5,.75,1")
+    parser.add_argument("--summary-fractions", type=_floats, default=[.05, .1, .15, .2], metavar="F,...",
+                        help="The fractions of the context window to allow a command summary to try, when no size "
+                             "is given for it, e.g. by analyzecmd. Default: .05,.1,.15,.2")
+    parser.add_argument("--no-save", action="store_true", default=False,
+                        help="Report the tuned values without saving them in ~/.sysgrok/models.json")
+
+
+def _load_inputs(runs, max_commands):
+    """Load the command output, and final analyses, recorded in archived runs.
+
+    Returns:
+        (list, list): A list of (problem description, command output) tuples, one for each run, where the
+            command output is a dictionary mapping commands to CommandResults, and a list of the responses
+            to the final analysis prompts sent in the runs.
+    """
+
+    inputs = []
+    responses = []
+    for run in runs:
+        run_archive = open_run(run)
+        problem_description = run_archive.meta["args"].get("problem_description")
+        command_output = load_commands_archived(run)
+        largest = sorted(command_output.items(), key=lambda co: len(co[1].stdout_buffer), reverse=True)
+        if largest:
+            inputs.append((problem_description, dict(largest[:max_commands])))
+        for query in run_archive.llm_queries():
+            if example_response in query["messages"][-1]["content"]:
+                responses.append(query["response"])
+    return inputs, responses
+
+
+def _measure(describe, f):
+    """Call f, with a budget of its own so that we can measure how many LLM calls and tokens it uses, and log
+    how long it took and what it used.
+
+    Returns:
+        (object, float, int, int): What f returned, and the seconds, LLM calls and tokens it used. If f
+            fails with an error that may be caused by the load it puts on the endpoint, e.g. a rate limit, then
+            what it returned is None and the seconds are infinite.
+    """
+
+    run_budget = llm.get_budget()
+    budget = llm.Budget(max_tokens=run_budget.remaining_tokens(), max_calls=run_budget.remaining_calls(),
+                        deadline=run_budget.deadline)
+    llm.set_budget(budget)
+    start = time.time()
+    try:
+        result = f()
+        seconds = time.time() - start
+    except RETRYABLE_ERRORS as e:
+        logging.warning(f"{describe}: failed with {e}")
+        result = None
+        seconds = math.inf
+    finally:
+        run_budget.merge(budget)
+        llm.set_budget(run_budget)
+
+    logging.info(f"{describe}: {seconds:.1f}s, {budget.calls_used} LLM calls, {budget.tokens_used} tokens")
+    return result, seconds, budget.calls_used, budget.tokens_used
+
+
+def _summarise_all(inputs):
+    return [(problem_description, get_command_summaries(command_output, problem_description, cache=False))
+            for problem_description, command_output in inputs]
+
+
+def _tune_concurrency(inputs, values):
+    """Returns the number of concurrent queries that summarises the inputs fastest, or None if every trial
+    failed, and the summaries
+    """
+
+    results = []
+    summaries = None
+    for n in values:
+        llm.set_max_concurrent_queries(n)
+        result, seconds, _, _ = _measure(f"{n} concurrent queries", lambda: _summarise_all(inputs))
+        results.append((n, seconds))
+        summaries = result or summaries
+
+    fastest = min(seconds for _, seconds in results)
+    if math.isinf(fastest):
+        logging.info("Summarising failed with every number of concurrent queries. Not tuning it.")
+        return None, summaries
+    # More concurrency makes rate limiting more likely, so the least that is nearly as fast as the best is chosen
+    return min(n for n, seconds in results if seconds <= fastest * (1 + _MIN_SPEEDUP)), summaries
+
+
+def _tune_chunk_fraction(model, inputs, values):
+    """Returns the chunk fraction that summarises the outputs in inputs that have to be chunked fastest, or
+    None if none of them do.
+    """
+
+    chunked = [(p, {c: o for c, o in outputs.items() if estimate_summary_cost(o)[1] > 1}) for p, outputs in inputs]
+    chunked = [(p, outputs) for p, outputs in chunked if outputs]
+    if not chunked:
+        logging.info("None of the outputs are large enough to be chunked. Not tuning the chunk fraction.")
+        return None
+
+    results = []
+    for fraction in values:
+        set_model_fields(model, chunk_fraction=fraction)
+        _, seconds, calls, _ = _measure(f"Chunk fraction {fraction}", lambda: _summarise_all(chunked))
+        results.append((seconds, calls, fraction))
+
+    # Output that is large enough to be chunked may not be once it is compacted
+    if all(calls <= sum(len(outputs) for _, outputs in chunked) for _, calls, _ in results):
+        logging.info("None of the outputs were chunked. Not tuning the chunk fraction.")
+        return None
+    return min(results)[2]
+
+
+def _tune_summary_fraction(model, inputs, values):
+    """Returns the smallest summary fraction that is large enough for most summaries of the outputs in inputs,
+    i.e. that the LLM does not have to cut short, or None if all of the outputs are summarised locally.
+    """
+
+    commands = [(p, c, o) for p, outputs in inputs for c, o in outputs.items() if not summarise_command_locally(c, o)]
+    if not commands:
+        logging.info("All of the outputs are summarised locally. Not tuning the summary fraction.")
+        return None
+
+    for fraction in sorted(values):
+        set_model_fields(model, summary_fraction=fraction)
+        with llm.phase(llm.PHASE_COMMAND_SUMMARY):
+            max_chars = int(llm.get_model_max_tokens() * fraction * llm.get_prose_char_token_ratio())
+        summaries, _, _, _ = _measure(f"Summary fraction {fraction}",
+                                      lambda: [summarise_command(c, o, problem_description=p, cache=False)[1]
+                                               for p, c, o in commands])
+        if summaries is None:
+            continue
+        usage = sorted(len(s) / max_chars for s in summaries)
+        percentile = usage[min(len(usage) - 1, int(len(usage) * _SUMMARY_PERCENTILE))]
+        logging.info(f"Summary fraction {fraction}: {100 * _SUMMARY_PERCENTILE:.0f}% of summaries use "
+                     f"{100 * percentile:.0f}% or less of the {max_chars} characters allowed")
+        if percentile <= _FULL_SUMMARY:
+            return fraction
+    return max(values)
+
+
+@llm.phase(llm.PHASE_ANALYSIS)
+def _tune_response_factor(responses, summaries):
+    """Returns a response factor that allows for the longest of the final analyses, those recorded in the runs
+    and those of the summaries made while tuning.
+    """
+
+    for problem_description, command_summaries in summaries or []:
+        cs_str = "\n".join(f"Summary for '{c}': {s}" for c, s in command_summaries)
+        if problem_description:
+            prompt = analyse_summaries_prompt_with_problem.format(response=example_response,
+                                                                  problem=problem_description, command_summaries=cs_str)
+        else:
+            prompt = analyse_summaries_prompt_without_problem.format(response=example_response,
+                                                                     command_summaries=cs_str)
+        response, _, _, _ = _measure("Final analysis", lambda: llm.get_llm_response(prompt))
+        if response is not None:
+            responses.append(response)
+
+    if not responses:
+        logging.info("There are no final analyses to tune the response factor with")
+        return None
+    example_tokens = llm.get_token_count(example_response)
+    longest = max(llm.get_token_count(r) for r in responses) / example_tokens
+    logging.info(f"The longest of {len(responses)} final analyses is {longest:.1f} times the size of the example")
+    # Rounded up to a multiple of .5, so that tuning again with similar analyses gives the same value
+    return max(math.ceil(longest * _RESPONSE_MARGIN * 2) / 2, 1)
+
+
+def run(args_parser, args):
+    if args.chat:
+        logging.error(f"Chat not implemented for {command}")
+        sys.exit(1)
+
+    if llm.get_dry_run():
+        logging.error(f"{command} measures how the LLM responds, so it cannot be used with --dry-run")
+        return -1
+
+    try:
+        inputs, responses = _load_inputs(args.runs or ["last"], args.max_commands)
+    except ValueError as e:
+        logging.error(e)
+        return -1
+    if not inputs:
+        logging.error("The runs did not record any command output to tune with")
+        return -1
+
+    # Every trial must query the LLM, rather than reusing responses from earlier trials
+    llm.set_similarity_threshold(None)
+
+    models = {}
+    with llm.phase(llm.PHASE_CHUNK_SUMMARY):
+        models["chunk_fraction"] = llm.get_model()
+    with llm.phase(llm.PHASE_COMMAND_SUMMARY):
+        models["summary_fraction"] = llm.get_model()
+    with llm.phase(llm.PHASE_ANALYSIS):
+        models["response_factor"] = llm.get_model()
+    models["max_concurrent_queries"] = llm.get_model()
+    unknown = [model for model in models.values() if get_model_info(model) is None]
+    if unknown:
+        logging.error(f"Unknown model: {unknown[0]}. Add it to ~/.sysgrok/models.json to tune it.")
+        return -1
+    previous = {field: getattr(get_model_info(model), field) for field, model in models.items()}
+
+    # Each parameter is tuned in turn, with those tuned before it set to their tuned values
+    tuned = {}
+    tuned["max_concurrent_queries"], summaries = _tune_concurrency(inputs, args.concurrency)
+    llm.set_max_concurrent_queries(tuned["max_concurrent_queries"] or previous["max_concurrent_queries"])
+    tuned["chunk_fraction"] = _tune_chunk_fraction(models["chunk_fraction"], inputs, args.chunk_fractions)
+    set_model_fields(models["chunk_fraction"], chunk_fraction=tuned["chunk_fraction"] or previous["chunk_fraction"])
+    tuned["summary_fraction"] = _tune_summary_fraction(models["summary_fraction"], inputs, args.summary_fractions)
+    set_model_fields(models["summary_fraction"],
+                     summary_fraction=tuned["summary_fraction"] or previous["summary_fraction"])
+    tuned["response_factor"] = _tune_response_factor(responses, summaries)
+
+    by_model = {}
+    for field, value in tuned.items():
+        if value is None:
+            print(f"{models[field]}: {field} not tuned")
+            continue
+        was = previous[field] if previous[field] is not None else "not set"
+        print(f"{models[field]}: {field} = {value} (was {was})")
+        by_model.setdefault(models[field], {})[field] = value
+
+    if not args.no_save:
+        for model, fields in by_model.items():
+            save_model_fields(model, **fields)
+    return 0
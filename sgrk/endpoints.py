@@ -0,0 +1,191 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import time
+
+from collections import deque
+from dataclasses import dataclass, field
+
+import openai
+
+# Errors after which the same query may succeed if it is sent to another endpoint
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+# How long an endpoint is avoided for after it fails. This doubles with each consecutive failure.
+_COOLDOWN_SECONDS = 2
+_MAX_COOLDOWN_SECONDS = 120
+# How long an endpoint is avoided for after it tells us we have exceeded its rate limit
+_RATE_LIMIT_COOLDOWN_SECONDS = 20
+# The weight of the most recent latency in each endpoint's moving average latency
+_LATENCY_EWMA_WEIGHT = .3
+
+
+class NoEndpointError(Exception):
+    """Raised when none of the configured endpoints serve the model a query is for"""
+
+
+@dataclass
+class Endpoint:
+    """An API endpoint that LLM queries can be sent to: an OpenAI API key, or an Azure OpenAI resource.
+
+    Fields are as for the GAI_ environment variables. api_key may be given as "$VAR" to read it from the
+    environment variable VAR. For Azure, deployments maps model names to the deployment IDs that serve them.
+    If models is set then the endpoint is only used for those models. tokens_per_minute is the endpoint's
+    quota, if it has one.
+    """
+
+    name: str
+    api_type: str
+    api_key: str
+    api_base: str = None
+    api_version: str = None
+    deployments: dict = field(default_factory=dict)
+    models: list = None
+    tokens_per_minute: int = None
+
+    latency: float = None
+    failures: int = 0
+    cooldown_until: float = 0
+    usage: deque = field(default_factory=deque)
+
+    def __post_init__(self):
+        if self.api_key and self.api_key.startswith("$"):
+            self.api_key = os.environ.get(self.api_key[1:])
+        if self.api_type == "azure" and not (self.api_base and self.api_version):
+            raise ValueError(f"Endpoint {self.name}: Azure requires the API base and version to be set")
+        if self.api_type not in ("azure", "open_ai"):
+            raise ValueError(f"Endpoint {self.name}: invalid api_type '{self.api_type}'. Must be azure or open_ai.")
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def request_args(self, model):
+        """Returns the arguments to openai.ChatCompletion.create that send a query for model to this endpoint"""
+
+        args = {"api_key": self.api_key, "api_type": self.api_type}
+        if self.api_type == "azure":
+            args.update(api_base=self.api_base, api_version=self.api_version,
+                        deployment_id=self.deployments.get(model, model))
+        else:
+            args["model"] = model
+        return args
+
+    def remaining_quota(self):
+        """Returns the number of tokens left in the endpoint's quota for the current minute, as far as this
+        process knows, or None if it has no quota.
+        """
+
+        if self.tokens_per_minute is None:
+            return None
+        while self.usage and self.usage[0][0] < time.time() - 60:
+            self.usage.popleft()
+        return self.tokens_per_minute - sum(tokens for _, tokens in self.usage)
+
+
+class EndpointPool:
+    """Distributes LLM queries between several endpoints. Each query is sent to the available endpoint with
+    the lowest recent latency, skipping those that have recently failed or that do not have enough of their
+    quota left. Endpoints that have not been used yet are tried first, so that we learn their latency.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+
+    def select(self, model, tokens, exclude=()):
+        """Select the endpoint to send a query for model, of about tokens tokens, to.
+
+        Returns:
+            Endpoint: The endpoint, or None if none of the endpoints that serve model, other than those in exclude,
+                are available, because they are cooling down after failing. See available_at.
+        """
+
+        now = time.time()
+        candidates = [e for e in self.endpoints
+                      if e.serves(model) and e.name not in exclude and e.cooldown_until <= now]
+        with_quota = [e for e in candidates if e.remaining_quota() is None or e.remaining_quota() >= tokens]
+        if with_quota:
+            return min(with_quota, key=lambda e: e.latency or 0)
+        # All of the endpoints are short of quota. The one with the most left is the most likely to accept it.
+        return max(candidates, key=lambda e: e.remaining_quota(), default=None)
+
+    def serves(self, model):
+        return any(e.serves(model) for e in self.endpoints)
+
+    def available_at(self, model, exclude=()):
+        """Returns the time at which the first of the endpoints that serve model, other than those in exclude,
+        will have finished cooling down, or None if there are no such endpoints.
+        """
+
+        return min((e.cooldown_until for e in self.endpoints if e.serves(model) and e.name not in exclude),
+                   default=None)
+
+    def report_success(self, endpoint, seconds, tokens):
+        endpoint.failures = 0
+        if endpoint.latency is None:
+            endpoint.latency = seconds
+        else:
+            endpoint.latency = _LATENCY_EWMA_WEIGHT * seconds + (1 - _LATENCY_EWMA_WEIGHT) * endpoint.latency
+        endpoint.usage.append((time.time(), tokens))
+
+    def report_cancelled(self, endpoint, tokens):
+        """Report a query that was cancelled, e.g. because a duplicate of it completed first. Its prompt still
+        counts towards the endpoint's quota. How long it had taken is not a latency, as it did not complete.
+        """
+
+        endpoint.usage.append((time.time(), tokens))
+
+    def report_failure(self, endpoint, error):
+        endpoint.failures += 1
+        if isinstance(error, openai.error.RateLimitError):
+            cooldown = _RATE_LIMIT_COOLDOWN_SECONDS
+        else:
+            cooldown = min(_COOLDOWN_SECONDS ** endpoint.failures, _MAX_COOLDOWN_SECONDS)
+        endpoint.cooldown_until = time.time() + cooldown
+        logging.warning(f"LLM query to endpoint {endpoint.name} failed. Not using it for {cooldown}s. Error: {error}")
+
+    @classmethod
+    def from_config(cls, config, quota_share=1):
+        """Create a pool from a list of dictionaries with the fields of Endpoint.
+
+        Each process keeps track of the quota it has used itself, so processes that query the endpoints at
+        the same time, e.g. the workers that summarise commands, must each be given a share of each quota.
+
+        Args:
+            config (list): The endpoints
+            quota_share (int): The number of processes sharing the endpoints. Each endpoint's tokens_per_minute
+                is divided by this.
+
+        Raises:
+            ValueError: If config is not a valid list of endpoints
+        """
+
+        try:
+            endpoints = [Endpoint(**e) for e in config]
+        except TypeError as e:
+            raise ValueError(f"Invalid endpoint: {e}")
+        for e in endpoints:
+            if e.tokens_per_minute is not None:
+                e.tokens_per_minute //= quota_share
+        return cls(endpoints)
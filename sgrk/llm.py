@@ -15,21 +15,55 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import asyncio
+import hashlib
+import json
+import os
 import sys
 import logging
+import math
+import re
+import threading
+import time
 
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 import openai
 import tiktoken
 
+from sgrk.archive import data_dir, get_run_archive
+from sgrk.endpoints import RETRYABLE_ERRORS, EndpointPool, NoEndpointError
+from sgrk.models import ModelInfo, get_model_info, models_path, select_model_for_tokens
+from sgrk import profiling, simindex
+
 
 @dataclass
 class LLMConfig:
     model: str
     temperature: float
+    # If None, the value tuned for the model is used. See get_max_concurrent_queries.
     max_concurrent_queries: int
     output_format: str
+    similarity_threshold: float = None
+    # Maps phases (see PHASES) to the model to use for that phase, instead of model
+    phase_models: dict = field(default_factory=dict)
+    # Models with larger context windows that may be used instead of chunking output that is too large
+    # for the configured model
+    large_context_models: list = field(default_factory=list)
+    # If set, a query that takes longer than this percentile of the recent latencies of its model is
+    # duplicated, and whichever copy finishes first is used. The duplicate goes to hedge_model, if set.
+    hedge_percentile: float = None
+    hedge_model: str = None
+    # A list of dictionaries describing the API endpoints to send queries to, if there are several of them.
+    # See endpoints.Endpoint. If not set then the endpoint configured in the openai module is used.
+    endpoints: list = None
+    # The maximum number of chunks of a command's output to summarise. If the output has more chunks then
+    # only those ranked as the most informative are summarised. See cmdfilter.score_chunks.
+    max_chunks_per_command: int = None
+    # If true, no queries are sent to the LLM. Each is answered with a placeholder the size the response is
+    # expected to be, and the calls and tokens it would have used are recorded. See dry_run_report.
+    dry_run: bool = False
 
 
 config = None
@@ -57,6 +91,51 @@ def get_output_format():
     return config.output_format
 
 
+# The phases of a run that can each use a different model. Summarising chunks of output and summarising
+# each command make the most LLM queries, so they benefit most from a fast model, while planning which
+# commands to run and the final analysis benefit most from a strong one.
+PHASE_PLAN = "plan"
+PHASE_CHUNK_SUMMARY = "chunk-summary"
+PHASE_COMMAND_SUMMARY = "command-summary"
+PHASE_ANALYSIS = "analysis"
+PHASES = (PHASE_PLAN, PHASE_CHUNK_SUMMARY, PHASE_COMMAND_SUMMARY, PHASE_ANALYSIS)
+
+# The phase and model override are per thread, as the LLM may be queried from more than one thread
+# at a time, e.g. in pipeline
+_context = threading.local()
+
+
+@contextmanager
+def phase(p):
+    """Context manager, or function decorator, that sets the phase of the run. While it is active,
+    get_model, and everything that depends on the model such as get_model_max_tokens, return the
+    values for the model configured for that phase, if there is one.
+    """
+
+    previous = get_phase()
+    _context.phase = p
+    try:
+        yield
+    finally:
+        _context.phase = previous
+
+
+def get_phase():
+    return getattr(_context, "phase", None)
+
+
+@contextmanager
+def use_model(m):
+    """Context manager that makes get_model return m, regardless of the configured model or phase"""
+
+    previous = getattr(_context, "model_override", None)
+    _context.model_override = m
+    try:
+        yield
+    finally:
+        _context.model_override = previous
+
+
 def set_model(m):
     global config
     logging.debug(f"Setting model to {m}")
@@ -64,8 +143,10 @@ def set_model(m):
 
 
 def get_model():
-    logging.debug(f"Retrieved model: {config.model}")
-    return config.model
+    current_phase = get_phase()
+    model = getattr(_context, "model_override", None) or config.phase_models.get(current_phase, config.model)
+    logging.debug(f"Retrieved model: {model} (phase: {current_phase})")
+    return model
 
 
 def set_temperature(t):
@@ -79,6 +160,10 @@ def get_temperature():
     return config.temperature
 
 
+# The maximum number of concurrent queries if it is neither configured nor tuned for the model
+_DEFAULT_MAX_CONCURRENT_QUERIES = 4
+
+
 def set_max_concurrent_queries(m):
     global config
     logging.debug(f"Setting max concurrent queries to {m}")
@@ -86,21 +171,318 @@ def set_max_concurrent_queries(m):
 
 
 def get_max_concurrent_queries():
-    logging.debug(f"Retrieved max concurrent queries {config.max_concurrent_queries}")
-    return config.max_concurrent_queries
+    """Returns the maximum number of concurrent LLM queries. If it is not configured, then this is the value
+    tuned for the model (see the tune command), or _DEFAULT_MAX_CONCURRENT_QUERIES if it has not been tuned.
+    """
+
+    max_concurrent_queries = config.max_concurrent_queries
+    if max_concurrent_queries is None:
+        info = get_model_info(get_model())
+        max_concurrent_queries = (info and info.max_concurrent_queries) or _DEFAULT_MAX_CONCURRENT_QUERIES
+    logging.debug(f"Retrieved max concurrent queries {max_concurrent_queries}")
+    return max_concurrent_queries
+
+
+def _get_model_setting(name):
+    """Returns a field of the current model's ModelInfo, or its default if the model is unknown"""
+
+    info = get_model_info(get_model())
+    return getattr(info if info else ModelInfo, name)
+
+
+def get_summary_fraction():
+    """Returns the fraction of the context window a command summary may use, when no size is given for it"""
+
+    return _get_model_setting("summary_fraction")
+
+
+def get_response_factor():
+    """Returns how many times the size of the example response the final analysis is allowed"""
+
+    return _get_model_setting("response_factor")
+
+
+def get_chunk_fraction():
+    """Returns the fraction of the space left in the prompt that each chunk of a command's output fills"""
+
+    return _get_model_setting("chunk_fraction")
+
+
+def get_max_chunks_per_command():
+    logging.debug(f"Retrieved max chunks per command {config.max_chunks_per_command}")
+    return config.max_chunks_per_command
+
+
+def get_dry_run():
+    return config.dry_run
+
+
+def set_similarity_threshold(t):
+    global config
+    logging.debug(f"Setting similarity threshold to {t}")
+    config.similarity_threshold = t
+
+
+def get_similarity_threshold():
+    logging.debug(f"Retrieved similarity threshold: {config.similarity_threshold}")
+    return config.similarity_threshold
+
+
+class BudgetExhaustedError(Exception):
+    """Raised when an LLM call cannot be made without exceeding the run's budget"""
+
+
+@dataclass
+class Budget:
+    """Limits on the wall time, tokens and LLM calls that a sysgrok run may use, along with a record
+    of how much has been used so far. A limit of None means unlimited.
+
+    Work that is farmed out to other processes is given its own Budget via split(). Once that
+    work is done its usage is added back to the parent Budget via merge().
+    """
+
+    max_seconds: float = None
+    max_tokens: int = None
+    max_calls: int = None
+    deadline: float = None
+    tokens_used: int = 0
+    calls_used: int = 0
+    # Maps (phase, model) to [calls, prompt tokens, response tokens] for the queries answered in a dry run
+    dry_run_usage: dict = field(default_factory=dict)
+
+    def start(self):
+        if self.max_seconds is not None:
+            self.deadline = time.time() + self.max_seconds
+        return self
+
+    def remaining_seconds(self):
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def remaining_tokens(self):
+        if self.max_tokens is None:
+            return None
+        return max(0, self.max_tokens - self.tokens_used)
+
+    def remaining_calls(self):
+        if self.max_calls is None:
+            return None
+        return max(0, self.max_calls - self.calls_used)
+
+    def exhausted(self):
+        return 0 in (self.remaining_seconds(), self.remaining_tokens(), self.remaining_calls())
+
+    def check(self, prompt_tokens=0):
+        """Raise a BudgetExhaustedError if there is not enough budget left to send a prompt with
+        prompt_tokens tokens to the LLM."""
+
+        if self.remaining_seconds() == 0:
+            raise BudgetExhaustedError("time limit reached")
+        if self.remaining_calls() == 0:
+            raise BudgetExhaustedError(f"limit of {self.max_calls} LLM calls reached")
+        remaining_tokens = self.remaining_tokens()
+        if remaining_tokens is not None and remaining_tokens <= prompt_tokens:
+            raise BudgetExhaustedError(f"limit of {self.max_tokens} tokens reached")
+
+    def charge(self, tokens):
+        self.calls_used += 1
+        self.tokens_used += tokens
+
+    def split(self, weights, reserve_tokens=0, reserve_calls=0):
+        """Divide the remaining budget between len(weights) pieces of work, in proportion to their
+        weights, after setting aside reserve_tokens and reserve_calls for the caller. Each child
+        shares the parent's deadline.
+        """
+
+        total = sum(weights) or 1
+        remaining_tokens = self.remaining_tokens()
+        remaining_calls = self.remaining_calls()
+        children = []
+        for w in weights:
+            child = Budget(deadline=self.deadline)
+            if remaining_tokens is not None:
+                child.max_tokens = int(max(0, remaining_tokens - reserve_tokens) * w / total)
+            if remaining_calls is not None:
+                child.max_calls = max(0, remaining_calls - reserve_calls) // len(weights)
+            children.append(child)
+        return children
+
+    def merge(self, child):
+        self.tokens_used += child.tokens_used
+        self.calls_used += child.calls_used
+        for key, usage in child.dry_run_usage.items():
+            totals = self.dry_run_usage.setdefault(key, [0, 0, 0])
+            for i, n in enumerate(usage):
+                totals[i] += n
+
+
+# The budget for the current process. Unlimited unless set_budget is called.
+_budget = Budget()
+
+
+def set_budget(b):
+    global _budget
+    logging.debug(f"Setting LLM budget to: {b}")
+    _budget = b
+
+
+def get_budget():
+    return _budget
+
+
+@dataclass
+class PromptStats:
+    """Records the prompt prefixes sent to the LLM, and how often calls repeat the prefix of an earlier
+    call. Providers only cache prompt prefixes of 1024 tokens or more, which the prefixes used here are
+    usually shorter than, so this measures how stable the prompts are rather than how many were cached.
+    """
+
+    # Maps a hash of each prefix to a [token count, number of calls] pair
+    prefixes: dict = field(default_factory=dict)
+    calls: int = 0
+
+    def record(self, prefix, tokens):
+        self.calls += 1
+        if not prefix:
+            return
+        key = hashlib.sha256(prefix.encode()).hexdigest()
+        self.prefixes.setdefault(key, [tokens, 0])[1] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        for key, (tokens, count) in other.prefixes.items():
+            self.prefixes.setdefault(key, [tokens, 0])[1] += count
+
+    def reused_prefix_calls(self):
+        """The number of calls which repeated the prefix of an earlier call"""
+
+        return sum(count - 1 for _, count in self.prefixes.values())
+
+    def reused_prefix_tokens(self):
+        """The number of prompt tokens sent which repeated the prefix of an earlier call"""
+
+        return sum(tokens * (count - 1) for tokens, count in self.prefixes.values())
+
+    def total_prefix_tokens(self):
+        return sum(tokens * count for tokens, count in self.prefixes.values())
+
+
+_prompt_stats = PromptStats()
+
+
+def set_prompt_stats(s):
+    global _prompt_stats
+    _prompt_stats = s
+
+
+def get_prompt_stats():
+    return _prompt_stats
+
+
+@dataclass
+class LatencyStats:
+    """The most recent latencies, in seconds, of the LLM queries to each model. These are persisted
+    between runs, in latency_path, so that we know what a normal latency is from the start of a run.
+    Latencies recorded in this process are also kept in new_samples, so that they can be merged into
+    the stats of the parent process when used in a worker process.
+    """
+
+    latencies: dict = field(default_factory=dict)
+    new_samples: list = field(default_factory=list)
+
+    def record(self, model, seconds):
+        self.new_samples.append((model, seconds))
+        history = self.latencies.setdefault(model, [])
+        history.append(seconds)
+        del history[:-_LATENCY_HISTORY]
+
+    def merge(self, other):
+        for model, seconds in other.new_samples:
+            self.record(model, seconds)
+
+    def for_worker(self):
+        """Returns a copy of these stats, without the new samples, to give to a worker process"""
+
+        return LatencyStats({m: list(h) for m, h in self.latencies.items()})
+
+    def percentile(self, model, p):
+        """Returns the pth percentile of the recent latencies of model, or None if there are too
+        few of them to tell.
+        """
+
+        history = sorted(self.latencies.get(model, []))
+        if len(history) < _LATENCY_MIN_SAMPLES:
+            return None
+        return history[min(len(history) - 1, int(len(history) * p / 100))]
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(latency_path) as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self):
+        tmp_path = f"{latency_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(data_dir, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self.latencies, f)
+            os.replace(tmp_path, latency_path)
+        except OSError as e:
+            logging.warning(f"Failed to save LLM latencies to {latency_path}: {e}")
+
+
+latency_path = os.path.join(data_dir, "latency.json")
+# The number of recent latencies kept per model, and the number needed before we hedge queries to it
+_LATENCY_HISTORY = 200
+_LATENCY_MIN_SAMPLES = 10
+# Never hedge a query that has taken less than this many seconds
+_HEDGE_MIN_DELAY = 2
+
+_latency_stats = LatencyStats()
+
+
+def set_latency_stats(s):
+    global _latency_stats
+    _latency_stats = s
+
+
+def get_latency_stats():
+    return _latency_stats
+
+
+# What is assumed about models that are not in the registry, e.g. Azure deployment IDs that are not named
+# after the model they deploy
+_DEFAULT_CONTEXT_TOKENS = 4096
+_DEFAULT_TOKENIZER = "cl100k_base"
+_warned_unknown_models = set()
+
+
+def _warn_unknown_model(model):
+    if model not in _warned_unknown_models:
+        _warned_unknown_models.add(model)
+        logging.warning(f"Unknown model: {model}. Assuming a context window of {_DEFAULT_CONTEXT_TOKENS} tokens and "
+                        f"the {_DEFAULT_TOKENIZER} tokenizer. Add it to {models_path} to describe it.")
 
 
 def get_model_max_tokens():
     model = get_model()
-    if model == "gpt-3.5-turbo":
-        return 4096
-    elif model == "gpt-4":
-        return 8192
-    elif model == "gpt-4-32k":
-        return 32768
-    else:
-        logging.error(f"Unknown model: {model}")
-        sys.exit(-1)
+    info = get_model_info(model)
+    if not info:
+        _warn_unknown_model(model)
+        return _DEFAULT_CONTEXT_TOKENS
+    return info.context_tokens
+
+
+def get_large_context_model(tokens):
+    """Returns the cheapest of the configured large context models that can fit tokens tokens in its
+    context window, or None if there is no such model.
+    """
+
+    return select_model_for_tokens(config.large_context_models, tokens)
 
 
 def get_base_messages():
@@ -121,14 +503,37 @@ def get_base_messages():
     return messages
 
 
+_encodings = {}
+
+
+def _get_encoding(model):
+    if model in _encodings:
+        return _encodings[model]
+
+    info = get_model_info(model)
+    tokenizer = info.tokenizer if info else _DEFAULT_TOKENIZER
+    if not info:
+        _warn_unknown_model(model)
+    try:
+        enc = tiktoken.get_encoding(tokenizer)
+    except ValueError:
+        # Older versions of tiktoken do not have the encodings of newer models. Those encodings have
+        # similar token counts to cl100k_base, which is good enough for our estimates.
+        logging.warning(f"Tokenizer {tokenizer} is not available. Using cl100k_base for {model}.")
+        enc = tiktoken.get_encoding("cl100k_base")
+    _encodings[model] = enc
+    return enc
+
+
+@profiling.span(profiling.SPAN_TOKEN_COUNTING)
 def get_token_count(data):
-    enc = tiktoken.encoding_for_model(get_model())
+    enc = _get_encoding(get_model())
     return len(enc.encode(data))
 
 
-# Global record of the character to token ratio for the current model. Allows us to
-# calculate it once and then reuse it as necessary.
-_command_char_token_ratio = None
+# Global record of the character to token ratio for each model. Allows us to calculate it
+# once and then reuse it as necessary.
+_command_char_token_ratios = {}
 
 
 def get_command_char_token_ratio():
@@ -136,10 +541,10 @@ def get_command_char_token_ratio():
     calculated by applying tiktoken to sample output from the `top` command.
     """
 
-    global _command_char_token_ratio
-    if _command_char_token_ratio:
-        logging.debug(f"Returning character token ratio for Linux commands: {_command_char_token_ratio}")
-        return _command_char_token_ratio
+    model = get_model()
+    if model in _command_char_token_ratios:
+        logging.debug(f"Returning character token ratio for Linux commands: {_command_char_token_ratios[model]}")
+        return _command_char_token_ratios[model]
 
     top_output = """top - 13:23:34 up  3:37,  1 user,  load average: 0.00, 0.00, 0.00
 Tasks: 106 total,   1 running, 105 sleeping,   0 stopped,   0 zombie
@@ -187,14 +592,42 @@ MiB Swap:      0.0 total,      0.0 free,      0.0 used.   3388.5 avail Mem
      43 root       0 -20       0      0      0 I   0.0   0.0   0:00.00 md
      44 root       0 -20       0      0      0 I   0.0   0.0   0:00.00 edac-poller"""
 
-    _command_char_token_ratio = len(top_output) / get_token_count(top_output)
-    logging.debug(f"Returning character token ratio for Linux commands: {_command_char_token_ratio}")
-    return _command_char_token_ratio
+    _command_char_token_ratios[model] = len(top_output) / get_token_count(top_output)
+    logging.debug(f"Returning character token ratio for Linux commands: {_command_char_token_ratios[model]}")
+    return _command_char_token_ratios[model]
+
 
+# The character to token ratio of a command's output is measured on a sample of up to this many characters
+_RATIO_SAMPLE_CHARS = 20000
+_RATIO_SAMPLES = 4
+
+
+def measure_char_token_ratio(text):
+    """Returns the character:token ratio of text, such as the output of a command after it has been
+    compacted, which can differ a lot from that of the sample output used by get_command_char_token_ratio.
+    text may also be an outputbuf.OutputBuffer, in which case only the samples are decoded.
+    Long text is sampled at _RATIO_SAMPLES evenly spaced points. The ratio is rounded down to a multiple
+    of .25, so that it is the same for output that has changed a little, e.g. a log that has grown.
+    """
 
-# Global record of the character to token ratio for the current model for English prose. Allows us to
+    if not text:
+        return get_command_char_token_ratio()
+
+    if len(text) > _RATIO_SAMPLE_CHARS:
+        sample_len = _RATIO_SAMPLE_CHARS // _RATIO_SAMPLES
+        step = len(text) // _RATIO_SAMPLES
+        sample = "".join(text[i * step:i * step + sample_len] for i in range(_RATIO_SAMPLES))
+    else:
+        sample = str(text)
+
+    ratio = max(math.floor(len(sample) / get_token_count(sample) * 4) / 4, .25)
+    logging.debug(f"Measured character token ratio: {ratio}")
+    return ratio
+
+
+# Global record of the character to token ratio for each model for English prose. Allows us to
 # calculate it once and then reuse it as necessary.
-_prose_char_token_ratio = None
+_prose_char_token_ratios = {}
 
 
 def get_prose_char_token_ratio():
@@ -202,10 +635,10 @@ def get_prose_char_token_ratio():
     sample text (which is actually GPT-4 generated text in a command summarisation use case).
     """
 
-    global _prose_char_token_ratio
-    if _prose_char_token_ratio:
-        logging.debug(f"Returning prose token ratio for English prose: {_prose_char_token_ratio}")
-        return _prose_char_token_ratio
+    model = get_model()
+    if model in _prose_char_token_ratios:
+        logging.debug(f"Returning prose token ratio for English prose: {_prose_char_token_ratios[model]}")
+        return _prose_char_token_ratios[model]
 
     sample_prose = """The system has been up for 5 hours and 15 minutes with 0 users logged in. The load
     average is low (0.09, 0.04, 0.01), indicating that the system is not under heavy load. The CPU usage
@@ -217,19 +650,43 @@ def get_prose_char_token_ratio():
     of CPU or memory resources. In conclusion, the system is currently stable and not experiencing any
     performance issues."""
 
-    _prose_char_token_ratio = len(sample_prose) / get_token_count(sample_prose)
-    logging.debug(f"Returning prose token ratio for Linux commands: {_prose_char_token_ratio}")
-    return _prose_char_token_ratio
+    _prose_char_token_ratios[model] = len(sample_prose) / get_token_count(sample_prose)
+    logging.debug(f"Returning prose token ratio for Linux commands: {_prose_char_token_ratios[model]}")
+    return _prose_char_token_ratios[model]
 
 
-def get_chat_completion_args(messages, stream=False):
+def _get_messages_token_count(messages):
+    return sum(get_token_count(m["content"]) for m in messages)
+
+
+def get_chat_completion_args(messages, stream=False, endpoint=None):
     kwargs = {
         "temperature": get_temperature(),
         "messages": messages,
         "stream": stream
     }
 
-    if openai.api_type == "azure":
+    # Make sure a single call cannot take us past the budget
+    remaining_seconds = _budget.remaining_seconds()
+    if remaining_seconds is not None:
+        kwargs["request_timeout"] = remaining_seconds
+    remaining_tokens = _budget.remaining_tokens()
+    if remaining_tokens is not None:
+        prompt_tokens = _get_messages_token_count(messages)
+        _budget.check(prompt_tokens)
+        # Unless the budget is the tighter limit, the response is only limited by the model's context window,
+        # which the API applies itself
+        if remaining_tokens < get_model_max_tokens():
+            kwargs["max_tokens"] = remaining_tokens - prompt_tokens
+    else:
+        _budget.check()
+    max_output_tokens = _get_model_setting("max_output_tokens")
+    if max_output_tokens is not None:
+        kwargs["max_tokens"] = min(kwargs.get("max_tokens", max_output_tokens), max_output_tokens)
+
+    if endpoint:
+        kwargs.update(endpoint.request_args(get_model()))
+    elif openai.api_type == "azure":
         kwargs["deployment_id"] = get_model()
     elif openai.api_type == "open_ai":
         kwargs["model"] = get_model()
@@ -240,48 +697,575 @@ def get_chat_completion_args(messages, stream=False):
     return kwargs
 
 
-def get_llm_response(prompt):
+_endpoint_pool = None
+# The number of processes that query the endpoints at the same time. See EndpointPool.from_config.
+_endpoint_quota_share = 1
+
+
+def set_endpoint_quota_share(n):
+    global _endpoint_pool, _endpoint_quota_share
+    if n != _endpoint_quota_share:
+        logging.debug(f"Setting endpoint quota share to {n}")
+        _endpoint_quota_share = n
+        _endpoint_pool = None
+
+
+def _get_endpoint_pool():
+    global _endpoint_pool
+    if _endpoint_pool is None and config.endpoints:
+        _endpoint_pool = EndpointPool.from_config(config.endpoints, _endpoint_quota_share)
+    return _endpoint_pool
+
+
+def _select_endpoint(messages, exclude=()):
+    """Returns the endpoint to send the messages to. If all of the endpoints that serve the model, other than
+    those in exclude, are cooling down after failing, then we wait for the first of them to be available.
+
+    Returns:
+        Endpoint: The endpoint, or None if every endpoint that serves the model is in exclude
+
+    Raises:
+        NoEndpointError: If none of the endpoints serve the model
+        BudgetExhaustedError: If the run's time limit would be reached before an endpoint is available
+    """
+
+    pool = _get_endpoint_pool()
+    model = get_model()
+    if not pool.serves(model):
+        raise NoEndpointError(f"None of the endpoints in GAI_ENDPOINTS serve {model}")
+
+    tokens = _get_messages_token_count(messages)
+    while True:
+        endpoint = pool.select(model, tokens, exclude)
+        available_at = pool.available_at(model, exclude)
+        if endpoint is not None or available_at is None:
+            return endpoint
+        wait = max(available_at - time.time(), 0)
+        remaining_seconds = _budget.remaining_seconds()
+        if remaining_seconds is not None and remaining_seconds < wait:
+            raise BudgetExhaustedError("time limit reached while waiting for an endpoint to be available")
+        logging.info(f"All of the endpoints that serve {model} failed recently. Waiting {wait:.1f}s for one of them.")
+        time.sleep(wait)
+
+
+def _send_with_failover(messages, stream=False):
+    """Send the messages to the LLM. If several endpoints are configured then the query is sent to the
+    best of them (see endpoints.EndpointPool) and, if that fails with an error that another endpoint may
+    not have, to the next best, and so on.
+    """
+
+    if config.dry_run:
+        return _dry_run_response(messages, stream)
+
+    pool = _get_endpoint_pool()
+    if not pool:
+        return openai.ChatCompletion.create(**get_chat_completion_args(messages, stream))
+
+    tried = []
+    error = None
+    while True:
+        endpoint = _select_endpoint(messages, tried)
+        if endpoint is None:
+            # Every endpoint has failed
+            raise error
+        tried.append(endpoint.name)
+
+        start = time.time()
+        try:
+            response = openai.ChatCompletion.create(**get_chat_completion_args(messages, stream, endpoint))
+        except RETRYABLE_ERRORS as e:
+            pool.report_failure(endpoint, e)
+            error = e
+            continue
+
+        tokens = _get_messages_token_count(messages)
+        if not stream and "usage" in response:
+            tokens = response["usage"]["total_tokens"]
+        pool.report_success(endpoint, time.time() - start, tokens)
+        return response
+
+
+def get_hedge_model():
+    return config.hedge_model or get_model()
+
+
+def _get_hedge_delay():
+    """Returns how long to wait for a query before hedging it, or None if it should not be hedged"""
+
+    if not config.hedge_percentile:
+        return None
+
+    # The duplicate query needs its own share of the budget
+    remaining_calls = _budget.remaining_calls()
+    if remaining_calls is not None and remaining_calls < 2:
+        return None
+
+    delay = _latency_stats.percentile(get_model(), config.hedge_percentile)
+    return max(delay, _HEDGE_MIN_DELAY) if delay is not None else None
+
+
+async def _reported_chat_completion(kwargs, endpoint, model, tokens):
+    """Send a query, and report how long it took, or that it failed, to the endpoint pool (if endpoint is
+    set) and to the latency stats of model. Only queries that complete have their latency recorded, as the
+    time a cancelled query had run for would make the latencies the hedge delay is based on look shorter.
+    """
+
+    pool = _get_endpoint_pool()
+    start = time.time()
+    try:
+        response = await openai.ChatCompletion.acreate(**kwargs)
+    except asyncio.CancelledError:
+        if endpoint:
+            pool.report_cancelled(endpoint, tokens)
+        raise
+    except RETRYABLE_ERRORS as e:
+        if endpoint:
+            pool.report_failure(endpoint, e)
+        raise
+
+    if endpoint:
+        pool.report_success(endpoint, time.time() - start,
+                            response["usage"]["total_tokens"] if "usage" in response else tokens)
+    _latency_stats.record(model, time.time() - start)
+    return response
+
+
+async def _hedged_chat_completion(primary_query, hedge_query, delay):
+    """Send a query and, if it has not completed within delay seconds, send a duplicate query. The
+    response to whichever completes first is returned, and the other is cancelled.
+
+    Args:
+        primary_query (tuple): The arguments of _reported_chat_completion for the query
+        hedge_query (tuple): The arguments of _reported_chat_completion for the duplicate query
+        delay (float): How long to wait before sending the duplicate
+
+    Returns:
+        tuple: The response, or None if the queries failed with errors that another endpoint may not have,
+            and whether the query was hedged
+
+    Raises:
+        Exception: The error of a query that failed with an error that is not in RETRYABLE_ERRORS
+    """
+
+    tasks = [asyncio.ensure_future(_reported_chat_completion(*primary_query))]
+    done, _ = await asyncio.wait(tasks, timeout=delay)
+    if not done:
+        logging.debug(f"LLM query has not completed after {delay:.1f}s. Sending a duplicate to {hedge_query[2]}.")
+        tasks.append(asyncio.ensure_future(_reported_chat_completion(*hedge_query)))
+
+    pending = set(tasks)
+    winner = None
+    while pending and not winner:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        winner = next((t for t in done if not t.exception()), None)
+
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    hedged = len(tasks) > 1
+    if winner:
+        if hedged:
+            logging.debug(f"The {'original' if winner is tasks[0] else 'duplicate'} LLM query completed first")
+        return winner.result(), hedged
+
+    for t in tasks:
+        if not isinstance(t.exception(), RETRYABLE_ERRORS):
+            raise t.exception()
+    return None, hedged
+
+
+def _profile_detail():
+    """Returns the detail to record LLM queries in the profile with, so that they are broken down by phase"""
+
+    return f"{get_phase() or 'no phase'} ({get_model()})"
+
+
+def _create_chat_completion(messages):
+    """Send the messages to the LLM, hedging the query if it is slow (see LLMConfig.hedge_percentile),
+    and record how long it took.
+    """
+
+    if config.dry_run:
+        return _dry_run_response(messages)
+
+    delay = _get_hedge_delay()
+    start = time.time()
+    if delay is None:
+        response = _send_with_failover(messages)
+        _latency_stats.record(get_model(), time.time() - start)
+    else:
+        # If there are several endpoints then send the duplicate query to a different one to the original
+        endpoint = hedge_endpoint = None
+        if _get_endpoint_pool():
+            endpoint = _select_endpoint(messages)
+            with use_model(get_hedge_model()):
+                hedge_endpoint = _select_endpoint(messages, [endpoint.name]) or _select_endpoint(messages)
+        tokens = _get_messages_token_count(messages)
+        primary_query = (get_chat_completion_args(messages, endpoint=endpoint), endpoint, get_model(), tokens)
+        with use_model(get_hedge_model()):
+            hedge_query = (get_chat_completion_args(messages, endpoint=hedge_endpoint), hedge_endpoint,
+                           get_model(), tokens)
+        # Each query records its own latency, under the model it was sent to
+        response, hedged = asyncio.run(_hedged_chat_completion(primary_query, hedge_query, delay))
+        if hedged:
+            # The cancelled query has still used a call, and the tokens of its prompt
+            _budget.charge(tokens)
+        if response is None:
+            logging.warning("The LLM query failed. Sending it again, to another endpoint if there is one.")
+            response = _send_with_failover(messages)
+    profiling.record_span(profiling.SPAN_LLM, time.time() - start, _profile_detail())
+    return response
+
+
+# The size, in tokens, assumed in a dry run for the response to a prompt that does not limit its size
+_DRY_RUN_RESPONSE_TOKENS = 1000
+# The latency, in seconds, assumed in a dry run for a query to gpt-3.5-turbo when no latencies have been
+# recorded for the model. Other models are assumed to be slower by their relative latency.
+_DRY_RUN_DEFAULT_LATENCY = 5
+_DRY_RUN_PLACEHOLDER = "[dry run: no LLM query was sent] "
+_response_limit_re = re.compile(r"(\d+) or fewer characters")
+
+
+def _dry_run_response(messages, stream=False):
+    """Answer a query without sending it to the LLM, and record the calls and tokens it would have used
+    in the budget. The response is a placeholder, in the format returned by openai.ChatCompletion.create.
+
+    A summary is sized as the real one is expected to be, i.e. the limit given in the prompt, as it may be
+    included in later prompts, e.g. the final analysis. A plan is an empty JSON object, and a streamed
+    response, which is likely to be printed, is a short note, but both are recorded at their expected size.
+    """
+
+    prompt_tokens = _get_messages_token_count(messages)
+    _budget.check(prompt_tokens)
+
+    limit = _response_limit_re.findall(messages[-1]["content"])
+    if limit:
+        response_tokens = math.ceil(int(limit[-1]) / get_prose_char_token_ratio())
+    else:
+        response_tokens = _DRY_RUN_RESPONSE_TOKENS
+    max_output_tokens = _get_model_setting("max_output_tokens")
+    if max_output_tokens is not None:
+        response_tokens = min(response_tokens, max_output_tokens)
+
+    if get_phase() == PHASE_PLAN:
+        content = "{}"
+    elif stream:
+        content = _DRY_RUN_PLACEHOLDER.strip()
+    else:
+        chars = int(response_tokens * get_prose_char_token_ratio())
+        content = (_DRY_RUN_PLACEHOLDER * (chars // len(_DRY_RUN_PLACEHOLDER) + 1))[:chars]
+
+    usage = _budget.dry_run_usage.setdefault((get_phase(), get_model()), [0, 0, 0])
+    usage[0] += 1
+    usage[1] += prompt_tokens
+    usage[2] += response_tokens
+
+    if stream:
+        return iter([{"choices": [{"delta": {"content": content}}]}])
+    return {
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": response_tokens,
+            "total_tokens": prompt_tokens + response_tokens
+        }
+    }
+
+
+def dry_run_report(local_seconds):
+    """Returns a report of the LLM queries that a dry run would have made, by phase and model, and an
+    estimate of how long a real run would take.
+
+    Args:
+        local_seconds (float): How long the dry run took, i.e. the time spent on everything other than
+            waiting for the LLM, such as executing commands, chunking and counting tokens.
+    """
+
+    concurrency = get_max_concurrent_queries()
+    lines = ["LLM queries the run would have made (response tokens are the most each response may use):",
+             f"{'phase':<16} {'model':<24} {'calls':>6} {'prompt tokens':>14} {'response tokens':>16} "
+             f"{'est. seconds':>13}"]
+    totals = [0, 0, 0]
+    llm_seconds = 0
+    assumed = set()
+    order = {p: i for i, p in enumerate(PHASES)}
+    usage = sorted(_budget.dry_run_usage.items(), key=lambda u: (order.get(u[0][0], len(PHASES)), u[0][1]))
+    for (phase_name, model), (calls, prompt_tokens, response_tokens) in usage:
+        latency = _latency_stats.percentile(model, 50)
+        if latency is None:
+            info = get_model_info(model)
+            latency = _DRY_RUN_DEFAULT_LATENCY * (info.relative_latency if info else 1)
+            assumed.add(model)
+        # Summaries are made by max_concurrent_queries worker processes at a time, and are assumed to be spread
+        # evenly between them. The plan and the final analysis are single queries.
+        parallel = concurrency if phase_name in (PHASE_CHUNK_SUMMARY, PHASE_COMMAND_SUMMARY) else 1
+        seconds = math.ceil(calls / parallel) * latency
+        llm_seconds += seconds
+        for i, n in enumerate((calls, prompt_tokens, response_tokens)):
+            totals[i] += n
+        lines.append(f"{phase_name or 'other':<16} {model:<24} {calls:>6} {prompt_tokens:>14} {response_tokens:>16} "
+                     f"{seconds:>13.1f}")
+
+    lines.append(f"Total: {totals[0]} LLM calls, {totals[1]} prompt tokens, and at most {totals[2]} response tokens")
+    lines.append(f"Estimated wall time: {local_seconds + llm_seconds:.1f}s ({local_seconds:.1f}s measured in the dry "
+                 f"run, plus {llm_seconds:.1f}s for the LLM queries with {concurrency} concurrent summary queries)")
+    if assumed:
+        lines.append(f"No latencies have been recorded for {', '.join(sorted(assumed))}, so "
+                     f"{_DRY_RUN_DEFAULT_LATENCY}s per query, times the model's relative latency, is assumed")
+    return "\n".join(lines)
+
+
+# The responses to earlier prompts are only reused for this long, as the state of the hosts they describe changes
+_SIMILAR_PROMPT_MAX_AGE = 24 * 60 * 60
+_similar_prompts = simindex.SimilarityIndex("similar-prompts", _SIMILAR_PROMPT_MAX_AGE)
+
+
+def get_llm_response(prompt, prefix=None):
+    """Send the prompt to the LLM and return its response.
+
+    Args:
+        prompt (str): The prompt
+        prefix (str): Optional text to place before the prompt. Prompts that are sent many times in
+            a run with only some of their content changing should put the content that does not
+            change in the prefix, so that its reuse is recorded in the PromptStats.
+    """
+
+    messages = get_base_messages()
+    messages.append({
+        "role": "user",
+        "content": (prefix or "") + prompt
+    })
+
+    # If a similar enough prompt has been sent before, with the same model and system messages, then
+    # reuse its response instead of querying the LLM
+    content = None
+    threshold = get_similarity_threshold()
+    if threshold:
+        namespace = get_model() + "".join(m["content"] for m in messages[:-1])
+        sig = simindex.signature(messages[-1]["content"])
+        similarity, content = _similar_prompts.lookup(namespace, sig, threshold)
+        if content is not None:
+            logging.debug(f"Reusing the response to an earlier prompt with similarity {similarity:.2f} "
+                          f"(threshold: {threshold})")
+        else:
+            logging.debug(f"No earlier prompt is similar enough to reuse its response. Most similar: "
+                          f"{similarity:.2f} (threshold: {threshold})")
+
+    if content is None:
+        if prefix:
+            # The system messages are sent with every call, so they are part of the shared prefix too
+            shared_prefix = "".join(m["content"] for m in messages[:-1]) + prefix
+            _prompt_stats.record(get_model() + shared_prefix, get_token_count(shared_prefix))
+        else:
+            _prompt_stats.record(None, 0)
+        response = _create_chat_completion(messages)
+
+        content = response["choices"][0]["message"]["content"]
+        if "usage" in response:
+            _budget.charge(response["usage"]["total_tokens"])
+        else:
+            _budget.charge(_get_messages_token_count(messages) + get_token_count(content))
+        if threshold and not config.dry_run:
+            _similar_prompts.add(namespace, sig, content)
+
+    run_archive = get_run_archive()
+    if run_archive:
+        run_archive.record_llm_query(messages, content)
+    return content
+
+
+def stream_llm_response(prompt):
+    """Send the prompt to the LLM and yield its response as it is generated.
+
+    Args:
+        prompt (str): The prompt
+
+    Yields:
+        str: The pieces of the response, in order
+    """
+
     messages = get_base_messages()
     messages.append({
         "role": "user",
         "content": prompt
     })
-    response = openai.ChatCompletion.create(
-        **get_chat_completion_args(messages)
-    )
 
-    return response["choices"][0]["message"]["content"]
+    _prompt_stats.record(None, 0)
+    # Only the time spent waiting for the response is profiled, not the time the caller spends on each piece
+    waited = 0
+    start = time.perf_counter()
+    completion = _send_with_failover(messages, stream=True)
+
+    response = []
+    for chunk in completion:
+        waited += time.perf_counter() - start
+        delta = chunk["choices"][0]["delta"]
+        if "content" in delta:
+            response.append(delta["content"])
+            yield delta["content"]
+        start = time.perf_counter()
+    waited += time.perf_counter() - start
+    profiling.record_span(profiling.SPAN_LLM, waited, _profile_detail())
+
+    response = "".join(response)
+    # Streamed responses do not include token usage, so we have to count it ourselves
+    _budget.charge(_get_messages_token_count(messages) + get_token_count(response))
+
+    run_archive = get_run_archive()
+    if run_archive:
+        run_archive.record_llm_query(messages, response)
+
+
+# Once a conversation uses this fraction of the model's context window we compact it
+_CONVERSATION_COMPACT_FRACTION = .6
+# The number of most recent messages that are always kept verbatim when compacting a conversation
+_CONVERSATION_KEEP_RECENT = 2
+# The fraction of the compaction threshold that the original input, and the running summary of
+# older messages, may each use
+_CONVERSATION_PINNED_FRACTION = .3
+_CONVERSATION_SUMMARY_FRACTION = .2
+
+_compress_input_prompt = """Below is the input I gave you at the start of our conversation. It is too long
+to keep repeating in full. Rewrite it as compactly as possible, using at most {max_chars} characters. Keep
+all of the data it contains, such as the names of programs, libraries and functions, and all numbers and
+percentages, and keep the instructions it gives. Drop examples, formatting and repetition.
+
+Input:
+{input}
+Compressed input:"""
+
+_summarise_conversation_prompt = """Below is a summary of the earlier part of a conversation between a user
+and you, followed by the messages that came after it. Write a new summary of the whole conversation using at
+most {max_chars} characters. Keep the specific facts, names and numbers that were discussed, the questions the
+user asked, and the suggestions that you made.
+
+Summary so far: {summary}
+Messages:
+{messages}
+New summary:"""
+
+
+class Conversation:
+    """A chat with the LLM whose size is kept bounded. Each message's token count is tracked, and
+    once the conversation reaches _CONVERSATION_COMPACT_FRACTION of the model's context window the
+    older messages are folded into a running summary. The first user message, which is usually the
+    input being analysed (e.g. a Top-N or a stack trace), is pinned so it is never summarised away,
+    but it is compressed if it is too large once the conversation continues past the first reply.
+    """
+
+    def __init__(self):
+        self.pinned = None
+        self.summary = None
+        self.turns = []
+
+    def append(self, role, content):
+        message = {"role": role, "content": content, "tokens": get_token_count(content)}
+        if self.pinned is None and role == "user":
+            self.pinned = message
+        else:
+            self.turns.append(message)
+
+    def messages(self):
+        """Returns the messages to send to the LLM"""
+
+        messages = get_base_messages()
+        if self.pinned:
+            messages.append(self.pinned)
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        messages.extend(self.turns)
+        return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+    def token_count(self):
+        return _get_messages_token_count(self.messages())
+
+    def compact(self):
+        """Compress the pinned input and fold older messages into the running summary, if the
+        conversation has grown too large.
+        """
+
+        # The input is sent as it is until there has been at least one reply to it, as compressing it loses
+        # detail and costs an extra query
+        if not self.turns:
+            return
+
+        limit = int(get_model_max_tokens() * _CONVERSATION_COMPACT_FRACTION)
+        tokens = self.token_count()
+        if tokens <= limit:
+            return
+
+        logging.debug(f"Compacting conversation of {tokens} tokens (limit: {limit})")
+        pinned_max_tokens = int(limit * _CONVERSATION_PINNED_FRACTION)
+        if self.pinned["tokens"] > pinned_max_tokens and not self.pinned.get("compressed"):
+            compressed = get_llm_response(_compress_input_prompt.format(
+                max_chars=int(pinned_max_tokens * get_prose_char_token_ratio()), input=self.pinned["content"]))
+            self.pinned = {"role": "user", "content": compressed, "tokens": get_token_count(compressed),
+                           "compressed": True}
+
+        older = self.turns[:-_CONVERSATION_KEEP_RECENT]
+        if older:
+            summary_max_tokens = int(limit * _CONVERSATION_SUMMARY_FRACTION)
+            messages = "\n".join(f"{m['role']}: {m['content']}" for m in older)
+            self.summary = get_llm_response(_summarise_conversation_prompt.format(
+                max_chars=int(summary_max_tokens * get_prose_char_token_ratio()),
+                summary=self.summary or "None", messages=messages))
+            self.turns = self.turns[-_CONVERSATION_KEEP_RECENT:]
+
+        logging.debug(f"Compacted conversation to {self.token_count()} tokens")
 
 
 def print_streamed_llm_response(prompt, conversation=None):
+    """Send the prompt to the LLM, as the next message in the conversation, and stream the
+    response to stdout.
+
+    Args:
+        prompt (str): The prompt
+        conversation (Conversation): The conversation so far. If not provided then a new
+            conversation is started.
+
+    Returns:
+        Conversation: The conversation, including the prompt and the response
+    """
+
     response = []
 
     if not conversation:
-        conversation = get_base_messages()
+        conversation = Conversation()
 
-    conversation.append({
-        "role": "user",
-        "content": prompt
-    })
+    conversation.append("user", prompt)
+    conversation.compact()
+    messages = conversation.messages()
 
-    completion = openai.ChatCompletion.create(
-        **get_chat_completion_args(conversation, stream=True)
-    )
+    start = time.perf_counter()
+    completion = _send_with_failover(messages, stream=True)
 
     wrote_reply = False
+    rendering = 0
     for chunk in completion:
         delta = chunk["choices"][0]["delta"]
         if "content" not in delta:
             continue
         content = delta["content"]
+        render_start = time.perf_counter()
         sys.stdout.write(content)
+        rendering += time.perf_counter() - render_start
         response.append(content)
         wrote_reply = True
 
     if wrote_reply:
         sys.stdout.write("\n")
+    profiling.record_span(profiling.SPAN_LLM, time.perf_counter() - start - rendering, _profile_detail())
+    profiling.record_span(profiling.SPAN_RENDERING, rendering)
+
+    response = "".join(response)
+    conversation.append("assistant", response)
+    # Streamed responses do not include token usage, so we have to count it ourselves
+    _budget.charge(_get_messages_token_count(messages) + get_token_count(response))
 
-    conversation.append({"role": "assistant", "content": "".join(response)})
+    run_archive = get_run_archive()
+    if run_archive:
+        run_archive.record_llm_query(messages, response)
 
     return conversation
 
@@ -301,4 +1285,8 @@ def chat(conversation):
             print("--- End chat with the LLM ---")
             sys.exit(0)
 
-        conversation = print_streamed_llm_response(user_input, conversation)
+        try:
+            conversation = print_streamed_llm_response(user_input, conversation)
+        except BudgetExhaustedError as e:
+            print(f"--- End chat with the LLM. Budget exhausted: {e} ---")
+            return conversation
@@ -0,0 +1,176 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import dataclasses
+import json
+import logging
+import os
+
+from dataclasses import dataclass
+
+from sgrk.archive import data_dir
+
+
+@dataclass
+class ModelInfo:
+    """The capabilities of a model.
+
+    context_tokens is the size of the model's context window, which is shared by the prompt and the
+    response. max_output_tokens, if set, is a further limit on the size of the response. relative_cost and
+    relative_latency compare the model to gpt-3.5-turbo, per token.
+
+    The remaining fields control how the model is used, and can be set for a deployment by the tune
+    command. summary_fraction is the fraction of the context window a command summary may use when no
+    size is given for it. response_factor is how many times the size of the example response the final
+    analysis is allowed. chunk_fraction is the fraction of the space left in the prompt that each chunk
+    of a command's output fills. max_concurrent_queries, if set, is the default for --max-concurrent-queries.
+    """
+
+    context_tokens: int
+    tokenizer: str = "cl100k_base"
+    max_output_tokens: int = None
+    relative_cost: float = 1
+    relative_latency: float = 1
+    summary_fraction: float = .1
+    response_factor: float = 4
+    chunk_fraction: float = 1
+    max_concurrent_queries: int = None
+
+
+_registry = {
+    "gpt-3.5-turbo": ModelInfo(4096),
+    "gpt-3.5-turbo-16k": ModelInfo(16384, relative_cost=2),
+    "gpt-4": ModelInfo(8192, relative_cost=20, relative_latency=3),
+    "gpt-4-32k": ModelInfo(32768, relative_cost=40, relative_latency=3),
+    "gpt-4-turbo": ModelInfo(128000, max_output_tokens=4096, relative_cost=7, relative_latency=2),
+    "gpt-4o": ModelInfo(128000, tokenizer="o200k_base", max_output_tokens=16384, relative_cost=3,
+                        relative_latency=1),
+    "gpt-4o-mini": ModelInfo(128000, tokenizer="o200k_base", max_output_tokens=16384, relative_cost=.1,
+                             relative_latency=.7),
+}
+
+# Models can be added, or the values for the models above changed, in this file. It must contain a JSON
+# dictionary mapping model names (or Azure deployment IDs) to dictionaries with the fields of ModelInfo,
+# e.g. {"my-gpt4-deployment": {"context_tokens": 8192, "relative_cost": 20}}.
+models_path = os.path.join(data_dir, "models.json")
+_models_file_loaded = False
+
+
+def _load_models_file():
+    global _models_file_loaded
+    _models_file_loaded = True
+    try:
+        with open(models_path) as f:
+            models = json.load(f)
+        if not isinstance(models, dict):
+            raise ValueError("expected a JSON object mapping model names to their fields")
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        logging.warning(f"Ignoring {models_path}, as it is not valid: {e}")
+        return
+
+    for name, fields in models.items():
+        try:
+            if name in _registry:
+                _registry[name] = dataclasses.replace(_registry[name], **fields)
+            else:
+                _registry[name] = ModelInfo(**fields)
+        except TypeError as e:
+            logging.error(f"Ignoring invalid entry for {name} in {models_path}: {e}")
+    logging.debug(f"Loaded {len(models)} models from {models_path}")
+
+
+def get_model_info(model):
+    """Returns the ModelInfo for the model, or None if the model is unknown"""
+
+    if not _models_file_loaded:
+        _load_models_file()
+    return _registry.get(model)
+
+
+def for_worker():
+    """Returns the registry of models, including any changes made with set_model_fields, to pass to
+    start_worker
+    """
+
+    if not _models_file_loaded:
+        _load_models_file()
+    return dict(_registry)
+
+
+def start_worker(registry):
+    """Use the registry of models returned by for_worker in the parent process in a worker process, which
+    does not inherit changes made with set_model_fields if it is spawned rather than forked
+    """
+
+    global _registry, _models_file_loaded
+    _registry = registry
+    _models_file_loaded = True
+
+
+def set_model_fields(model, **fields):
+    """Change fields of the ModelInfo of a known model for the rest of this process"""
+
+    _registry[model] = dataclasses.replace(get_model_info(model), **fields)
+
+
+def save_model_fields(model, **fields):
+    """Change fields of the ModelInfo of a known model, and save them in models_path so that they are used
+    by later runs too. Other entries in the file are kept as they are.
+    """
+
+    set_model_fields(model, **fields)
+    try:
+        with open(models_path) as f:
+            models = json.load(f)
+        if not isinstance(models, dict):
+            raise ValueError("expected a JSON object mapping model names to their fields")
+    except FileNotFoundError:
+        models = {}
+    except ValueError as e:
+        # Do not overwrite the file, so that whatever is in it can be recovered
+        logging.warning(f"Not saving {', '.join(fields)} for {model}, as {models_path} is not valid: {e}")
+        return
+    models.setdefault(model, {}).update(fields)
+
+    os.makedirs(os.path.dirname(models_path), exist_ok=True)
+    tmp_path = f"{models_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(models, f, indent=4)
+    os.replace(tmp_path, models_path)
+    logging.info(f"Saved {', '.join(f'{k}={v}' for k, v in fields.items())} for {model} in {models_path}")
+
+
+def select_model_for_tokens(candidates, tokens):
+    """Select the model from candidates that can fit a prompt and response of tokens tokens in its
+    context window. If more than one can, the one with the lowest cost, and then latency, is selected.
+
+    Returns:
+        str: The selected model, or None if none of the candidates are large enough
+    """
+
+    fitting = []
+    for model in candidates:
+        info = get_model_info(model)
+        if info is None:
+            logging.warning(f"Not considering unknown model {model}. Add it to {models_path} to use it.")
+            continue
+        if info.context_tokens >= tokens:
+            fitting.append((info.relative_cost, info.relative_latency, model))
+
+    return min(fitting)[2] if fitting else None
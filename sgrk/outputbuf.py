@@ -0,0 +1,266 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import codecs
+import logging
+import mmap
+import tempfile
+import zlib
+
+from collections.abc import Sequence
+
+# Output smaller than this is kept as it is, as compressing it would save little
+_COMPRESS_BYTES = 64 * 1024
+
+# Output larger than this is written to a temporary file rather than kept in memory
+_spill_bytes = 16 * 1024 * 1024
+
+# The most output, in bytes, that is decoded at a time when output is read a piece at a time
+_READ_BYTES = 1024 * 1024
+
+
+def set_spill_bytes(b):
+    global _spill_bytes
+    logging.debug(f"Setting output spill threshold to {b} bytes")
+    _spill_bytes = b
+
+
+def get_spill_bytes():
+    return _spill_bytes
+
+
+class OutputBuffer:
+    """Holds the output of a command as bytes, which are only decoded when the output is used, so that the
+    output of many commands can be held at once without using much memory. Once the buffer is finished,
+    output larger than _COMPRESS_BYTES is compressed, and output larger than the spill threshold (see
+    set_spill_bytes) is kept in a temporary file, which is memory-mapped to read it, instead.
+
+    Output is added with write, and the buffer must then be finished before it is read. OutputBuffer.of
+    creates a finished buffer from a string.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._compressed = None
+        self._file = None
+        self._mmap = None
+        self._size = 0
+        self._finished = False
+
+    @classmethod
+    def of(cls, output):
+        """Returns a finished buffer holding output, which may be a str, bytes, None, or an OutputBuffer,
+        which is returned as it is.
+        """
+
+        if isinstance(output, OutputBuffer):
+            return output
+        buffer = cls()
+        if output:
+            buffer.write(output.encode("utf-8", errors="replace") if isinstance(output, str) else output)
+        buffer.finish()
+        return buffer
+
+    def write(self, data):
+        if self._finished:
+            raise ValueError("Cannot write to a finished output buffer")
+        if not data:
+            return
+
+        self._size += len(data)
+        if self._file is None and self._size > _spill_bytes:
+            logging.debug(f"Output is larger than {_spill_bytes} bytes. Writing it to a temporary file.")
+            self._file = tempfile.TemporaryFile(prefix="sgrk-output-")
+            self._file.write(self._data)
+            self._data = None
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._data += data
+
+    def finish(self):
+        """Finish writing to the buffer, after which it can be read"""
+
+        if self._finished:
+            return
+        self._finished = True
+        if self._file is not None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        elif self._size > _COMPRESS_BYTES:
+            self._compressed = zlib.compress(self._data, 1)
+            self._data = None
+        else:
+            self._data = bytes(self._data)
+
+    @classmethod
+    def _from_compressed(cls, compressed, size):
+        buffer = cls()
+        buffer._data = None
+        buffer._compressed = compressed
+        buffer._size = size
+        buffer._finished = True
+        return buffer
+
+    def __reduce__(self):
+        # Buffers are pickled to send them to worker processes. A temporary file cannot be, so its contents
+        # are sent compressed instead.
+        if not self._finished:
+            raise ValueError("Cannot pickle an output buffer before it is finished")
+        if self._mmap is not None:
+            return OutputBuffer._from_compressed, (zlib.compress(self._mmap, 1), self._size)
+        if self._compressed is not None:
+            return OutputBuffer._from_compressed, (self._compressed, self._size)
+        return OutputBuffer.of, (self._data,)
+
+    def __len__(self):
+        """Returns the size of the output in bytes"""
+
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __str__(self):
+        return self.text()
+
+    def __repr__(self):
+        where = "spilled" if self._mmap is not None else "compressed" if self._compressed is not None else "in memory"
+        return f"OutputBuffer({self._size} bytes, {where})"
+
+    def getvalue(self):
+        """Returns the output as bytes"""
+
+        if not self._finished:
+            raise ValueError("Cannot read an output buffer before it is finished")
+        if self._mmap is not None:
+            return self._mmap[:]
+        if self._compressed is not None:
+            return zlib.decompress(self._compressed)
+        return self._data
+
+    def text(self):
+        """Returns the output, decoded as UTF-8. A new string is created each time this is called, so callers
+        that use the output more than once should keep it.
+        """
+
+        return self.getvalue().decode("utf-8", errors="replace")
+
+    def iter_bytes(self):
+        """Yields the output as bytes, up to _READ_BYTES at a time, so that output that is compressed or in a
+        temporary file can be read without holding all of it in memory at once.
+        """
+
+        if not self._finished:
+            raise ValueError("Cannot read an output buffer before it is finished")
+        if self._mmap is not None:
+            for i in range(0, self._size, _READ_BYTES):
+                yield self._mmap[i:i + _READ_BYTES]
+        elif self._compressed is not None:
+            decompressor = zlib.decompressobj()
+            data = self._compressed
+            while data:
+                piece = decompressor.decompress(data, _READ_BYTES)
+                data = decompressor.unconsumed_tail
+                if piece:
+                    yield piece
+            piece = decompressor.flush()
+            if piece:
+                yield piece
+        elif self._data:
+            yield self._data
+
+    def iter_text(self):
+        """Yields the output, decoded as UTF-8, a piece at a time. See iter_bytes."""
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for piece in self.iter_bytes():
+            text = decoder.decode(piece)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def lines(self):
+        """Yields the lines of the output, decoded as UTF-8, without their line breaks. See iter_bytes."""
+
+        rest = ""
+        for text in self.iter_text():
+            lines = (rest + text).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line.rstrip("\r")
+        if rest:
+            yield rest.rstrip("\r")
+
+    def __getitem__(self, key):
+        """Returns the decoded text of a slice of the output's bytes, e.g. to sample long output. A slice
+        may split a multi-byte character, which is decoded as a replacement character.
+        """
+
+        if not isinstance(key, slice):
+            raise TypeError("Output buffers can only be sliced")
+        if self._mmap is not None:
+            return self._mmap[key].decode("utf-8", errors="replace")
+        return self.getvalue()[key].decode("utf-8", errors="replace")
+
+    def chunks(self, chunk_size):
+        """Split the output into chunks of up to chunk_size bytes, breaking them between lines, so that
+        when output only grows at the end (e.g. logs) all but the last few chunks are unchanged. A line
+        longer than chunk_size is a chunk of its own. The line breaks between chunks are dropped.
+
+        Returns:
+            Sequence: The chunks, as strings. Each chunk is decoded when it is used, rather than all of
+                them being created up front.
+        """
+
+        data = self._mmap if self._mmap is not None else self.getvalue()
+        bounds = []
+        start = 0
+        end = 0
+        while end < len(data):
+            line_end = data.find(b"\n", end)
+            if line_end == -1:
+                line_end = len(data)
+            if line_end - start > chunk_size and end > start:
+                bounds.append((start, end - 1))
+                start = end
+            end = line_end + 1
+        if start < len(data) or not bounds:
+            bounds.append((start, len(data)))
+
+        logging.debug(f"Split output of {self._size} bytes into {len(bounds)} chunks with up to {chunk_size} "
+                      "bytes each")
+        return _Chunks(data, bounds)
+
+
+class _Chunks(Sequence):
+    """The chunks of an OutputBuffer, as (start, end) offsets into its bytes"""
+
+    def __init__(self, data, bounds):
+        self._data = data
+        self._bounds = bounds
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        start, end = self._bounds[index]
+        return self._data[start:end].decode("utf-8", errors="replace").rstrip("\r\n")
@@ -0,0 +1,210 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import queue
+import threading
+
+from multiprocessing import Pool
+
+from sgrk import llm, profiling
+from sgrk.cmdanalysis import (compact_command_result, estimate_summary_cost, get_max_chars_per_command_summary,
+                              multiproc_wrapper_summarise_command, worker_settings)
+from sgrk.cmdexec import execute_commands_remote
+from sgrk.cmdparsers import summarise_command_locally
+
+# Summaries are sized as if this many commands will be run, as we do not know how many there will be
+# until they have all been run. If more are run, the summaries are shortened before the final analysis.
+_EXPECTED_COMMANDS = 20
+# How often, in seconds, the summarisation stage checks for finished summaries while it waits for output
+_POLL_SECONDS = .1
+
+_collection_done = object()
+
+
+class _BudgetAllocator:
+    """Gives each command a share of the run's budget as it is submitted for summarisation. As we do
+    not know how many commands there will be, each is given what it is estimated to need, if the budget
+    not already allocated to commands being summarised, and not reserved for the final analysis, allows.
+    """
+
+    def __init__(self, budget, reserve_tokens):
+        self.budget = budget
+        self.reserve_tokens = reserve_tokens
+        self.allocated_tokens = 0
+        self.allocated_calls = 0
+
+    def allocate(self, cost, calls):
+        """Returns the budget for a command, or None if it cannot be afforded"""
+
+        child = llm.Budget(deadline=self.budget.deadline)
+        remaining_tokens = self.budget.remaining_tokens()
+        if remaining_tokens is not None:
+            available = remaining_tokens - self.reserve_tokens - self.allocated_tokens
+            # Output that is too large for the remaining budget is summarised in part, so we only need
+            # enough for a single full-sized call
+            if available < min(cost, llm.get_model_max_tokens()):
+                return None
+            child.max_tokens = min(cost, available)
+        remaining_calls = self.budget.remaining_calls()
+        if remaining_calls is not None:
+            # Keep one call back for the final analysis
+            available = remaining_calls - 1 - self.allocated_calls
+            if available < 1:
+                return None
+            child.max_calls = min(calls, available)
+
+        self.allocated_tokens += child.max_tokens or 0
+        self.allocated_calls += child.max_calls or 0
+        return child
+
+    def release(self, child, used):
+        self.allocated_tokens -= child.max_tokens or 0
+        self.allocated_calls -= child.max_calls or 0
+        self.budget.merge(used)
+
+
+def _fit_command_summaries(command_summaries, problem_description):
+    """Shorten the longest summaries if, together, they are too long for the final analysis prompt"""
+
+    if not command_summaries:
+        return command_summaries
+    max_chars = get_max_chars_per_command_summary(problem_description, len(command_summaries))
+    if sum(len(s) for _, s in command_summaries) <= max_chars * len(command_summaries):
+        return command_summaries
+
+    logging.debug(f"Shortening command summaries to {max_chars} characters to fit them in the analysis prompt")
+    return [(c, s if len(s) <= max_chars else s[:max_chars] + " [...]") for c, s in command_summaries]
+
+
+def collect_and_summarise(host, commands, problem_description=None, compact=True, local_parsers=True, cache=True,
+                          filters=None):
+    """Execute commands on host and summarise the output of each command as soon as it is available, rather
+    than waiting for all of the commands to complete before starting to summarise them. The work is done in
+    stages, which run concurrently:
+
+    1. Collection: a thread executes the commands, which may be a generator that is still producing them,
+       and puts each CommandResult on a queue.
+    2. Summarisation: the output of each command is taken from the queue, compacted, and summarised either
+       locally or by a pool of worker processes (which split output that is too long into chunks and
+       summarise those). At most max_concurrent_queries commands are summarised at a time.
+
+    The queue between the stages is bounded, so if summarisation falls behind then collection waits for
+    it, and the output of at most a few commands is held in memory at a time.
+
+    Args:
+        host (str): The host to execute the commands on
+        commands (iterable): The commands to execute
+        problem_description (str): The problem to summarise the commands with respect to
+        compact (bool): If true, collapse repeated and uninformative lines in each command's output.
+        local_parsers (bool): If true, summarise commands that we have a local parser for without the LLM.
+        cache (bool): If true, reuse cached summaries of chunks of large outputs.
+        filters (cmdexec.CommandFilters): Optional filters to push down into the commands.
+
+    Returns:
+        list: A list of (command, summary) tuples, in the order the commands were executed, for use with
+            cmdanalysis.analyse_command_summaries.
+    """
+
+    max_in_flight = llm.get_max_concurrent_queries()
+    results = queue.Queue(maxsize=max_in_flight)
+    collection_errors = []
+
+    def collect():
+        try:
+            execute_commands_remote(host, commands, llm.get_budget().deadline, on_result=results.put,
+                                    filters=filters)
+        except Exception as e:
+            collection_errors.append(e)
+        finally:
+            results.put(_collection_done)
+
+    budget = llm.get_budget()
+    with llm.phase(llm.PHASE_ANALYSIS):
+        allocator = _BudgetAllocator(budget, llm.get_model_max_tokens())
+    max_chars = get_max_chars_per_command_summary(problem_description, _EXPECTED_COMMANDS)
+    latency_stats = llm.get_latency_stats()
+
+    order = []
+    summaries = {}
+    in_flight = []
+    collection_finished = False
+    with profiling.span(profiling.SPAN_POOL_STARTUP):
+        pool = Pool(max_in_flight)
+    # The workers are forked before the collector thread is started, so that they cannot inherit locks it holds,
+    # e.g. those of the SSH connection or of logging, which would never be released in the workers
+    collector = threading.Thread(target=collect, name="collector", daemon=True)
+    collector.start()
+    with pool:
+        while not collection_finished or in_flight:
+            for job in [j for j in in_flight if j[0].ready()]:
+                in_flight.remove(job)
+                async_result, child, command = job
+                try:
+                    summary, used, prompt_stats, worker_latency_stats, profile = async_result.get()
+                except Exception as e:
+                    # What the failed worker used is not known, so only the budget allocated to it is released
+                    logging.warning(f"Failed to summarise '{command}': {e}")
+                    summaries[command] = f"Not summarised, as summarising it failed ({e})."
+                    allocator.release(child, llm.Budget())
+                    continue
+                summaries[summary[0]] = summary[1]
+                allocator.release(child, used)
+                llm.get_prompt_stats().merge(prompt_stats)
+                latency_stats.merge(worker_latency_stats)
+                profiling.merge(profile)
+                logging.info(f"Summarised '{summary[0]}'")
+
+            if collection_finished or len(in_flight) >= max_in_flight:
+                if in_flight:
+                    in_flight[0][0].wait(_POLL_SECONDS)
+                continue
+
+            try:
+                result = results.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if result is _collection_done:
+                collection_finished = True
+                continue
+
+            command = result.command
+            order.append(command)
+            if local_parsers:
+                summary = summarise_command_locally(command, result)
+                if summary:
+                    summaries[command] = summary
+                    continue
+
+            if compact:
+                result = compact_command_result(result)
+            child = allocator.allocate(*estimate_summary_cost(result))
+            if child is None:
+                logging.warning(f"Not summarising '{command}', to stay within the run's budget")
+                summaries[command] = "Not summarised, to stay within the budget for this run."
+                continue
+
+            logging.debug(f"Summarising '{command}' while later commands are executed")
+            args = (llm.get_config(), child, latency_stats.for_worker(), worker_settings(), command, result,
+                    max_chars, problem_description, False, False, cache)
+            in_flight.append((pool.apply_async(multiproc_wrapper_summarise_command, args), child, command))
+
+    collector.join()
+    if collection_errors:
+        raise collection_errors[0]
+
+    return _fit_command_summaries([(c, summaries[c]) for c in order], problem_description)
@@ -0,0 +1,336 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Profiling of sysgrok itself, enabled with --profile. The time spent in each phase of a run (spans) is
+# recorded, and the stacks of all threads are sampled periodically to produce a collapsed stack file,
+# which can be turned into a flame graph, or have its hottest stack explained by the stacktrace command.
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from sgrk.archive import data_dir
+
+# Profiles are written here by default, named after the time they were started at
+profiles_dir = os.path.join(data_dir, "profiles")
+
+# How often the stacks of all threads are sampled, in seconds
+_SAMPLE_INTERVAL = .01
+# The number of spans with details, e.g. individual commands, to show in the report for each span
+_TOP_DETAILS = 5
+# The number of allocation sites to show in the report when memory is profiled
+_TOP_ALLOCATIONS = 10
+
+SPAN_STARTUP = "startup"
+SPAN_PLANNING = "planning"
+SPAN_COLLECTION = "collection"
+SPAN_COMPACTION = "compaction"
+SPAN_CHUNKING = "chunking"
+SPAN_TOKEN_COUNTING = "token counting"
+SPAN_JSON_PARSING = "json parsing"
+SPAN_POOL_STARTUP = "pool startup"
+SPAN_LLM = "llm"
+SPAN_RENDERING = "rendering"
+
+
+@dataclass
+class ProfileData:
+    """The spans and stack samples recorded by a Profiler. Kept separate from the Profiler so that it can be
+    returned from worker processes and merged into the profile of the parent process.
+    """
+
+    # Maps each span name to [calls, total seconds, max seconds]
+    spans: dict = field(default_factory=dict)
+    # Maps each span name to a dictionary mapping details, e.g. commands, to [calls, total seconds]
+    details: dict = field(default_factory=dict)
+    # Maps collapsed stacks, i.e. frames separated by semicolons, outermost first, to their sample counts
+    stacks: dict = field(default_factory=dict)
+
+    def record(self, name, seconds, detail=None):
+        span = self.spans.setdefault(name, [0, 0, 0])
+        span[0] += 1
+        span[1] += seconds
+        span[2] = max(span[2], seconds)
+        if detail is not None:
+            d = self.details.setdefault(name, {}).setdefault(detail, [0, 0])
+            d[0] += 1
+            d[1] += seconds
+
+    def merge(self, other):
+        for name, (calls, total, longest) in other.spans.items():
+            span = self.spans.setdefault(name, [0, 0, 0])
+            span[0] += calls
+            span[1] += total
+            span[2] = max(span[2], longest)
+        for name, details in other.details.items():
+            for detail, (calls, total) in details.items():
+                d = self.details.setdefault(name, {}).setdefault(detail, [0, 0])
+                d[0] += calls
+                d[1] += total
+        for stack, count in other.stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0) + count
+
+
+class Profiler:
+    """Records how long each span takes and, while it is started, samples the stacks of all threads.
+
+    Args:
+        sample_interval (float): How often to sample stacks, in seconds. If 0, stacks are not sampled.
+        cprofile (bool): If true, also profile the main thread with cProfile.
+        memory (bool): If true, also trace memory allocations with tracemalloc.
+        thread_prefix (str): Prefixed to the thread names in the sampled stacks, e.g. to tell the threads
+            of worker processes from those of the main process.
+    """
+
+    def __init__(self, sample_interval=_SAMPLE_INTERVAL, cprofile=False, memory=False, thread_prefix=""):
+        self.data = ProfileData()
+        self.sample_interval = sample_interval
+        self.thread_prefix = thread_prefix
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.memory = memory
+        self.memory_snapshot = None
+        self.memory_peak = None
+        self.started = None
+        self.elapsed = None
+        self._lock = threading.Lock()
+        # Maps thread IDs to the names of the spans that are active in that thread, outermost first
+        self._active_spans = {}
+        self._sampler = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self.started = time.time()
+        if self.memory:
+            tracemalloc.start()
+        if self.cprofile:
+            self.cprofile.enable()
+        if self.sample_interval:
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+        return self
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+        if self._sampler:
+            self._stopping.set()
+            self._sampler.join()
+        if self.cprofile:
+            self.cprofile.disable()
+        if self.memory:
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def record(self, name, seconds, detail=None):
+        with self._lock:
+            self.data.record(name, seconds, detail)
+
+    def merge(self, data):
+        with self._lock:
+            self.data.merge(data)
+
+    def enter_span(self, name):
+        self._active_spans.setdefault(threading.get_ident(), []).append(name)
+
+    def exit_span(self):
+        self._active_spans[threading.get_ident()].pop()
+
+    def _sample(self):
+        names = {}
+        while not self._stopping.wait(self.sample_interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == threading.get_ident():
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                spans = [f"[{s}]" for s in self._active_spans.get(thread_id, ())]
+                thread = f"{self.thread_prefix}{names.get(thread_id, thread_id)}"
+                samples.append(";".join([thread] + spans + frames[::-1]))
+            with self._lock:
+                for stack in samples:
+                    self.data.stacks[stack] = self.data.stacks.get(stack, 0) + 1
+
+    def report(self):
+        """Returns a report of the time spent in each span, and the peak memory use if memory was traced"""
+
+        lines = ["Time spent in each phase of the run (a phase that happens within another, e.g. token counting "
+                 "within chunking, is included in both):",
+                 f"{'phase':<24} {'calls':>7} {'total s':>9} {'mean s':>9} {'max s':>9} {'% of run':>9}"]
+        # Startup is recorded as a span, but happened before the profiler was started
+        elapsed = (self.elapsed or time.time() - self.started) + self.data.spans.get(SPAN_STARTUP, [0, 0])[1]
+        for name, (calls, total, longest) in sorted(self.data.spans.items(), key=lambda s: -s[1][1]):
+            lines.append(f"{name:<24} {calls:>7} {total:>9.3f} {total / calls:>9.3f} {longest:>9.3f} "
+                         f"{100 * total / elapsed:>8.1f}%")
+            details = sorted(self.data.details.get(name, {}).items(), key=lambda d: -d[1][1])
+            for detail, (calls, total) in details[:_TOP_DETAILS]:
+                lines.append(f"  {detail[:60]:<60} {calls:>5} {total:>9.3f}s")
+        lines.append(f"Total run time, including startup: {elapsed:.3f}s")
+
+        if self.memory_snapshot:
+            lines.append(f"Peak traced memory: {self.memory_peak / 1024 / 1024:.1f} MiB. Largest allocation sites "
+                         "still allocated at the end of the run:")
+            for stat in self.memory_snapshot.statistics("lineno")[:_TOP_ALLOCATIONS]:
+                lines.append(f"  {stat}")
+        return "\n".join(lines)
+
+    def save(self, path_prefix):
+        """Write the collapsed stacks to path_prefix.folded and the hottest of them, in the format expected
+        by the stacktrace command, to path_prefix.hottest.txt. The cProfile stats, if any, are written
+        to path_prefix.pstats.
+
+        Returns:
+            list: The paths of the files written
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(path_prefix)), exist_ok=True)
+        paths = []
+        if self.data.stacks:
+            path = f"{path_prefix}.folded"
+            with open(path, "w") as f:
+                for stack, count in sorted(self.data.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+
+            # Threads that are not doing sysgrok's work, such as those that manage the worker pool, spend
+            # the whole run waiting, so the hottest stack is taken from those sampled within a span if
+            # there are any. The stacktrace command expects the innermost frame first.
+            in_spans = {s: c for s, c in self.data.stacks.items() if ";[" in s}
+            hottest = max((in_spans or self.data.stacks).items(), key=lambda s: s[1])[0]
+            path = f"{path_prefix}.hottest.txt"
+            with open(path, "w") as f:
+                f.write("\n".join(reversed(hottest.split(";"))) + "\n")
+            paths.append(path)
+
+        if self.cprofile:
+            path = f"{path_prefix}.pstats"
+            self.cprofile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+# The profiler for this process, or None if the run is not being profiled
+_profiler = None
+
+
+def set_profiler(p):
+    global _profiler
+    logging.debug(f"Setting profiler to {p}")
+    _profiler = p
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def span(name, detail=None):
+    """Context manager, or function decorator, that records how long the code within it takes as part of
+    the named span, if the run is being profiled. detail, e.g. a command, is recorded too, so that the
+    report can show which instances of the span took longest.
+    """
+
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    profiler.enter_span(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(name, time.perf_counter() - start, detail)
+        profiler.exit_span()
+
+
+def record_span(name, seconds, detail=None):
+    """Record a span that was timed by the caller, e.g. one that is not a single block of code"""
+
+    if _profiler is not None:
+        _profiler.record(name, seconds, detail)
+
+
+def process_age():
+    """Returns how long ago this process was started, in seconds, including the time taken to start the
+    interpreter and import modules. Where this is not known, the CPU time used so far is returned instead.
+    """
+
+    try:
+        with open("/proc/self/stat") as f:
+            # The process name, in parentheses, may contain spaces, so the fields are counted after it
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0)
+    except (OSError, ValueError, IndexError):
+        return time.process_time()
+
+
+def for_worker():
+    """Returns the settings to profile a worker process with, to pass to start_worker, or None if the run
+    is not being profiled
+    """
+
+    if _profiler is None:
+        return None
+    return {"sample_interval": _profiler.sample_interval}
+
+
+def start_worker(settings):
+    """Start profiling a worker process, with the settings returned by for_worker in the parent process.
+    The profile of the parent process may have been inherited when the worker was forked, so it is always
+    replaced.
+    """
+
+    profiler = None
+    if settings is not None:
+        profiler = Profiler(settings["sample_interval"], thread_prefix="worker-").start()
+    set_profiler(profiler)
+
+
+def finish_worker():
+    """Stop profiling a worker process.
+
+    Returns:
+        ProfileData: The worker's profile, to pass to merge in the parent process, or None if it was not
+            being profiled
+    """
+
+    if _profiler is None:
+        return None
+    _profiler.stop()
+    return _profiler.data
+
+
+def merge(data):
+    """Merge the profile of a worker process into the profile of this process"""
+
+    if data is not None and _profiler is not None:
+        _profiler.merge(data)
@@ -0,0 +1,149 @@
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from sgrk.archive import makedirs_private, open_private
+from sgrk.cache import FileCache, cache_key
+
+# Timestamps, PIDs, addresses and hashes differ between otherwise equivalent prompts, e.g. the same log lines
+# fetched twice or the same stack trace from two processes, so they are masked before comparing prompts. Other
+# numbers, e.g. the CPU usage in the output of top, are kept, as prompts that differ in them are not equivalent.
+# Prompts are lower cased before they are masked.
+_volatile_res = [
+    (re.compile(r"\b\d{4}-\d\d-\d\d(?:[t ]\d\d:\d\d(?::\d\d(?:[.,]\d+)?)?(?:z|[+-]\d\d:?\d\d)?)?\b|"
+                r"\b\d\d?:\d\d:\d\d(?:[.,]\d+)?\b|\[\s*\d+\.\d+\]"), "<timestamp>"),
+    (re.compile(r"(\bpid[=: ]\s*|\w\[)\d+"), r"\1<pid>"),
+    # Hashes and IDs are told apart from decimal numbers by having both digits and letters
+    (re.compile(r"\b0x[0-9a-f]+\b|\b(?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{8,}\b"), "<hex>"),
+]
+_token_re = re.compile(r"\w+|[^\w\s]")
+
+# Prompts are compared as sets of word n-grams of this length
+_SHINGLE_SIZE = 3
+# The number of hash functions in a MinHash signature, and the number of LSH bands it is split into.
+# With 16 bands of 4 rows, prompts with a similarity of 0.8 are found as candidates with a probability of
+# over 99.9%, and prompts with a similarity of 0.3 with a probability of about 12%.
+_NUM_PERM = 64
+_NUM_BANDS = 16
+_ROWS_PER_BAND = _NUM_PERM // _NUM_BANDS
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# The hash functions must be the same in every process and every run, so they are generated from a fixed seed
+_rng = random.Random(0x5ca1ab1e)
+_perms = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(_NUM_PERM)]
+
+
+def _normalise(text):
+    text = text.lower()
+    for regex, mask in _volatile_res:
+        text = regex.sub(mask, text)
+    return _token_re.findall(text)
+
+
+def _shingles(tokens):
+    if len(tokens) <= _SHINGLE_SIZE:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[i:i + _SHINGLE_SIZE]) for i in range(len(tokens) - _SHINGLE_SIZE + 1)}
+
+
+def signature(text):
+    """Returns the MinHash signature of the text, after it has been normalised"""
+
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+              for s in _shingles(_normalise(text))]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _perms]
+
+
+def similarity(sig_a, sig_b):
+    """Returns the estimated Jaccard similarity of the texts with the given signatures"""
+
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class SimilarityIndex:
+    """A persistent index of texts, and a value for each of them, which can be searched for texts that are
+    similar to a given one. Similarity is the Jaccard similarity of the normalised texts' shingles, as
+    estimated by MinHash, and candidates are found with locality sensitive hashing, so a lookup only reads
+    the entries that share at least one band of their signature with the text being looked up.
+
+    Entries are grouped by a namespace (e.g. the model and system prompt the text was sent with) and
+    texts only match entries in the same namespace. Entries older than max_age seconds do not match, and
+    are deleted when they are found.
+    """
+
+    def __init__(self, name, max_age=None):
+        self.entries = FileCache(name)
+        self.bands_path = os.path.join(self.entries.path, "lsh")
+        self.max_age = max_age
+
+    def _band_paths(self, namespace, sig):
+        for i in range(_NUM_BANDS):
+            band = sig[i * _ROWS_PER_BAND:(i + 1) * _ROWS_PER_BAND]
+            yield os.path.join(self.bands_path, cache_key(namespace, i, *band))
+
+    def lookup(self, namespace, sig, threshold):
+        """Find the most similar entry to the text with signature sig.
+
+        Returns:
+            (float, str): The similarity of the most similar entry and its value, or None for the value if
+                no entry has a similarity of at least threshold.
+        """
+
+        candidates = set()
+        for path in self._band_paths(namespace, sig):
+            try:
+                with open(path) as f:
+                    candidates.update(f.read().split())
+            except FileNotFoundError:
+                continue
+
+        best_similarity, best_value = 0, None
+        for key in candidates:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            entry = json.loads(entry)
+            # Entries added before they had a time are treated as expired
+            if self.max_age is not None and entry.get("time", 0) < time.time() - self.max_age:
+                self.entries.delete(key)
+                continue
+            s = similarity(sig, entry["signature"])
+            if s > best_similarity:
+                best_similarity, best_value = s, entry["value"]
+
+        if best_similarity < threshold:
+            return best_similarity, None
+        return best_similarity, best_value
+
+    def add(self, namespace, sig, value):
+        key = cache_key(namespace, *sig)
+        self.entries.put(key, json.dumps({"signature": sig, "value": value, "time": time.time()}))
+        try:
+            makedirs_private(self.bands_path)
+            for path in self._band_paths(namespace, sig):
+                # Appends of a single short line are atomic, so concurrent processes can add to the same band
+                with open_private(path, "a") as f:
+                    f.write(key + "\n")
+        except OSError as e:
+            logging.warning(f"Failed to add an entry to the similarity index in {self.bands_path}: {e}")
@@ -25,22 +25,43 @@
 # Email: sean.heelan@elastic.co
 
 
-from sgrk.llm import LLMConfig, set_config
+from sgrk.archive import get_run_archive, set_max_runs
+from sgrk.cmdexec import set_compress_output
+from sgrk.outputbuf import set_spill_bytes
+from sgrk.profiling import SPAN_STARTUP, Profiler, process_age, profiles_dir, record_span, set_profiler
+from sgrk.endpoints import EndpointPool, NoEndpointError
+from sgrk.llm import (
+    PHASES,
+    Budget,
+    BudgetExhaustedError,
+    LatencyStats,
+    LLMConfig,
+    dry_run_report,
+    get_latency_stats,
+    get_prompt_stats,
+    set_budget,
+    set_config,
+    set_latency_stats
+)
 from sgrk.commands import (
     analyzecmd,
+    baseline,
     code,
     debughost,
     explainfunction,
     explainprocess,
     findfaster,
     stacktrace,
-    topn
+    topn,
+    tune
 )
 
 import argparse
+import json
 import logging
 import os
 import sys
+import time
 
 import openai
 
@@ -57,26 +78,39 @@ try:
 except KeyError:
     pass
 
-if not api_key or not api_type:
-    sys.stderr.write("You must set the GAI API type and key\n")
-    sys.exit(1)
+# GAI_ENDPOINTS may be set to the path of a JSON file that describes several API endpoints, e.g. Azure
+# deployments in different regions, to spread LLM queries across, instead of the single endpoint given
+# by the other GAI_ variables. See sgrk/endpoints.py for the format.
+endpoints = None
+if os.environ.get("GAI_ENDPOINTS"):
+    try:
+        with open(os.environ["GAI_ENDPOINTS"]) as f:
+            endpoints = json.load(f)
+        EndpointPool.from_config(endpoints)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Invalid GAI_ENDPOINTS file: {e}\n")
+        sys.exit(1)
+else:
+    if not api_key or not api_type:
+        sys.stderr.write("You must set the GAI API type and key\n")
+        sys.exit(1)
 
-openai.api_key = api_key
-openai.api_type = api_type
+    openai.api_key = api_key
+    openai.api_type = api_type
 
-if api_type == "azure":
-    if not (api_base and api_version):
-        sys.stderr.write("Azure requires the API base and version to be set")
+    if api_type == "azure":
+        if not (api_base and api_version):
+            sys.stderr.write("Azure requires the API base and version to be set")
+            sys.exit(1)
+        openai.api_base = api_base
+        openai.api_version = api_version
+    elif api_type == "open_ai":
+        if api_base or api_version:
+            sys.stderr.write("You must not to set the GAI_API_BASE or GAI_API_VERSION for the open_ai GAI_API_TYPE")
+            sys.exit(1)
+    else:
+        sys.stderr.write(f"Invalid GAI_API_TYPE value: '{api_type}'. Must be azure or open_ai.")
         sys.exit(1)
-    openai.api_base = api_base
-    openai.api_version = api_version
-elif api_type == "open_ai":
-    if api_base or api_version:
-        sys.stderr.write("You must not to set the GAI_API_BASE or GAI_API_VERSION for the open_ai GAI_API_TYPE")
-        sys.exit(1)
-else:
-    sys.stderr.write(f"Invalid GAI_API_TYPE value: '{api_type}'. Must be azure or open_ai.")
-    sys.exit(1)
 
 
 ascii_name = """
@@ -94,13 +128,15 @@ System analysis and optimisation with LLMs
 if __name__ == "__main__":
     commands = {
         analyzecmd.command: analyzecmd,
+        baseline.command: baseline,
         code.command: code,
         explainfunction.command: explainfunction,
         explainprocess.command: explainprocess,
         debughost.command: debughost,
         findfaster.command: findfaster,
         stacktrace.command: stacktrace,
-        topn.command: topn
+        topn.command: topn,
+        tune.command: tune
     }
 
     parser = argparse.ArgumentParser(
@@ -118,9 +154,66 @@ if __name__ == "__main__":
     parser.add_argument("--output-format", type=str, help="Specify the output format for the LLM to use")
     parser.add_argument("-m", "--model-or-deployment-id", dest="model", default="gpt-3.5-turbo",
                         help="""The OpenAI model, or Azure deployment ID, to use.""")
+    parser.add_argument("--phase-model", action="append", default=[], metavar="PHASE=MODEL",
+                        help=f"""Use MODEL, instead of the model given by -m, for one phase of a run. PHASE is one of:
+    {', '.join(PHASES)}. E.g. a fast model for the chunk-summary and command-summary phases, which make the most
+    queries, and a stronger one for the analysis phase. May be given more than once.""")
+    parser.add_argument("--large-context-model", action="append", default=[], metavar="MODEL",
+                        help="""A model with a larger context window than the model in use, to send output that would
+    otherwise have to be summarised in chunks to. The cheapest of these models that is large enough is used. May be
+    given more than once. Models not known to sysgrok can be described in ~/.sysgrok/models.json.""")
+    parser.add_argument("--max-chunks-per-command", type=int, default=0,
+                        help="""Maximum number of chunks of a command's output to summarise, when it is too large to
+    summarise in one LLM query. If there are more chunks, those with the most rare lines, errors, warnings and unusual
+    values are summarised and the rest are skipped. 0, the default, means no limit.""")
     parser.add_argument("--temperature", type=float, default=0, help="ChatGPT temperature. See OpenAI docs.")
-    parser.add_argument("--max-concurrent-queries", type=int, default=4,
-                        help="Maximum number of parallel queries to OpenAI")
+    parser.add_argument("--max-concurrent-queries", type=int,
+                        help="""Maximum number of parallel queries to OpenAI. Defaults to the value the tune sub-command
+    found for the model, or 4 if it has not been tuned.""")
+    parser.add_argument("--hedge-percentile", type=float,
+                        help="""If an LLM query takes longer than this percentile (e.g. 95) of the recent latencies of
+    its model, send a duplicate query and use whichever response arrives first. Disabled by default.""")
+    parser.add_argument("--hedge-model",
+                        help="The model, or Azure deployment ID, to send duplicate queries to. Defaults to the same.")
+    parser.add_argument("--max-time", type=float,
+                        help="""Maximum wall time, in seconds, for the run. Once it is reached no more commands or LLM
+    queries are started, and whatever results are available are reported.""")
+    parser.add_argument("--max-tokens", type=int,
+                        help="""Maximum number of tokens to use across all LLM queries in the run. Summaries are
+    shortened, and low priority commands skipped, to stay within it.""")
+    parser.add_argument("--max-llm-calls", type=int, help="Maximum number of LLM queries to make in the run")
+    parser.add_argument("--similarity-threshold", type=float,
+                        help="""Reuse the response to an earlier LLM query if its prompt is at least this similar (0 to
+    1) to the new one, once timestamps, PIDs and addresses are ignored, and it was made in the last day. E.g. 0.9.
+    Disabled by default.""")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="""Do not query the LLM. Commands are executed, or their recorded output used with
+    --replay, and chunked and token counted as usual, and then the number of LLM calls each phase would make, the
+    tokens they would use, and an estimate of how long the run would take, are reported. Implies --no-archive.""")
+    parser.add_argument("--no-archive", action="store_true", default=False,
+                        help="""Do not record the output of the commands executed, and the LLM queries made, in the run
+    archive in ~/.sysgrok/runs. Archived runs can be analysed again with --replay.""")
+    parser.add_argument("--max-archived-runs", type=int, default=100, metavar="N",
+                        help="""Once a run is started, delete the oldest archived runs so that at most this many are
+    kept. 0 keeps all runs. Defaults to 100.""")
+
+    parser.add_argument("--compress-output", action="store_true", default=False,
+                        help="""Compress the output of the commands executed on remote hosts before it is sent over ssh,
+    with zstd or gzip, whichever is installed on the host. Much faster for large outputs over slow links.""")
+    parser.add_argument("--spill-threshold", type=int, default=16, metavar="MB",
+                        help="""The output of a command that is larger than this is written to a temporary file,
+    rather than kept in memory, to limit how much memory is used when commands produce very large outputs.""")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="""Profile sysgrok itself. Reports the time spent in each phase of the run, e.g. startup,
+    planning, executing each command, chunking, token counting and each LLM query, and writes a collapsed stack file,
+    for flame graph tools, and the hottest stack, for the stacktrace sub-command, to --profile-output.""")
+    parser.add_argument("--profile-output", metavar="PREFIX",
+                        help="""The path prefix of the files written by --profile.
+    Defaults to ~/.sysgrok/profiles/<time>-<pid>.""")
+    parser.add_argument("--profile-cprofile", action="store_true", default=False,
+                        help="Also profile the main thread with cProfile, and write its stats to PREFIX.pstats")
+    parser.add_argument("--profile-memory", action="store_true", default=False,
+                        help="Also trace memory allocations, and report the peak and the largest allocation sites")
 
     subparsers = parser.add_subparsers(help="The sub-command to execute", dest="sub_command")
     for v in commands.values():
@@ -137,7 +230,38 @@ if __name__ == "__main__":
 
     logging.basicConfig(format=log_format, datefmt=log_date_format, level=log_level)
 
-    set_config(LLMConfig(args.model, args.temperature, args.max_concurrent_queries, args.output_format))
+    profiler = None
+    if args.profile or args.profile_cprofile or args.profile_memory:
+        profiler = Profiler(cprofile=args.profile_cprofile, memory=args.profile_memory).start()
+        set_profiler(profiler)
+        # Startup, i.e. starting the interpreter and importing modules, happened before the profiler started
+        record_span(SPAN_STARTUP, process_age())
+
+    phase_models = {}
+    for pm in args.phase_model:
+        phase, _, model = pm.partition("=")
+        if phase not in PHASES or not model:
+            sys.stderr.write(f"Invalid --phase-model value: '{pm}'. Must be PHASE=MODEL, where PHASE is one of: "
+                             f"{', '.join(PHASES)}\n")
+            sys.exit(1)
+        phase_models[phase] = model
+
+    if args.dry_run:
+        if getattr(args, "resume", None):
+            sys.stderr.write("--resume cannot be used with --dry-run, as the run would be continued with placeholder "
+                             "responses\n")
+            sys.exit(1)
+        # The placeholder responses must not be replayed or resumed
+        args.no_archive = True
+
+    set_config(LLMConfig(args.model, args.temperature, args.max_concurrent_queries, args.output_format,
+                         args.similarity_threshold, phase_models, args.large_context_model, args.hedge_percentile,
+                         args.hedge_model, endpoints, args.max_chunks_per_command, args.dry_run))
+    set_budget(Budget(args.max_time, args.max_tokens, args.max_llm_calls).start())
+    set_latency_stats(LatencyStats.load())
+    set_compress_output(args.compress_output)
+    set_spill_bytes(args.spill_threshold * 1024 * 1024)
+    set_max_runs(args.max_archived_runs)
 
     if not args.sub_command:
         parser.print_help(sys.stderr)
@@ -149,4 +273,45 @@ if __name__ == "__main__":
         sys.stderr.write("\nUnknown sub-command\n")
         sys.exit(1)
 
-    sys.exit(commands[args.sub_command].run(parser, args))
+    start = time.time()
+    try:
+        ret = commands[args.sub_command].run(parser, args)
+    except BudgetExhaustedError as e:
+        logging.error(f"Run budget exhausted: {e}")
+        ret = 1
+    except NoEndpointError as e:
+        logging.error(e)
+        ret = 1
+    except KeyboardInterrupt:
+        logging.error("Interrupted")
+        ret = 130
+
+    run_archive = get_run_archive()
+    if run_archive:
+        run_archive.finish(ret)
+        logging.info(f"Archived run as {run_archive.id}. Use --replay {run_archive.id} to analyse it again.")
+        if ret != 0:
+            logging.info(f"Use --resume {run_archive.id} to continue it from where it stopped.")
+
+    if get_latency_stats().new_samples:
+        get_latency_stats().save()
+
+    if args.dry_run:
+        print(dry_run_report(time.time() - start))
+
+    prompt_stats = get_prompt_stats()
+    if prompt_stats.prefixes:
+        logging.info(f"{prompt_stats.calls} LLM queries sent {prompt_stats.total_prefix_tokens()} tokens in shared "
+                     f"prompt prefixes. {prompt_stats.reused_prefix_calls()} of them repeated the prefix of an earlier "
+                     f"query, for {prompt_stats.reused_prefix_tokens()} tokens")
+
+    if profiler:
+        profiler.stop()
+        sys.stderr.write(profiler.report() + "\n")
+        path_prefix = args.profile_output or os.path.join(profiles_dir,
+                                                          f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+        paths = profiler.save(path_prefix)
+        if paths:
+            logging.info(f"Wrote the profile to {', '.join(paths)}. Use 'sysgrok.py stacktrace "
+                         f"{path_prefix}.hottest.txt' to have the hottest stack explained.")
+    sys.exit(ret)